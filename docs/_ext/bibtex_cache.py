@@ -0,0 +1,96 @@
+# -*- coding: utf-8 -*-
+"""
+Sphinx extension caching the bibliography parsed by sphinxcontrib-bibtex.
+
+sphinxcontrib-bibtex parses all files of ``bibtex_bibfiles`` with pybtex whenever the environment is created anew
+(e.g. a clean or ``-E`` build). This extension stores the parsed data as a pickle, keyed by a hash of the contents of
+the files, and loads it instead of parsing files that did not change.
+
+Configuration values (``conf.py``):
+
+- ``bibtex_cache_dir``: directory of the cache (default: ``bibtex_cache`` in the doctrees directory)
+"""
+import hashlib
+import os
+import pickle
+import tempfile
+
+from sphinx.util import logging
+from sphinxcontrib.bibtex import bibfile
+
+logger = logging.getLogger(__name__)
+
+# Bump this whenever the structure of the cached data changes
+CACHE_VERSION = 1
+
+
+def get_cache_key(bibfilenames, encoding):
+  h = hashlib.sha1()
+  h.update(('%i\0%s\0' % (CACHE_VERSION, encoding)).encode('utf-8'))
+  for filename in bibfilenames:
+    h.update(('%s\0' % filename).encode('utf-8'))
+    if filename.is_file():
+      with open(str(filename), mode='rb') as bib_fs:
+        h.update(hashlib.sha1(bib_fs.read()).digest())
+  return h.hexdigest()
+
+
+def make_cached_parser(parse_bibdata, get_cache_dir):
+  """
+  Wrap ``sphinxcontrib.bibtex.bibfile.parse_bibdata`` with the cache.
+
+  :param get_cache_dir: function returning the cache directory, or None to disable the cache
+  """
+
+  def parse_bibdata_cached(bibfilenames, encoding):
+    cache_dir = get_cache_dir()
+    if cache_dir is None:
+      return parse_bibdata(bibfilenames, encoding)
+
+    fname = os.path.join(cache_dir, get_cache_key(bibfilenames, encoding) + '.pickle')
+    if os.path.isfile(fname):
+      try:
+        with open(fname, mode='rb') as cache_fs:
+          bibdata = pickle.load(cache_fs)
+        logger.info('loaded parsed bibliography from cache')
+        # The environment checks the modification times to decide whether the files must be parsed again
+        return bibdata._replace(bibfiles=dict(
+          (f, b._replace(mtime=bibfile.get_mtime(f))) for f, b in bibdata.bibfiles.items()))
+      except Exception as e:
+        logger.warning('bibliography cache %s could not be loaded (%s), parsing the bibliography', fname, e)
+
+    bibdata = parse_bibdata(bibfilenames, encoding)
+    if not os.path.isdir(cache_dir):
+      os.makedirs(cache_dir)
+    # Write to a temporary file first, so an interrupted build never leaves a truncated entry. Its name is unique, as
+    # concurrent builds may share the cache.
+    tmp_fd, tmp_fname = tempfile.mkstemp(suffix='.tmp', dir=cache_dir)
+    with os.fdopen(tmp_fd, 'wb') as cache_fs:
+      pickle.dump(bibdata, cache_fs, protocol=pickle.HIGHEST_PROTOCOL)
+    os.replace(tmp_fname, fname)
+    return bibdata
+
+  return parse_bibdata_cached
+
+
+def setup(app):
+  app.setup_extension('sphinxcontrib.bibtex')
+  app.add_config_value('bibtex_cache_dir', None, '')
+
+  def get_cache_dir():
+    if app.config.bibtex_cache_dir is not None:
+      return app.config.bibtex_cache_dir
+    if app.doctreedir is None:
+      return None
+    return os.path.join(str(app.doctreedir), 'bibtex_cache')
+
+  # process_bibdata looks up parse_bibdata in the module namespace when the builder is initialised. The wrapper of a
+  # previous application in the same process is replaced.
+  parse_bibdata = getattr(bibfile.parse_bibdata, 'uncached', bibfile.parse_bibdata)
+  bibfile.parse_bibdata = make_cached_parser(parse_bibdata, get_cache_dir)
+  bibfile.parse_bibdata.uncached = parse_bibdata
+  return {
+    'version': '0.1',
+    'parallel_read_safe': True,
+    'parallel_write_safe': True
+  }
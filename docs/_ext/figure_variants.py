@@ -0,0 +1,75 @@
+# -*- coding: utf-8 -*-
+"""
+Sphinx extension serving the WebP variants of figures made by ``scripts/figure_assets.py``.
+
+An image ``Figures/x.png`` with variants ``Figures/x.webp`` (shown size) and ``Figures/x@2x.webp`` (twice the shown
+size) next to it is written as a ``<picture>`` element, so browsers that support WebP load the smallest variant that
+suits the screen, and other browsers load the PNG. The variants are copied to the output with the images.
+"""
+import os
+import posixpath
+import shutil
+
+from docutils import nodes
+from sphinx.util import logging
+from sphinx.writers.html5 import HTML5Translator
+
+logger = logging.getLogger(__name__)
+
+# Suffixes of the variants and their size relative to the size the image is shown at, as in scripts/figure_assets.py
+WEBP_VARIANTS = (('.webp', 1), ('@2x.webp', 2))
+
+
+def get_variants(srcdir, uri):
+  """
+  :return: list of (suffix, density) of the variants that exist for the image
+  """
+  base = os.path.splitext(os.path.join(str(srcdir), uri))[0]
+  return [(suffix, density) for suffix, density in WEBP_VARIANTS if os.path.isfile(base + suffix)]
+
+
+def html_visit_image(self, node):
+  variants = []
+  if node['uri'] in self.builder.images:
+    variants = get_variants(self.builder.srcdir, node['uri'])
+  if len(variants) == 0:
+    node['picture'] = False
+    return HTML5Translator.visit_image(self, node)
+
+  base = posixpath.join(self.builder.imgpath, os.path.splitext(self.builder.images[node['uri']])[0])
+  srcset = ', '.join('%s%s %ix' % (base, suffix, density) for suffix, density in variants)
+  node['picture'] = True
+  self.body.append('<picture><source type="image/webp" srcset="%s" />' % self.attval(srcset))
+  HTML5Translator.visit_image(self, node)
+
+
+def html_depart_image(self, node):
+  HTML5Translator.depart_image(self, node)
+  if node.get('picture'):
+    self.body.append('</picture>')
+
+
+def copy_variants(app, exception):
+  if exception is not None or app.builder.format != 'html':
+    return
+  dest_dir = os.path.join(str(app.builder.outdir), app.builder.imagedir)
+  n_copied = 0
+  for uri, dest in app.builder.images.items():
+    src_base = os.path.splitext(os.path.join(str(app.srcdir), uri))[0]
+    dest_base = os.path.join(dest_dir, os.path.splitext(dest)[0])
+    for suffix, _ in get_variants(app.srcdir, uri):
+      if not os.path.isfile(dest_base + suffix) or \
+         os.path.getmtime(dest_base + suffix) < os.path.getmtime(src_base + suffix):
+        shutil.copyfile(src_base + suffix, dest_base + suffix)
+        n_copied += 1
+  logger.info('copied %i figure variants', n_copied)
+
+
+def setup(app):
+  app.add_node(nodes.image, override=True, html=(html_visit_image, html_depart_image))
+  app.connect('build-finished', copy_variants)
+  return {
+    'version': '0.1',
+    'parallel_read_safe': True,
+    'parallel_write_safe': True
+  }
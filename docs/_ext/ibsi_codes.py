@@ -0,0 +1,121 @@
+# -*- coding: utf-8 -*-
+"""
+Sphinx extension to refer to IBSI codes (e.g. ``MPUJ``) and look them up.
+
+The converter (``scripts/parse_tex.py``) labels every header with an IBSI code as ``ibsi_<code>`` and writes an index
+of all codes to ``ibsi_codes.json``. This extension adds:
+
+- the ``:ibsi:`` role: ``:ibsi:`MPUJ``` (or ``:ibsi:`grid distances <MPUJ>```) links to the header of the code, by
+  the label the index gives for it. Unknown codes are reported while the document is read, and not linked.
+- ``_static/ibsi_codes.json`` in the HTML output, mapping every code to the URL of its header (relative to the root of
+  the site), its name and its family, for tools and pages to look up codes without searching
+- a script that resolves URL fragments holding a code, so that ``<any page>#MPUJ`` opens the header of ``MPUJ``
+
+Configuration values (``conf.py``):
+
+- ``ibsi_codes_index``: path of the index written by the converter, relative to the configuration directory
+"""
+import json
+import os
+import re
+
+from docutils import nodes, utils
+from sphinx import addnodes
+from sphinx.util import logging
+from sphinx.util.nodes import split_explicit_title
+
+logger = logging.getLogger(__name__)
+
+CODE_PATTERN = re.compile(r'^[0-9A-Z]{4}$')
+
+LOOKUP_SCRIPT = u"""
+(function () {
+  var code = decodeURIComponent(window.location.hash.substr(1)).toUpperCase();
+  if (!/^[0-9A-Z]{4}$/.test(code) || document.getElementById(window.location.hash.substr(1))) {
+    return;
+  }
+  var root = document.documentElement.dataset.content_root;
+  if (root === undefined) {
+    root = DOCUMENTATION_OPTIONS.URL_ROOT;
+  }
+  var request = new XMLHttpRequest();
+  request.open('GET', root + '_static/ibsi_codes.json');
+  request.onload = function () {
+    var entry = request.status === 200 ? JSON.parse(request.responseText)[code] : undefined;
+    if (entry !== undefined) {
+      window.location.replace(root + entry.url);
+    }
+  };
+  request.send();
+})();
+"""
+
+
+def load_index(app):
+  fname = os.path.join(str(app.confdir), app.config.ibsi_codes_index)
+  app.ibsi_codes_file = fname
+  if not os.path.isfile(fname):
+    # Not an error: the documents have no IBSI code labels either until they are converted
+    logger.info('IBSI code index %s not found, IBSI codes are not linked (run scripts/parse_tex.py to create it)',
+                fname)
+    app.ibsi_codes = {}
+    return
+  with open(fname, mode='rb') as index_fs:
+    app.ibsi_codes = json.loads(index_fs.read().decode('utf-8'))
+
+
+def ibsi_role(name, rawtext, text, lineno, inliner, options=None, content=None):
+  """
+  Link to the header of an IBSI code, resolved as a reference to its label. The code is the link text, unless a title
+  is passed.
+  """
+  env = inliner.document.settings.env
+  has_title, title, code = split_explicit_title(utils.unescape(text))
+  code = code.strip().upper()
+
+  env.note_dependency(env.app.ibsi_codes_file)
+  text_node = nodes.inline(rawtext, title if has_title else code, classes=['xref', 'ibsi'])
+  if CODE_PATTERN.match(code) is None or code not in env.app.ibsi_codes:
+    logger.warning('unknown IBSI code: %s', code, location=(env.docname, lineno), type='ibsi', subtype='code')
+    return [text_node], []
+
+  # A missing label is reported when references are resolved
+  node = addnodes.pending_xref(rawtext, refdomain='std', reftype='ref', reftarget=env.app.ibsi_codes[code]['label'],
+                               refexplicit=True, refwarn=True, refdoc=env.docname)
+  node += text_node
+  return [node], []
+
+
+def write_lookup(app, exception):
+  """
+  Write the lookup file and script to the static files of the HTML output.
+  """
+  if exception is not None or app.builder.format != 'html':
+    return
+  lookup = {}
+  for code, entry in app.ibsi_codes.items():
+    if entry['document'] not in app.env.all_docs:
+      continue
+    lookup[code] = dict((k, entry[k]) for k in ('name', 'type', 'family', 'family_code') if k in entry)
+    lookup[code]['url'] = app.builder.get_target_uri(entry['document']) + '#' + entry['anchor']
+
+  static_dir = os.path.join(str(app.builder.outdir), '_static')
+  if not os.path.isdir(static_dir):
+    os.makedirs(static_dir)
+  with open(os.path.join(static_dir, 'ibsi_codes.json'), mode='wb') as lookup_fs:
+    lookup_fs.write(json.dumps(lookup, sort_keys=True, separators=(',', ':')).encode('utf-8'))
+  with open(os.path.join(static_dir, 'ibsi_lookup.js'), mode='wb') as script_fs:
+    script_fs.write(LOOKUP_SCRIPT.encode('utf-8'))
+
+
+def setup(app):
+  app.add_config_value('ibsi_codes_index', 'ibsi_codes.json', 'env')
+  app.add_role('ibsi', ibsi_role)
+  app.add_js_file('ibsi_lookup.js', defer='defer')
+  app.connect('builder-inited', load_index)
+  app.connect('build-finished', write_lookup)
+  return {
+    'version': '0.1',
+    'parallel_read_safe': True,
+    'parallel_write_safe': True
+  }
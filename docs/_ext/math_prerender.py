@@ -0,0 +1,349 @@
+# -*- coding: utf-8 -*-
+"""
+Sphinx extension rendering math to static HTML at build time, so pages do not have to wait for MathJax to typeset the
+formulas in the browser.
+
+After a document is resolved, all its formulas that are not yet in the cache are rendered in a single batch by the
+configured renderer. Results are stored in a persistent cache keyed by a hash of the renderer, the display mode and
+the formula, so unchanged formulas are never rendered again. Formulas the renderer cannot render are written as
+MathJax markup instead, and MathJax is only loaded on the pages that contain such formulas.
+
+Configuration values (``conf.py``):
+
+- ``math_prerender_renderer``: ``'katex'`` (KaTeX, run by node.js), ``'stub'`` (offline renderer for testing), the
+  dotted path of a :py:class:`Renderer` subclass, or a :py:class:`Renderer` instance. If None (the default), math is
+  not pre-rendered and Sphinx renders it with MathJax as usual. KaTeX needs node.js and the ``katex`` npm package,
+  which are not Python requirements (``npm install katex``).
+- ``math_prerender_cache``: directory of the cache (default: ``math_cache`` in the doctrees directory)
+- ``math_prerender_node``: node.js executable used by the KaTeX renderer (default: ``node``)
+- ``math_prerender_katex``: path passed to ``require`` to load KaTeX (default: ``katex``, i.e. installed by npm)
+- ``math_prerender_macros``: dict of macro: definition passed to KaTeX (see the ``macros`` option of KaTeX), e.g. the
+  macros the converter leaves in the text (``math_macros.json``, see ``conf.py``)
+"""
+import hashlib
+import importlib
+import json
+import os
+import subprocess
+import tempfile
+
+from docutils import nodes
+from sphinx.ext import mathjax
+from sphinx.util import logging
+from sphinx.util.math import get_node_equation_number
+
+logger = logging.getLogger(__name__)
+
+# Class of the markup written by sphinx.ext.mathjax, used to find the pages that need MathJax
+MATHJAX_CLASS = 'math notranslate nohighlight'
+PRERENDERED_CLASS = 'math-prerendered'
+
+
+class RendererUnavailable(Exception):
+  """
+  Raised by a renderer that cannot render anything (e.g. because a program is missing). Formulas are then left to
+  MathJax, without storing them as failed in the cache.
+  """
+
+
+class Renderer(object):
+  """
+  Base class of the math renderers.
+  """
+
+  def key(self):
+    """
+    :return: string identifying the renderer and its version, part of the cache key of each formula
+    """
+    return type(self).__name__
+
+  def css_files(self):
+    """
+    :return: list of CSS files (URLs) needed by the rendered HTML
+    """
+    return []
+
+  def render(self, formulas):
+    """
+    Render a batch of formulas.
+
+    :param formulas: list of (TeX source, display mode) tuples
+    :return: list of HTML strings, None for formulas that could not be rendered
+    """
+    raise NotImplementedError()
+
+
+class StubRenderer(Renderer):
+  """
+  Renderer that needs no external programs, for testing: formulas are written as escaped TeX in a ``<code>`` element.
+
+  :param fail_on: formulas containing this string are reported as not renderable
+  """
+
+  def __init__(self, fail_on=r'\unrenderable'):
+    self.fail_on = fail_on
+
+  def render(self, formulas):
+    html = []
+    for tex, display in formulas:
+      if self.fail_on and self.fail_on in tex:
+        html.append(None)
+      else:
+        html.append(u'<code class="math-stub%s">%s</code>' % (' display' if display else '', escape(tex)))
+    return html
+
+
+KATEX_SCRIPT = u"""
+var katex = require(process.argv[1]);
+var macros = JSON.parse(process.argv[2]);
+var data = '';
+process.stdin.setEncoding('utf8');
+process.stdin.on('data', function (chunk) { data += chunk; });
+process.stdin.on('end', function () {
+  var html = JSON.parse(data).map(function (f) {
+    try {
+      return katex.renderToString(f[0], {displayMode: f[1], throwOnError: true, macros: Object.assign({}, macros)});
+    } catch (e) {
+      return null;
+    }
+  });
+  process.stdout.write(JSON.stringify(html));
+});
+"""
+
+
+class KatexRenderer(Renderer):
+  """
+  Renders formulas to HTML with KaTeX, running a single node.js process per batch.
+  """
+
+  def __init__(self, node='node', katex='katex', macros=None):
+    self.node = node
+    self.katex = katex
+    self.macros = macros or {}
+    self._version = None
+
+  def version(self):
+    if self._version is None:
+      try:
+        self._version = subprocess.check_output(
+          [self.node, '-e', 'process.stdout.write(require(process.argv[1]).version)', self.katex],
+          stderr=subprocess.PIPE).decode('utf-8')
+      except (OSError, subprocess.CalledProcessError) as e:
+        raise RendererUnavailable('KaTeX could not be loaded by %s (%s)' % (self.node, e))
+    return self._version
+
+  def key(self):
+    if len(self.macros) == 0:
+      return 'katex-%s' % self.version()
+    macros = json.dumps(self.macros, sort_keys=True).encode('utf-8')
+    return 'katex-%s-%s' % (self.version(), hashlib.sha1(macros).hexdigest()[:12])
+
+  def css_files(self):
+    return ['https://cdn.jsdelivr.net/npm/katex@%s/dist/katex.min.css' % self.version()]
+
+  def render(self, formulas):
+    self.version()  # Check that KaTeX is available
+    proc = subprocess.Popen([self.node, '-e', KATEX_SCRIPT, self.katex, json.dumps(self.macros)],
+                            stdin=subprocess.PIPE, stdout=subprocess.PIPE)
+    out, _ = proc.communicate(json.dumps(formulas).encode('utf-8'))
+    if proc.returncode != 0:
+      raise RendererUnavailable('KaTeX renderer exited with code %i' % proc.returncode)
+    return json.loads(out.decode('utf-8'))
+
+
+RENDERERS = {
+  'stub': StubRenderer,
+  'katex': KatexRenderer
+}
+
+
+def get_renderer(config):
+  renderer = config.math_prerender_renderer
+  if renderer is None or isinstance(renderer, Renderer):
+    return renderer
+  if renderer == 'katex':
+    return KatexRenderer(config.math_prerender_node, config.math_prerender_katex, config.math_prerender_macros)
+  if renderer in RENDERERS:
+    return RENDERERS[renderer]()
+  module_name, class_name = renderer.rsplit('.', 1)
+  return getattr(importlib.import_module(module_name), class_name)()
+
+
+class MathCache(object):
+  """
+  On-disk store of rendered formulas, one file per formula. Formulas that could not be rendered are stored as well, so
+  they are not passed to the renderer again.
+  """
+
+  FAILED = object()
+
+  def __init__(self, cache_dir):
+    self.cache_dir = cache_dir
+    if not os.path.isdir(cache_dir):
+      os.makedirs(cache_dir)
+
+  def get(self, key):
+    """
+    :return: the HTML of the formula, :py:attr:`FAILED` if it could not be rendered, or None if it is not cached
+    """
+    fname = os.path.join(self.cache_dir, key + '.html')
+    if os.path.isfile(fname):
+      with open(fname, mode='rb') as cache_fs:
+        return cache_fs.read().decode('utf-8')
+    if os.path.isfile(os.path.join(self.cache_dir, key + '.failed')):
+      return self.FAILED
+    return None
+
+  def put(self, key, html):
+    # Write to a temporary file first, so an interrupted build never leaves a truncated entry. Its name is unique, as
+    # concurrent builds may share the cache.
+    fname = os.path.join(self.cache_dir, key + ('.failed' if html is None else '.html'))
+    tmp_fd, tmp_fname = tempfile.mkstemp(suffix='.tmp', dir=self.cache_dir)
+    with os.fdopen(tmp_fd, 'wb') as cache_fs:
+      cache_fs.write(b'' if html is None else html.encode('utf-8'))
+    os.replace(tmp_fname, fname)
+
+
+def escape(text):
+  return text.replace('&', '&amp;').replace('<', '&lt;').replace('>', '&gt;').replace('"', '&quot;')
+
+
+def get_block_tex(node):
+  """
+  TeX source of a math block, with multiple equations aligned the same way sphinx.ext.mathjax does.
+  """
+  parts = [p for p in node.astext().split('\n\n') if p.strip()]
+  parts = [r'\begin{split}%s\end{split}' % p if r'\\' in p else p for p in parts]
+  if len(parts) > 1:
+    return r'\begin{aligned}%s\end{aligned}' % r'\\'.join(parts)
+  return u''.join(parts)
+
+
+def get_formula_key(renderer_key, tex, display):
+  h = hashlib.sha1()
+  for part in (renderer_key, 'display' if display else 'inline', tex):
+    h.update(part.encode('utf-8'))
+    h.update(b'\0')
+  return h.hexdigest()
+
+
+def prerender_math(app, doctree, docname):
+  """
+  Render the formulas of a resolved document, storing the HTML in the ``prerendered`` attribute of each math node.
+  """
+  renderer = app.math_prerender_renderer
+  if renderer is None or app.builder.format != 'html':
+    return
+
+  cache = MathCache(app.config.math_prerender_cache or os.path.join(app.doctreedir, 'math_cache'))
+  try:
+    renderer_key = renderer.key()
+  except RendererUnavailable as e:
+    logger.warning('Math is not pre-rendered: %s', e, once=True)
+    app.math_prerender_renderer = None
+    return
+
+  to_render = {}  # key: (formula, nodes)
+  for node in doctree.findall(lambda n: isinstance(n, (nodes.math, nodes.math_block))):
+    display = isinstance(node, nodes.math_block)
+    if display and node.get('no-wrap', node.get('nowrap', False)):
+      continue
+    tex = get_block_tex(node) if display else node.astext()
+    key = get_formula_key(renderer_key, tex, display)
+    html = cache.get(key)
+    if html is None:
+      to_render.setdefault(key, ((tex, display), []))[1].append(node)
+    elif html is not MathCache.FAILED:
+      node['prerendered'] = html
+
+  if len(to_render) == 0:
+    return
+
+  keys = list(to_render.keys())
+  try:
+    rendered = renderer.render([to_render[k][0] for k in keys])
+  except RendererUnavailable as e:
+    logger.warning('Math is not pre-rendered: %s', e, once=True)
+    app.math_prerender_renderer = None
+    return
+
+  for key, html in zip(keys, rendered):
+    cache.put(key, html)
+    if html is None:
+      logger.info('Formula could not be pre-rendered, leaving it to MathJax: %s', to_render[key][0][0],
+                  location=to_render[key][1][0])
+      continue
+    for node in to_render[key][1]:
+      node['prerendered'] = html
+
+
+def html_visit_math(self, node):
+  if 'prerendered' not in node:
+    mathjax.html_visit_math(self, node)
+  self.body.append(self.starttag(node, 'span', '', CLASS=PRERENDERED_CLASS))
+  self.body.append(node['prerendered'] + '</span>')
+  raise nodes.SkipNode
+
+
+def html_visit_displaymath(self, node):
+  if 'prerendered' not in node:
+    mathjax.html_visit_displaymath(self, node)
+  self.body.append(self.starttag(node, 'div', CLASS=PRERENDERED_CLASS))
+  if node['number']:
+    number = get_node_equation_number(self, node)
+    self.body.append('<span class="eqno">(%s)' % number)
+    self.add_permalink_ref(node, 'Link to this equation')
+    self.body.append('</span>')
+  self.body.append(node['prerendered'])
+  self.body.append('</div>\n')
+  raise nodes.SkipNode
+
+
+def install_assets(app, pagename, templatename, context, doctree):
+  """
+  Add the CSS of the renderer to pages with pre-rendered math, and MathJax to pages with formulas left to MathJax.
+  """
+  if app.builder.format != 'html' or app.builder.math_renderer_name != 'prerender':
+    return
+  body = context.get('body', '')
+  renderer = app.math_prerender_renderer
+  if renderer is not None and PRERENDERED_CLASS in body:
+    for css in renderer.css_files():
+      app.builder.add_css_file(css)
+  if MATHJAX_CLASS in body:
+    options = dict(app.config.mathjax_options)
+    if 'async' not in options and 'defer' not in options:
+      options['defer'] = 'defer'
+    if app.config.mathjax3_config:
+      app.builder.add_js_file('', body='window.MathJax = %s' % json.dumps(app.config.mathjax3_config))
+    app.builder.add_js_file(app.config.mathjax_path, **options)
+
+
+def init_renderer(app):
+  app.math_prerender_renderer = get_renderer(app.config)
+
+
+def select_math_renderer(app, config):
+  if config.html_math_renderer is None and config.math_prerender_renderer is not None:
+    config.html_math_renderer = 'prerender'
+
+
+def setup(app):
+  app.setup_extension('sphinx.ext.mathjax')
+  app.add_html_math_renderer('prerender', (html_visit_math, None), (html_visit_displaymath, None))
+  app.add_config_value('math_prerender_renderer', None, 'html')
+  app.add_config_value('math_prerender_cache', None, '')
+  app.add_config_value('math_prerender_node', 'node', '')
+  app.add_config_value('math_prerender_katex', 'katex', '')
+  app.add_config_value('math_prerender_macros', {}, 'html')
+
+  app.connect('config-inited', select_math_renderer)
+  app.connect('builder-inited', init_renderer)
+  app.connect('doctree-resolved', prerender_math)
+  app.connect('html-page-context', install_assets)
+  return {
+    'version': '0.1',
+    'parallel_read_safe': True,
+    'parallel_write_safe': True
+  }
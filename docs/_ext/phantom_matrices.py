@@ -0,0 +1,266 @@
+# -*- coding: utf-8 -*-
+"""
+Sphinx extension rendering the texture matrices of the digital phantom from the data files written by the converter
+(``scripts/phantom_matrices.py``), instead of parsing them from grid tables.
+
+``.. phantom-matrices:: /phantom_matrices/<name>.json`` shows all matrices of a data file. In HTML, each matrix is a
+compact table without the per-cell markup of regular tables. Matrices can also be loaded lazily: the page then only
+holds their captions, and a script fetches the data file from ``_static/phantom_matrices`` once the matrices scroll into
+view. Other builders get regular tables.
+
+Options of the directive:
+
+- ``:lazy:``: load the matrices lazily (HTML only)
+
+Configuration values (``conf.py``):
+
+- ``phantom_matrices_lazy_rows``: data files with more rows than this, over all their matrices, are loaded lazily (None
+  to only load the files of directives with the ``:lazy:`` option lazily)
+"""
+import json
+import os
+import posixpath
+import shutil
+
+from docutils import nodes
+from docutils.parsers.rst import directives
+from sphinx.util import logging
+from sphinx.util.docutils import SphinxDirective
+
+logger = logging.getLogger(__name__)
+
+STATIC_DIR = posixpath.join('_static', 'phantom_matrices')
+
+LAZY_SCRIPT = u"""
+(function () {
+  function fill(table, matrix) {
+    var html = '<thead><tr><th>' + matrix.columns.join('</th><th>') + '</th></tr></thead><tbody>';
+    matrix.rows.forEach(function (row) {
+      html += '<tr><td>' + row.split(' ').join('</td><td>') + '</td></tr>';
+    });
+    table.insertAdjacentHTML('beforeend', html + '</tbody>');
+  }
+
+  function load(div) {
+    fetch(div.dataset.src).then(function (response) { return response.json(); }).then(function (data) {
+      div.querySelectorAll('table.phantom-matrix').forEach(function (table, index) { fill(table, data.matrices[index]); });
+      div.classList.remove('phantom-matrices-lazy');
+    });
+  }
+
+  function init() {
+    var divs = document.querySelectorAll('div.phantom-matrices-lazy');
+    if (!('IntersectionObserver' in window)) {
+      divs.forEach(load);
+      return;
+    }
+    var observer = new IntersectionObserver(function (entries) {
+      entries.forEach(function (entry) {
+        if (entry.isIntersecting) {
+          observer.unobserve(entry.target);
+          load(entry.target);
+        }
+      });
+    }, {rootMargin: '200px'});
+    divs.forEach(function (div) { observer.observe(div); });
+  }
+
+  if (document.readyState === 'loading') {
+    document.addEventListener('DOMContentLoaded', init);
+  } else {
+    init();
+  }
+})();
+"""
+
+CSS = u"""
+div.phantom-matrices { display: flex; flex-wrap: wrap; gap: 1em 2em; align-items: flex-start; }
+table.phantom-matrix { border-collapse: collapse; margin: 0; }
+table.phantom-matrix caption { caption-side: top; text-align: left; max-width: 16em; padding-bottom: 0.3em; }
+table.phantom-matrix caption p { margin: 0; }
+table.phantom-matrix th, table.phantom-matrix td { padding: 0.1em 0.6em; text-align: right; }
+table.phantom-matrix thead { border-bottom: 1px solid #888; }
+div.phantom-matrices-lazy table.phantom-matrix { height: 10em; }
+"""
+
+
+class phantom_matrices(nodes.General, nodes.Element):
+  pass
+
+
+class phantom_matrix(nodes.General, nodes.Element):
+  """
+  A matrix: its caption as a paragraph child, and its ``columns`` and ``rows`` (lists of cell texts) as attributes.
+  """
+  pass
+
+
+class PhantomMatricesDirective(SphinxDirective):
+  required_arguments = 1
+  has_content = False
+  option_spec = {
+    'lazy': directives.flag
+  }
+
+  def run(self):
+    rel_fname, fname = self.env.relfn2path(self.arguments[0], self.env.docname)
+    self.env.note_dependency(rel_fname)
+    try:
+      with open(fname, mode='rb') as data_fs:
+        matrices = json.loads(data_fs.read().decode('utf-8'))['matrices']
+    except (IOError, OSError, ValueError, KeyError) as e:
+      return [self.state.document.reporter.warning('Matrices could not be read from %s: %s' % (fname, e),
+                                                   line=self.lineno)]
+
+    n_rows = sum(len(m['rows']) for m in matrices)
+    lazy_rows = self.config.phantom_matrices_lazy_rows
+    lazy = 'lazy' in self.options or (lazy_rows is not None and n_rows > lazy_rows)
+    node = phantom_matrices(src=rel_fname, lazy=lazy)
+    self.set_source_info(node)
+    for index, matrix in enumerate(matrices):
+      caption = nodes.paragraph()
+      caption += self.parse_inline(matrix['caption'], lineno=self.lineno)[0]
+      matrix_node = phantom_matrix(columns=matrix['columns'], rows=[r.split(' ') for r in matrix['rows']],
+                                   index=index)
+      matrix_node += caption
+      node += matrix_node
+
+    if lazy:
+      if not hasattr(self.env, 'phantom_matrices_lazy'):
+        self.env.phantom_matrices_lazy = {}
+      self.env.phantom_matrices_lazy.setdefault(self.env.docname, set()).add(rel_fname)
+    return [node]
+
+
+def get_static_file(rel_fname):
+  return posixpath.join(STATIC_DIR, posixpath.basename(rel_fname))
+
+
+def html_visit_matrices(self, node):
+  if node['lazy']:
+    src = posixpath.join(self.builder.get_target_uri(self.builder.current_docname).count('/') * '../',
+                         get_static_file(node['src']))
+    self.body.append(self.starttag(node, 'div', CLASS='phantom-matrices phantom-matrices-lazy', **{'data-src': src}))
+  else:
+    self.body.append(self.starttag(node, 'div', CLASS='phantom-matrices'))
+
+
+def html_depart_matrices(self, node):
+  self.body.append('</div>\n')
+
+
+def html_visit_matrix(self, node):
+  self.body.append('<table class="phantom-matrix"><caption>')
+
+
+def html_depart_matrix(self, node):
+  self.body.append('</caption>')
+  if not node.parent['lazy']:
+    self.body.append('\n<thead><tr><th>%s</th></tr></thead>\n<tbody>' %
+                     '</th><th>'.join(self.encode(c) for c in node['columns']))
+    # End tags of cells and rows are implied, which halves the size of the matrices
+    for row in node['rows']:
+      self.body.append('<tr><td>%s\n' % '<td>'.join(self.encode(c) for c in row))
+    self.body.append('</tbody>')
+  self.body.append('</table>\n')
+
+
+def build_table(node):
+  """
+  :return: a regular table node showing a matrix
+  """
+  columns = node['columns']
+  table = nodes.table(classes=['phantom-matrix'])
+  title = nodes.title()
+  title += node[0].children
+  table += title
+  tgroup = nodes.tgroup(cols=len(columns))
+  table += tgroup
+  for col_idx, column in enumerate(columns):
+    tgroup += nodes.colspec(colwidth=max([len(column)] + [len(r[col_idx]) for r in node['rows']]))
+
+  def make_row(cells):
+    row = nodes.row()
+    for cell in cells:
+      entry = nodes.entry()
+      entry += nodes.paragraph(cell, cell)
+      row += entry
+    return row
+
+  thead = nodes.thead()
+  thead += make_row(columns)
+  tgroup += thead
+  tbody = nodes.tbody()
+  for cells in node['rows']:
+    tbody += make_row(cells)
+  tgroup += tbody
+  return table
+
+
+def replace_matrices(app, doctree, docname):
+  """
+  Replace the matrices by regular tables for builders other than HTML.
+  """
+  if app.builder.format == 'html':
+    return
+  for node in list(doctree.findall(phantom_matrices)):
+    container = nodes.container(classes=['phantom-matrices'])
+    container.extend(build_table(m) for m in node.children)
+    node.replace_self(container)
+
+
+def purge_lazy(app, env, docname):
+  getattr(env, 'phantom_matrices_lazy', {}).pop(docname, None)
+
+
+def merge_lazy(app, env, docnames, other):
+  if not hasattr(env, 'phantom_matrices_lazy'):
+    env.phantom_matrices_lazy = {}
+  for docname in docnames:
+    if docname in getattr(other, 'phantom_matrices_lazy', {}):
+      env.phantom_matrices_lazy[docname] = other.phantom_matrices_lazy[docname]
+
+
+def add_lazy_script(app, pagename, templatename, context, doctree):
+  if app.builder.format == 'html' and pagename in getattr(app.env, 'phantom_matrices_lazy', {}):
+    app.builder.add_js_file('phantom_matrices.js', defer='defer')
+
+
+def write_static_files(app, exception):
+  """
+  Copy the data files of lazily loaded matrices, and write the script and style sheet to the static files.
+  """
+  if exception is not None or app.builder.format != 'html':
+    return
+  static_dir = os.path.join(str(app.builder.outdir), '_static')
+  data_dir = os.path.join(str(app.builder.outdir), STATIC_DIR)
+  if not os.path.isdir(data_dir):
+    os.makedirs(data_dir)
+  for docname, files in getattr(app.env, 'phantom_matrices_lazy', {}).items():
+    for rel_fname in files:
+      src = os.path.join(str(app.srcdir), rel_fname)
+      dest = os.path.join(str(app.builder.outdir), get_static_file(rel_fname))
+      if not os.path.isfile(dest) or os.path.getmtime(dest) < os.path.getmtime(src):
+        shutil.copyfile(src, dest)
+  with open(os.path.join(static_dir, 'phantom_matrices.js'), mode='wb') as script_fs:
+    script_fs.write(LAZY_SCRIPT.encode('utf-8'))
+  with open(os.path.join(static_dir, 'phantom_matrices.css'), mode='wb') as css_fs:
+    css_fs.write(CSS.encode('utf-8'))
+
+
+def setup(app):
+  app.add_config_value('phantom_matrices_lazy_rows', 50, 'env')
+  app.add_node(phantom_matrices, html=(html_visit_matrices, html_depart_matrices))
+  app.add_node(phantom_matrix, html=(html_visit_matrix, html_depart_matrix))
+  app.add_directive('phantom-matrices', PhantomMatricesDirective)
+  app.add_css_file('phantom_matrices.css')
+  app.connect('doctree-resolved', replace_matrices)
+  app.connect('env-purge-doc', purge_lazy)
+  app.connect('env-merge-info', merge_lazy)
+  app.connect('html-page-context', add_lazy_script)
+  app.connect('build-finished', write_static_files)
+  return {
+    'version': '0.1',
+    'parallel_read_safe': True,
+    'parallel_write_safe': True
+  }
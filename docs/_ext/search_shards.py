@@ -0,0 +1,215 @@
+# -*- coding: utf-8 -*-
+"""
+Sphinx extension making the HTML search index smaller and loading only the parts of it that a query needs.
+
+- Math and tables of numbers (e.g. the texture matrices of the digital phantom) are not indexed: their tokens are
+  noise that no one searches for.
+- The full-text terms are split into shards by their first characters. ``searchindex.js`` only holds the document
+  titles and other data needed for every query, and the search page loads the shards of the terms of a query on
+  demand. Partial matches are only found among terms in the same shard.
+- A query for an IBSI code (see the ``ibsi_codes`` extension) shows the header of that code as first result. The
+  codes are stored in the shards as well.
+
+The full index is kept in the doctrees directory, as Sphinx reads it back in incremental builds.
+
+Configuration values (``conf.py``):
+
+- ``search_shard_prefix_length``: number of leading characters of a term that select its shard
+- ``search_numeric_table_ratio``: tables in which at least this fraction of the body cells are numbers are not
+  indexed (None to index all tables)
+"""
+import hashlib
+import json
+import os
+import re
+
+from docutils import nodes
+from sphinx.util import logging
+
+logger = logging.getLogger(__name__)
+
+NUMBER_PATTERN = re.compile(u'^[-+−]?(\\d+([.,]\\d*)?|[.,]\\d+)([eE][-+]?\\d+)?%?$')
+SHARD_DIR = os.path.join('_static', 'search')
+
+SHARD_SCRIPT = u"""
+var SearchShards = {
+  files: null,
+  loaded: {},
+  waiting: {},
+
+  add: function (prefix, shard) {
+    var index = Search._index;
+    ['terms', 'titleterms', 'codes'].forEach(function (key) {
+      Object.keys(shard[key]).forEach(function (term) { index[key][term] = shard[key][term]; });
+    });
+    SearchShards.loaded[prefix] = true;
+    (SearchShards.waiting[prefix] || []).forEach(function (callback) { callback(); });
+    delete SearchShards.waiting[prefix];
+  },
+
+  load: function (prefixes, callback) {
+    var missing = prefixes.filter(function (p) {
+      return SearchShards.files.hasOwnProperty(p) && !SearchShards.loaded[p];
+    });
+    var remaining = missing.length;
+    if (remaining === 0) {
+      callback();
+      return;
+    }
+    missing.forEach(function (p) {
+      var first = !SearchShards.waiting.hasOwnProperty(p);
+      SearchShards.waiting[p] = (SearchShards.waiting[p] || []).concat([function () {
+        remaining -= 1;
+        if (remaining === 0) callback();
+      }]);
+      if (first) {
+        var script = document.createElement('script');
+        script.src = Search._index.shard_root + SearchShards.files[p];
+        script.onerror = function () { SearchShards.add(p, {terms: {}, titleterms: {}, codes: {}}); };
+        document.body.appendChild(script);
+      }
+    });
+  },
+
+  install: function () {
+    var query = Search.query;
+    var performSearch = Search._performSearch;
+
+    Search.query = function (q) {
+      SearchShards.files = Search._index.shards;
+      Search._index.codes = Search._index.codes || {};
+      var prefixes = {};
+      var parsed = Search._parseQuery(q);
+      [parsed[1], parsed[2], parsed[4]].forEach(function (words) {
+        words.forEach(function (w) { prefixes[w.substr(0, Search._index.shard_prefix_length)] = true; });
+      });
+      SearchShards.load(Object.keys(prefixes), function () { query(q); });
+    };
+
+    // Exact matches of IBSI codes come first (results are shown from the end of the list)
+    Search._performSearch = function (q, searchTerms, excludedTerms, highlightTerms, objectTerms) {
+      var results = performSearch(q, searchTerms, excludedTerms, highlightTerms, objectTerms);
+      objectTerms.forEach(function (term) {
+        var code = Search._index.codes[term];
+        if (code === undefined) return;
+        var kind = typeof SearchResultKind === 'undefined' ? 'title' : SearchResultKind.title;
+        results.push([Search._index.docnames[code[0]], code[2] + ' (' + term.toUpperCase() + ')', '#' + code[1],
+                      null, 1000, Search._index.filenames[code[0]], kind]);
+      });
+      return results;
+    };
+  }
+};
+
+if (typeof Search !== 'undefined') {
+  SearchShards.install();
+} else {
+  document.addEventListener('DOMContentLoaded', SearchShards.install);
+}
+"""
+
+
+def is_number(text):
+  return NUMBER_PATTERN.match(text.strip().replace(' ', '')) is not None
+
+
+def exclude_noise(app, doctree):
+  """
+  Mark math and tables of numbers with the ``no-search`` class, so they are not indexed.
+  """
+  for node in doctree.findall(lambda n: isinstance(n, (nodes.math, nodes.math_block))):
+    node['classes'].append('no-search')
+
+  ratio = app.config.search_numeric_table_ratio
+  if ratio is None:
+    return
+  for table in doctree.findall(nodes.table):
+    cells = [e.astext() for body in table.findall(nodes.tbody) for e in body.findall(nodes.entry)]
+    cells = [c for c in cells if c.strip() != '']
+    if len(cells) > 0 and len([c for c in cells if is_number(c)]) >= ratio * len(cells):
+      table['classes'].append('no-search')
+
+
+def keep_full_index(app):
+  """
+  Have the builder write the full search index to the doctrees directory, from where it is read back by incremental
+  builds. The published ``searchindex.js`` is written by :py:func:`write_shards`.
+  """
+  if app.builder.format == 'html' and getattr(app.builder, 'searchindex_filename', None) == 'searchindex.js':
+    app.builder.searchindex_filename = os.path.join(str(app.doctreedir), 'searchindex_full.js')
+
+
+def get_shard_file(prefix, shard_data):
+  name = ''.join(c if c.isalnum() and ord(c) < 128 else '_%x' % ord(c) for c in prefix)
+  return '%s.%s.js' % (name, hashlib.sha1(shard_data.encode('utf-8')).hexdigest()[:8])
+
+
+def write_shards(app, exception):
+  if exception is not None or app.builder.format != 'html' or getattr(app.builder, 'indexer', None) is None:
+    return
+  from sphinx.search import js_index
+
+  index = app.builder.indexer.freeze()
+  prefix_length = app.config.search_shard_prefix_length
+  docnames = index['docnames']
+
+  shards = {}
+  for key in ('terms', 'titleterms'):
+    for term, files in index.pop(key).items():
+      shards.setdefault(term[:prefix_length], {'terms': {}, 'titleterms': {}, 'codes': {}})[key][term] = files
+  for code, entry in getattr(app, 'ibsi_codes', {}).items():
+    if entry['document'] in docnames:
+      code = code.lower()
+      shards.setdefault(code[:prefix_length], {'terms': {}, 'titleterms': {}, 'codes': {}})['codes'][code] = \
+        [docnames.index(entry['document']), entry['anchor'], entry['name']]
+
+  shard_dir = os.path.join(str(app.builder.outdir), SHARD_DIR)
+  if not os.path.isdir(shard_dir):
+    os.makedirs(shard_dir)
+  old_files = set(f for f in os.listdir(shard_dir) if f != 'shards.js')
+
+  files = {}
+  shard_bytes = 0
+  for prefix, shard in shards.items():
+    shard_data = 'SearchShards.add(%s,%s)' % (json.dumps(prefix), json.dumps(shard, sort_keys=True,
+                                                                            separators=(',', ':')))
+    files[prefix] = get_shard_file(prefix, shard_data)
+    shard_bytes += len(shard_data)
+    old_files.discard(files[prefix])
+    fname = os.path.join(shard_dir, files[prefix])
+    if not os.path.isfile(fname):
+      with open(fname, mode='wb') as shard_fs:
+        shard_fs.write(shard_data.encode('utf-8'))
+  for f in old_files:
+    os.remove(os.path.join(shard_dir, f))
+
+  index['terms'] = {}
+  index['titleterms'] = {}
+  index['shards'] = files
+  index['shard_root'] = SHARD_DIR.replace(os.sep, '/') + '/'
+  index['shard_prefix_length'] = prefix_length
+  with open(os.path.join(str(app.builder.outdir), 'searchindex.js'), mode='wb') as index_fs:
+    index_fs.write(js_index.dumps(index).encode('utf-8'))
+  with open(os.path.join(shard_dir, 'shards.js'), mode='wb') as script_fs:
+    script_fs.write(SHARD_SCRIPT.encode('utf-8'))
+  logger.info('search index: %i bytes, %i shards of %i bytes in total',
+              os.path.getsize(os.path.join(str(app.builder.outdir), 'searchindex.js')), len(files), shard_bytes)
+
+
+def add_shard_script(app, pagename, templatename, context, doctree):
+  if pagename == 'search' and app.builder.format == 'html':
+    app.builder.add_js_file(SHARD_DIR.replace(os.sep, '/') + '/shards.js', defer='defer')
+
+
+def setup(app):
+  app.add_config_value('search_shard_prefix_length', 1, 'html')
+  app.add_config_value('search_numeric_table_ratio', 0.8, 'env')
+  app.connect('doctree-read', exclude_noise)
+  app.connect('builder-inited', keep_full_index)
+  app.connect('html-page-context', add_shard_script)
+  app.connect('build-finished', write_shards)
+  return {
+    'version': '0.1',
+    'parallel_read_safe': True,
+    'parallel_write_safe': True
+  }
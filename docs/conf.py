@@ -14,16 +14,14 @@
 
 from __future__ import print_function
 
+import json
 import sys
 import os
 
 import sphinx_rtd_theme
 
-# If extensions (or modules to document with autodoc) are in another directory,
-# add these directories to sys.path here. If the directory is relative to the
-# documentation root, use os.path.abspath to make it absolute, like shown here.
-sys.path.insert(0, os.path.abspath('..'))
-print(os.path.abspath('..'))
+# Local extensions
+sys.path.insert(0, os.path.abspath('_ext'))
 
 # -- General configuration ------------------------------------------------
 
@@ -33,15 +31,53 @@ print(os.path.abspath('..'))
 # Add any Sphinx extension module names here, as strings. They can be
 # extensions coming with Sphinx (named 'sphinx.ext.*') or your custom
 # ones.
+# The manual is plain RST (no Python code to document), so autodoc, coverage
+# and viewcode are not loaded. All extensions are safe for parallel builds
+# (make html-parallel).
 extensions = [
-    'sphinx.ext.autodoc',
-    'sphinx.ext.coverage',
     'sphinx.ext.mathjax',
-    'sphinx.ext.viewcode',
-    'sphinx.ext.githubpages',
-    'sphinxcontrib.bibtex'
+    'sphinxcontrib.bibtex',
+    'bibtex_cache',
+    'figure_variants',
+    'ibsi_codes',
+    'math_prerender',
+    'phantom_matrices',
+    'search_shards'
 ]
 
+# Bibliography. The converter (scripts/parse_tex.py) writes only the cited
+# entries to CitedBibliography.bib, the full bibliography is used otherwise.
+# The parsed bibliography is cached (see _ext/bibtex_cache.py).
+if os.path.isfile(os.path.join(os.path.dirname(os.path.abspath(__file__)), 'CitedBibliography.bib')):
+    bibtex_bibfiles = ['CitedBibliography.bib']
+else:
+    bibtex_bibfiles = ['Bibliography.bib']
+
+# Math is rendered by MathJax in the browser. To render it to HTML at build
+# time with KaTeX instead (see _ext/math_prerender.py), which needs node.js and
+# KaTeX (npm install katex), build with
+#   make html SPHINXOPTS="-D math_prerender_renderer=katex"
+# Formulas that cannot be rendered, or all of them if KaTeX is not available,
+# are then left to MathJax. Use 'stub' to test the build offline.
+math_prerender_renderer = None
+
+# Math macros of the Tex source that MathJax and KaTeX do not know are
+# expanded by the converter, unless it is run with --math-macros define: it
+# then leaves them in the text and writes their definitions to
+# math_macros.json, which are passed to MathJax and KaTeX here. The file is
+# committed with the RST documents, which cannot be rendered without it.
+math_macros_file = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'math_macros.json')
+if os.path.isfile(math_macros_file):
+    with open(math_macros_file) as macros_fs:
+        math_macros = json.load(macros_fs)
+    mathjax3_config = {'tex': {'macros': math_macros['mathjax']}}
+    math_prerender_macros = math_macros['katex']
+
+# The texture matrices of the digital phantom are rendered from the data files
+# in phantom_matrices (see _ext/phantom_matrices.py). Data files with more rows
+# than this are loaded by the browser once they scroll into view.
+phantom_matrices_lazy_rows = 50
+
 # Add any paths that contain templates here, relative to this directory.
 templates_path = ['_templates']
 
@@ -88,6 +124,14 @@ language = None
 # This patterns also effect to html_static_path and html_extra_path
 exclude_patterns = ['_build', 'Thumbs.db', '.DS_Store']
 
+# The first chapter is included in index.rst (see scripts/parse_tex.py). It is
+# not built on its own as well, or its labels (e.g. of IBSI codes) would be
+# defined twice.
+with open(os.path.join(os.path.dirname(os.path.abspath(__file__)), 'index.rst')) as index_fs:
+    for line in index_fs:
+        if line.startswith('.. include:: '):
+            exclude_patterns.append(line[len('.. include:: '):].strip())
+
 # The reST default role (used for this markup: `text`) to use for all
 # documents.
 #default_role = None
@@ -0,0 +1,593 @@
+# -*- coding: utf-8 -*-
+"""
+Benchmark of the Tex to RST conversion in ``parse_tex.py``.
+
+A synthetic IBSI-style source document is generated at a configurable scale (feature families, features with ``\\id``
+codes, math blocks using the ``\\floor*``, ``\\abs`` and ``\\iverson`` macros, tables, figures and citations) and every
+stage of the conversion is timed separately.
+
+Pandoc is not run by default: its output for the generated document is read from a recorded fixture in ``bench/``
+(created by ``--record-fixture``). Pass ``--pandoc`` to run and time the actual conversion as well, and
+``--check-chapters`` to check that converting the document chapter by chapter in several processes (as with a cache,
+``--jobs`` or ``--stream``) gives the same output as a single pandoc run. The check fails on any difference, e.g. in
+the numbers of sections and figures or in references between chapters.
+
+Stage timings are compared with a JSON baseline (``bench/baseline.json``, created by ``--save-baseline``) and the
+benchmark exits with status 1 if any stage got slower than the baseline by more than the tolerance. Timings are stored
+relative to a fixed pure-Python calibration workload that is run alongside them, so a baseline recorded on one machine
+can be checked on another.
+"""
+import argparse
+import difflib
+import gzip
+import hashlib
+import json
+import os
+import platform
+import random
+import re
+import shutil
+import sys
+import tempfile
+import timeit
+
+import six
+from six.moves import range
+
+import benchmark_tables
+import parse_tex
+
+
+BENCH_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'bench')
+BASELINE_VERSION = 1
+
+# Stages bound by file writes, the calibration workload does not account for the speed of the disk
+IO_STAGES = ('fix_benchmark_tables', 'read_benchmark_tables', 'write_sections')
+
+CORPUS_DEFAULTS = {
+  'families': 8,
+  'features': 10,
+  'math': 3,
+  'tables': 2,
+  'figures': 2,
+  'citations': 2,
+  'seed': 0
+}
+
+WORDS = ('intensity', 'texture', 'matrix', 'voxel', 'region', 'grey', 'level', 'image', 'mask', 'distance', 'zone',
+         'run', 'size', 'emphasis', 'feature', 'value', 'neighbourhood', 'interpolation', 'discretisation', 'volume',
+         'surface', 'mesh', 'histogram', 'mean', 'variance', 'the', 'of', 'a', 'is', 'and', 'in', 'for', 'with')
+
+PREAMBLE = r"""\documentclass{book}
+\usepackage{mathtools}
+\DeclarePairedDelimiter\floor{\lfloor}{\rfloor}
+\DeclarePairedDelimiter\ceil{\lceil}{\rceil}
+\DeclarePairedDelimiter\abs{\lvert}{\rvert}
+\DeclarePairedDelimiter\norm{\lVert}{\rVert}
+\newcommand{\iverson}[1]{\left[#1\right]}
+\newcommand{\id}[1]{}
+\newcommand{\textid}[1]{\textit{#1}}
+\begin{document}
+"""
+
+
+class CorpusGenerator(object):
+  """
+  Generator of a synthetic source document, laid out like the IBSI reference manual: ``IBSIWorkDocument.tex`` with an
+  introduction and an image processing chapter, the feature chapter in ``Chapters/FeatureDef.tex`` and one benchmark
+  table per feature in ``benchmarks/``.
+
+  The output only depends on the passed settings (see :py:data:`CORPUS_DEFAULTS`).
+  """
+
+  def __init__(self, families, features, math, tables, figures, citations, seed=0):
+    self.families = families
+    self.features = features
+    self.math = math
+    self.tables = tables
+    self.figures = figures
+    self.citations = citations
+    self.rnd = random.Random(seed)
+    self.codes = set()
+
+  def code(self):
+    while True:
+      c = ''.join(self.rnd.choice('ABCDEFGHIJKLMNOPQRSTUVWXYZ0123456789') for _ in range(4))
+      if c not in self.codes:
+        self.codes.add(c)
+        return c
+
+  def words(self, n):
+    return ' '.join(self.rnd.choice(WORDS) for _ in range(n))
+
+  def title(self, n):
+    return self.words(n).capitalize()
+
+  def citation(self):
+    return r'\cite{%s%i%s}' % (self.rnd.choice(['Smith', 'Doe-Ray', 'Zwanenburg', 'Aerts']),
+                               self.rnd.randint(1990, 2020), self.rnd.choice(['', 'a', 'b']))
+
+  def paragraph(self, citations=0, inline_ids=()):
+    parts = [self.words(self.rnd.randint(20, 40)) + '.']
+    for _ in range(citations):
+      parts.append('%s %s.' % (self.words(8).capitalize(), self.citation()))
+    for c in inline_ids:
+      parts.append(r'See \textid{%s}.' % c)
+    if self.rnd.random() < 0.2:
+      parts.append(r'%s\footnote{%s.}' % (self.words(6).capitalize(), self.words(10).capitalize()))
+    return ' '.join(parts) + '\n'
+
+  def math_block(self):
+    return (r'\begin{equation}' + '\n'
+            r'F_{%s} = \frac{1}{N_v} \sum_{k=1}^{N_v} \floor*{\frac{X_k - X_{min}}{w_b}} \abs{X_k - \mu} '
+            r'\iverson{X_k > %i}' + '\n'
+            r'\end{equation}' + '\n') % (self.code().lower(), self.rnd.randint(0, 100))
+
+  def table(self, label):
+    rows = [' & '.join(['%.3g' % self.rnd.uniform(0, 1000) for _ in range(4)]) + r' \\' for _ in range(6)]
+    return '\n'.join([r'\begin{table}[h]', r'\centering', r'\caption{%s.}' % self.title(6), r'\label{%s}' % label,
+                      r'\begin{tabular}{cccc}', r'\toprule',
+                      r'\textbf{a} & \textbf{b} & \textbf{c} & \textbf{d} \\', r'\midrule'] + rows +
+                     [r'\bottomrule', r'\end{tabular}', r'\end{table}']) + '\n'
+
+  def figure(self, name, label):
+    return '\n'.join([r'\begin{figure}[h]', r'\centering',
+                      r'\includegraphics[scale=0.5]{./Figures/%s.pdf}' % name,
+                      r'\caption{%s.}' % self.title(8), r'\label{%s}' % label, r'\end{figure}']) + '\n'
+
+  def benchmark_table(self, feature_name):
+    rows = []
+    for data in ('dig. phantom', 'config. A', 'config. B', 'config. C'):
+      rows.append(r'    %s & %s & %.3g & %.1g & %s \\' % (
+        data, r'\textemdash' if data == 'dig. phantom' else '2D', self.rnd.uniform(0, 1e5), self.rnd.uniform(0, 100),
+        self.rnd.choice(['very strong', 'strong', 'moderate'])))
+    return '\n'.join([r'\small{', r'\begin{longtable}{ccccc}', r'    \toprule',
+                      r'    {\textbf{data}} & {\textbf{config.}} & {\textbf{value}} & {\textbf{tol.}} & '
+                      r'{\textbf{consensus}} \\', r'    \midrule'] + rows +
+                     [r'    \bottomrule', r'\caption{Benchmark table for the %s feature.}' % feature_name.lower(),
+                      r'\end{longtable}', r'}']) + '\n'
+
+  def generate(self):
+    """
+    :return: dictionary of file path (relative to the source folder) to file contents
+    """
+    files = {}
+    main_codes = [self.code() for _ in range(2)]
+
+    feature_def = [self.paragraph(self.citations)]
+    for fam_idx in range(self.families):
+      fam_name = self.title(3)
+      feature_def.append('\\section[%s]{%s\\id{%s}}\\label{sec_family_%i}\n' % (fam_name, fam_name, self.code(),
+                                                                                  fam_idx))
+      feature_def.append(self.paragraph(self.citations))
+      for t_idx in range(self.tables):
+        feature_def.append(self.table('tab_family_%i_%i' % (fam_idx, t_idx)))
+      for f_idx in range(self.figures):
+        feature_def.append(self.figure('Family%iFigure%i' % (fam_idx, f_idx), 'fig_family_%i_%i' % (fam_idx, f_idx)))
+        feature_def.append('As shown in Fig. \\ref{fig_family_%i_%i}, %s.\n' % (fam_idx, f_idx, self.words(10)))
+
+      for feat_idx in range(self.features):
+        feat_name = '%s %i' % (self.title(2), feat_idx)
+        feat_code = self.code()
+        bench_name = 'family_%i_feature_%i' % (fam_idx, feat_idx)
+        feature_def.append('\n\\subsection[%s]{%s\\id{%s}}\\label{feat_%s}\n' % (feat_name, feat_name, feat_code,
+                                                                                bench_name))
+        feature_def.append(self.paragraph(self.citations, inline_ids=[feat_code]))
+        for _ in range(self.math):
+          feature_def.append(self.math_block())
+          feature_def.append('where $\\floor*{x/w_b}$ and $\\abs{x}$ %s.\n' % self.words(12))
+        feature_def.append('\\input{benchmarks/%s}\n' % bench_name)
+        files[os.path.join('benchmarks', bench_name + '.tex')] = self.benchmark_table(feat_name)
+
+    files[os.path.join('Chapters', 'FeatureDef.tex')] = '\n'.join(feature_def)
+
+    files['IBSIWorkDocument.tex'] = '\n'.join([
+      PREAMBLE,
+      '\\chapter*{The image biomarker standardisation initiative}',
+      self.paragraph(self.citations, inline_ids=main_codes[:1]),
+      '\\section*{Permanent identifiers\\id{%s}}' % main_codes[1],
+      self.paragraph(),
+      '\\chapter{Introduction}\\label{chap_introduction}',
+      self.paragraph(self.citations),
+      'See (\\textbf{Chapter \\ref{chap_image_processing}}).\n',
+      'The conversion is described in Section \\ref{sec_data_conv}, the features in Section \\ref{sec_family_0} and '
+      'Fig. \\ref{fig_family_0_0}.\n',
+      '\\chapter{Image processing}\\label{chap_image_processing}',
+      '\\section[Data conversion]{Data conversion\\id{%s}}\\label{sec_data_conv}' % self.code(),
+      self.paragraph(self.citations),
+      self.math_block(),
+      self.figure('ImageInterpolation', 'figInterpolation'),
+      '\\begin{enumerate}',
+      '\\item %s.' % self.words(30).capitalize(),
+      '\\item %s.' % self.words(5).capitalize(),
+      '\\end{enumerate}\n',
+      '\\chapter{Image features}\\label{chap_image_features}',
+      '\\input{Chapters/FeatureDef}\n',
+      '\\end{document}\n'])
+    return files
+
+
+def write_corpus(files, dest_dir):
+  for fname, data in six.iteritems(files):
+    parse_tex.write_overlay_file(os.path.join(dest_dir, fname), data)
+
+
+def get_corpus_key(files):
+  h = hashlib.sha1()
+  for fname in sorted(files):
+    h.update(fname.replace(os.sep, '/').encode('utf-8'))
+    h.update(b'\0')
+    h.update(files[fname].encode('utf-8'))
+    h.update(b'\0')
+  return h.hexdigest()
+
+
+def get_fixture_path(corpus_key):
+  return os.path.join(BENCH_DIR, 'pandoc_%s.rst.gz' % corpus_key[:12])
+
+
+def read_fixture(corpus_key):
+  fname = get_fixture_path(corpus_key)
+  if not os.path.isfile(fname):
+    return None
+  with gzip.open(fname, mode='rb') as fixture_fs:
+    return fixture_fs.read().decode('utf-8')
+
+
+def write_fixture(corpus_key, output):
+  if not os.path.isdir(BENCH_DIR):
+    os.makedirs(BENCH_DIR)
+  # Fix the timestamp in the gzip header, so recording the same output twice gives the same file
+  with open(get_fixture_path(corpus_key), mode='wb') as raw_fs:
+    with gzip.GzipFile(fileobj=raw_fs, mode='wb', filename='', mtime=0) as fixture_fs:
+      fixture_fs.write(output.encode('utf-8'))
+
+
+class _NullWriter(object):
+
+  def write(self, s):
+    pass
+
+  def flush(self):
+    pass
+
+
+class Calibration(object):
+  """
+  A fixed pure-Python workload (regular expressions, string and list operations, as used by the converter) of a few
+  milliseconds, to express stage timings relative to the speed of the machine.
+  """
+
+  def __init__(self):
+    self.text = '\n'.join('%i :raw-latex:`\\cite{Smith%i}` \\floor*{x_%i} | a & b | %s' %
+                          (i, 2000 + i % 20, i, 'word ' * 8) for i in range(500))
+    self.pattern = re.compile(r'\\cite\{(?P<Key>\w+)\}')
+
+  def run(self):
+    lines = self.text.split('\n')
+    lines = [self.pattern.sub(lambda m: m.group('Key').lower(), line) for line in lines]
+    lines = [line.replace('\\floor*', '\\lfloor') for line in lines if '&' in line]
+    return len('\n'.join(sorted(lines)))
+
+  def time(self):
+    start = timeit.default_timer()
+    self.run()
+    return timeit.default_timer() - start
+
+
+class StageTimer(object):
+  """
+  Times stages of the conversion, running each stage ``repeat`` times.
+
+  Every run of a stage directly follows a run of the :py:class:`Calibration` workload. The time of a stage relative to
+  the speed of the machine is the median ratio of these pairs, so it is measured under the same load as the
+  calibration. Output printed by a stage is suppressed while it is timed.
+  """
+
+  def __init__(self, repeat=5):
+    self.repeat = repeat
+    self.calibration = Calibration()
+    self.timings = []  # list of (stage name, fastest run (seconds), median relative time), in order of execution
+
+  def time(self, name, func, *args, **kwargs):
+    """
+    Run ``func(*args)`` ``repeat`` times and record its timing.
+
+    :param setup: function returning a fresh tuple of arguments for every run, for stages that update their input in
+      place (its runtime is not included in the timing). If passed, ``args`` is ignored.
+    :return: the result of the last run
+    """
+    setup = kwargs.get('setup')
+    runs = []
+    result = None
+    for _ in range(self.repeat):
+      run_args = args if setup is None else setup()
+      calibration = self.calibration.time()
+      stdout = sys.stdout
+      sys.stdout = _NullWriter()
+      try:
+        start = timeit.default_timer()
+        result = func(*run_args)
+        elapsed = timeit.default_timer() - start
+      finally:
+        sys.stdout = stdout
+      runs.append((elapsed, calibration))
+    ratios = sorted(elapsed / calibration for elapsed, calibration in runs)
+    self.timings.append((name, min(r[0] for r in runs), ratios[len(ratios) // 2]))
+    return result
+
+
+def run_pandoc(overlay, source_folder, jobs=1):
+  """
+  Convert the document in ``overlay`` as :py:func:`parse_tex.convert` does, with the unchanged files in
+  ``source_folder``.
+  """
+  texinputs = [overlay, source_folder]
+  tex_source = os.path.join(overlay, 'IBSIWorkDocument.tex')
+  if jobs == 1:
+    output = parse_tex.parse_input(tex_source, texinputs=texinputs)
+  else:
+    output = parse_tex.convert_chapters(tex_source, parse_tex.read_tex_source(tex_source), jobs=jobs,
+                                        texinputs=texinputs)
+  return output.replace('\r', '')
+
+
+def diff_chapter_conversion(overlay, source_folder, jobs=2):
+  """
+  Convert the document in ``overlay`` in a single pandoc run and chapter by chapter in ``jobs`` processes, which must
+  give the same output (see :py:class:`parse_tex.ChapterPlan`).
+
+  :return: lines of the unified diff of the two outputs (empty if they are the same)
+  """
+  single_run = run_pandoc(overlay, source_folder).split('\n')
+  by_chapter = run_pandoc(overlay, source_folder, jobs=jobs).split('\n')
+  return list(difflib.unified_diff(single_run, by_chapter, 'single run', 'by chapter (%i jobs)' % jobs, lineterm=''))
+
+
+def run_stages(timer, source_folder, work_dir, use_pandoc=False, corpus_key=None):
+  """
+  Run the conversion stage by stage on the corpus in ``source_folder``, timing each stage.
+
+  :param work_dir: empty directory to hold the overlay and the output files
+  :return: the output of pandoc (or the fixture)
+  """
+  overlay = os.path.join(work_dir, 'overlay')
+  out_dir = os.path.join(work_dir, 'out')
+  os.makedirs(out_dir)
+
+  tex_data = timer.time('read_tex_source', parse_tex.read_tex_source,
+                        os.path.join(source_folder, 'IBSIWorkDocument.tex'))
+  feature_data = parse_tex.read_tex_source(os.path.join(source_folder, 'Chapters', 'FeatureDef.tex'))
+
+  feature_class_codes, feature_codes = timer.time('parse_feature_ids', parse_tex.parse_feature_ids, feature_data)
+  other_codes = timer.time('parse_other_ids', parse_tex.parse_other_ids, tex_data)
+  tex_data, _ = timer.time('update_inline_ids', parse_tex.update_inline_ids, tex_data)
+  feature_data, _ = parse_tex.update_inline_ids(feature_data)
+  parse_tex.write_overlay_file(os.path.join(overlay, 'IBSIWorkDocument.tex'), tex_data)
+  parse_tex.write_overlay_file(os.path.join(overlay, 'Chapters', 'FeatureDef.tex'), feature_data)
+  timer.time('fix_benchmark_tables', parse_tex.fix_benchmark_tables, os.path.join(source_folder, 'benchmarks'),
+             os.path.join(overlay, 'benchmarks'))
+  timer.time('read_benchmark_tables', lambda: benchmark_tables.get_records(benchmark_tables.read_benchmark_tables(
+    os.path.join(source_folder, 'benchmarks'), benchmark_tables.get_benchmark_features([tex_data, feature_data]))[0]))
+  figures = timer.time('parse_tex_figures', parse_tex.parse_tex_figures, tex_data)
+  chap_labels = timer.time('get_chapter_labels', parse_tex.get_chapter_labels, tex_data)
+
+  if use_pandoc:
+    # A single run, pandoc is too slow to repeat and its runtime varies less than that of the short stages
+    repeat, timer.repeat = timer.repeat, 1
+    output = timer.time('pandoc', run_pandoc, overlay, source_folder)
+    timer.repeat = repeat
+  else:
+    output = read_fixture(corpus_key)
+    if output is None:
+      raise ValueError('No pandoc fixture for this corpus (%s), record one with --record-fixture' %
+                       get_fixture_path(corpus_key))
+
+  pandoc_output = output
+
+  # Document level passes, separately and as run by main() on a shared edit buffer
+  _, footnotes = timer.time('get_footnotes', parse_tex.get_footnotes, output)
+  timer.time('parse_chapter_refs', parse_tex.parse_chapter_refs, output, chap_labels)
+  timer.time('correct_tables', parse_tex.correct_tables, output)
+
+  def document_edits(text):
+    buffer = parse_tex.EditBuffer(text)
+    parse_tex.edit_footnotes(buffer)
+    parse_tex.edit_chapter_refs(buffer, chap_labels)
+    parse_tex.edit_tables(buffer)
+    return buffer.apply(), buffer.get_footnote_lines()
+
+  output, footnote_lines = timer.time('document_edits', document_edits, output)
+  output_lines = output.split('\n')
+
+  sections = timer.time('split_sections', lambda: [
+    (s, e, c) for s, e, c in parse_tex.split_section_ranges(output_lines, feature_class_codes, feature_codes,
+                                                            other_codes, ['=', '-'])])
+  # As in the manual, pandoc drops the \id codes from the titles, so split_sections finds the features and attaches
+  # their codes. Otherwise its timing would not cover that work.
+  n_codes = sum(len(c) for s, e, c in sections)
+  if n_codes == 0:
+    raise ValueError('No IBSI code is attached to the sections of the corpus')
+  section_lines = [output_lines[s:e] for s, e, c in sections]
+
+  # Separate per-section passes, each on fresh copies of the sections as they update them in place
+  def copy_sections():
+    return [list(s) for s in section_lines],
+
+  for name, fix in [('process_citations', parse_tex.process_citations),
+                    ('fix_math_indent', parse_tex.fix_math_indent),
+                    ('fix_math_formula', parse_tex.fix_math_formula),
+                    ('fix_numbered_lists', parse_tex.fix_numbered_lists)]:
+    timer.time(name, lambda secs, f=fix: [f(s) for s in secs], setup=copy_sections)
+  timer.time('fix_figures', lambda secs: [parse_tex.fix_figures(s, figures) for s in secs], setup=copy_sections)
+
+  transformed = timer.time('section_transformer', lambda: [parse_tex.SectionTransformer(figures).transform(s)
+                                                           for s in section_lines])
+
+  def write_sections():
+    for sec_idx, ((start, end, _), section) in enumerate(zip(sections, transformed)):
+      footer = u''
+      for line_idx, no in footnote_lines:
+        if start <= line_idx < end and no in footnotes:
+          footer += parse_tex.format_footnote(no, footnotes[no])
+      with open(os.path.join(out_dir, '%02i.rst' % sec_idx), mode='wb') as out_fs:
+        out_fs.write(u'\n'.join(section).encode('utf-8'))
+        out_fs.write(footer.encode('utf-8'))
+
+  timer.time('write_sections', write_sections)
+  return pandoc_output
+
+
+def compare_baseline(result, baseline, tolerance, io_tolerance, min_delta):
+  """
+  A stage regressed if its relative time exceeds that of the baseline by more than ``tolerance`` (``io_tolerance`` for
+  :py:data:`IO_STAGES`) and by more than ``min_delta`` seconds on this machine. Stages missing from the baseline are
+  reported too, the baseline must then be recorded again.
+
+  :return: list of messages describing the stages that regressed or are not in the baseline (empty if none)
+  """
+  regressions = []
+  base_stages = baseline['stages']
+  for name, stage in sorted(six.iteritems(result['stages']), key=lambda s: s[1]['order']):
+    if name not in base_stages:
+      regressions.append('%s: not in the baseline, record it again with --save-baseline' % name)
+      continue
+    base = base_stages[name]
+    calibration = stage['seconds'] / stage['relative']
+    allowed = base['relative'] * (1 + (io_tolerance if name in IO_STAGES else tolerance))
+    delta = (stage['relative'] - base['relative']) * calibration
+    if stage['relative'] > allowed and delta > min_delta:
+      regressions.append('%s: %.2f ms, baseline %.2f ms (scaled to this machine), +%.0f%%' % (
+        name, stage['seconds'] * 1e3, base['relative'] * calibration * 1e3,
+        (stage['relative'] / base['relative'] - 1) * 100))
+  return regressions
+
+
+def print_table(result, baseline=None):
+  print('%-24s %12s %12s' % ('stage', 'time (ms)', 'baseline'))
+  for name, stage in sorted(six.iteritems(result['stages']), key=lambda s: s[1]['order']):
+    base = u''
+    if baseline is not None and name in baseline['stages']:
+      base = '%.2f' % (baseline['stages'][name]['relative'] * stage['seconds'] / stage['relative'] * 1e3)
+    print('%-24s %12.2f %12s' % (name, stage['seconds'] * 1e3, base))
+
+
+def main(corpus, repeat=7, use_pandoc=False, record_fixture=False, baseline_file=None, save_baseline=False,
+         tolerance=0.5, io_tolerance=1., min_delta=0.002, keep=None, check_chapters=None):
+  """
+  Generate the corpus, time the stages and compare them with the baseline.
+
+  :param check_chapters: number of processes to convert the document chapter by chapter with, to compare the output
+    with that of a single pandoc run (default: no check)
+  :return: exit status (0 if no stage regressed and the conversions by chapter and in a single run are the same)
+  """
+  files = CorpusGenerator(**corpus).generate()
+  corpus_key = get_corpus_key(files)
+  print('Corpus %s: %i files, %i kB' % (corpus_key[:12], len(files),
+                                        sum(len(f) for f in six.itervalues(files)) // 1024))
+
+  work_dir = tempfile.mkdtemp() if keep is None else keep
+  try:
+    source_folder = os.path.join(work_dir, 'ibsi-reference-manual')
+    write_corpus(files, source_folder)
+
+    if record_fixture:
+      output = run_stages(StageTimer(repeat=1), source_folder, os.path.join(work_dir, 'record'), use_pandoc=True)
+      write_fixture(corpus_key, output)
+      print('Stored pandoc fixture %s' % get_fixture_path(corpus_key))
+
+    timer = StageTimer(repeat=repeat)
+    run_stages(timer, source_folder, os.path.join(work_dir, 'run'), use_pandoc=use_pandoc, corpus_key=corpus_key)
+
+    chapter_diff = []
+    if check_chapters is not None:
+      chapter_diff = diff_chapter_conversion(os.path.join(work_dir, 'run', 'overlay'), source_folder,
+                                             jobs=check_chapters)
+  finally:
+    if keep is None:
+      shutil.rmtree(work_dir)
+
+  result = {
+    'version': BASELINE_VERSION,
+    'corpus': corpus,
+    'corpus_key': corpus_key,
+    'python': platform.python_version(),
+    'stages': dict((name, {'order': idx, 'seconds': seconds, 'relative': relative})
+                   for idx, (name, seconds, relative) in enumerate(timer.timings))
+  }
+
+  if baseline_file is None:
+    baseline_file = os.path.join(BENCH_DIR, 'baseline.json')
+
+  if check_chapters is not None:
+    for line in chapter_diff[:100]:
+      print(line)
+    if len(chapter_diff) > 100:
+      print('... (%i more lines)' % (len(chapter_diff) - 100))
+    print('Conversion by chapter (%i jobs) %s the single run' % (
+      check_chapters, 'DIFFERS FROM' if len(chapter_diff) > 0 else 'matches'))
+    if len(chapter_diff) > 0:
+      return 1
+
+  if save_baseline:
+    with open(baseline_file, mode='w') as baseline_fs:
+      json.dump(result, baseline_fs, indent=2, sort_keys=True)
+      baseline_fs.write('\n')
+    print_table(result)
+    print('Stored baseline %s' % baseline_file)
+    return 0
+
+  baseline = None
+  if os.path.isfile(baseline_file):
+    with open(baseline_file) as baseline_fs:
+      baseline = json.load(baseline_fs)
+    if baseline.get('version') != BASELINE_VERSION or baseline.get('corpus_key') != corpus_key:
+      print('Baseline %s was recorded for a different corpus, not comparing' % baseline_file)
+      baseline = None
+
+  print_table(result, baseline)
+  if baseline is None:
+    return 0
+
+  regressions = compare_baseline(result, baseline, tolerance, io_tolerance, min_delta)
+  for r in regressions:
+    print('REGRESSION %s' % r)
+  return 1 if len(regressions) > 0 else 0
+
+
+if __name__ == '__main__':
+  parser = argparse.ArgumentParser(description='Benchmark the stages of parse_tex.py on a synthetic document')
+  parser.add_argument('--families', type=int, default=CORPUS_DEFAULTS['families'], help='Number of feature families')
+  parser.add_argument('--features', type=int, default=CORPUS_DEFAULTS['features'], help='Number of features per family')
+  parser.add_argument('--math', type=int, default=CORPUS_DEFAULTS['math'], help='Number of math blocks per feature')
+  parser.add_argument('--tables', type=int, default=CORPUS_DEFAULTS['tables'], help='Number of tables per family')
+  parser.add_argument('--figures', type=int, default=CORPUS_DEFAULTS['figures'], help='Number of figures per family')
+  parser.add_argument('--citations', type=int, default=CORPUS_DEFAULTS['citations'],
+                      help='Number of citations per paragraph')
+  parser.add_argument('--seed', type=int, default=CORPUS_DEFAULTS['seed'], help='Seed of the corpus generator')
+  parser.add_argument('--repeat', type=int, default=7,
+                      help='Number of runs of each stage (the fastest time is shown, regressions are judged on the '
+                           'median time relative to the calibration workload)')
+  parser.add_argument('--pandoc', action='store_true', help='Run and time pandoc instead of reading the fixture')
+  parser.add_argument('--record-fixture', action='store_true', help='Run pandoc and store its output as fixture')
+  parser.add_argument('--baseline', help='Baseline file (default: bench/baseline.json)')
+  parser.add_argument('--save-baseline', action='store_true', help='Store the timings as the new baseline')
+  parser.add_argument('--tolerance', type=float, default=0.5,
+                      help='Fraction by which a stage may be slower than the baseline before failing')
+  parser.add_argument('--io-tolerance', type=float, default=1.,
+                      help='Same as --tolerance, for the stages writing files (%s)' % ', '.join(IO_STAGES))
+  parser.add_argument('--min-delta', type=float, default=2.,
+                      help='Slowdowns smaller than this (ms) are never reported, to ignore noise in short stages')
+  parser.add_argument('--keep', help='Generate the corpus and output in this (empty) directory and keep them')
+  parser.add_argument('--check-chapters', type=int, nargs='?', const=2, metavar='JOBS',
+                      help='Convert the document chapter by chapter in JOBS processes (default: 2) and in a single '
+                           'pandoc run, and fail if the outputs differ')
+  args = parser.parse_args()
+  if args.check_chapters is not None and args.check_chapters < 2:
+    parser.error('--check-chapters needs at least 2 jobs')
+
+  corpus_settings = dict((k, getattr(args, k)) for k in CORPUS_DEFAULTS)
+  sys.exit(main(corpus_settings, repeat=args.repeat, use_pandoc=args.pandoc, record_fixture=args.record_fixture,
+                baseline_file=args.baseline, save_baseline=args.save_baseline, tolerance=args.tolerance,
+                io_tolerance=args.io_tolerance, min_delta=args.min_delta / 1e3, keep=args.keep,
+                check_chapters=args.check_chapters))
@@ -0,0 +1,303 @@
+# -*- coding: utf-8 -*-
+"""
+Structured reference values, read from the benchmark tables of the Tex source (``benchmarks/*.tex``) without pandoc.
+
+Every benchmark table is a ``longtable`` with the columns data, config., value, tol. and consensus, included by
+``\\input{benchmarks/<name>}`` below the header of the feature it belongs to. The ``read_benchmark_tables`` stage of
+``parse_tex.py`` parses the tables into records, and replaces each of them in the source passed to pandoc by a marker
+paragraph. The markers in the RST output are then replaced by tables written from the records. All reference values are
+also written in machine-readable form, as ``reference_values.json`` and ``reference_values.csv``, with one record per
+row of a table:
+
+- ``code``, ``feature``: IBSI code and name of the feature the table is included under
+- ``table``: name of the table file, e.g. ``morph_volume``
+- ``data``, ``config``: data set and configuration, e.g. ``config. A`` and ``2D``
+- ``value``, ``tolerance``: reference value and its tolerance as numbers (None / empty if unset)
+- ``value_text``: reference value as written in the table, e.g. ``3.58e5``, which gives its precision (None / empty if
+  unset)
+- ``consensus``: consensus on the value, e.g. ``very strong``
+
+Tables that do not have this layout are left to pandoc (see ``fix_benchmark_tables``).
+"""
+import hashlib
+import json
+import os
+import re
+
+import six
+
+BENCHMARK_DIR = 'benchmarks'
+REFERENCE_VALUES = 'reference_values'  # Base name of the JSON and CSV files
+
+# Column headers of the benchmark tables, and the record fields they are stored in
+COLUMNS = (('data', 'data'), ('config.', 'config'), ('value', 'value'), ('tol.', 'tolerance'),
+           ('consensus', 'consensus'))
+RECORD_FIELDS = ('code', 'feature', 'table', 'data', 'config', 'value', 'value_text', 'tolerance', 'consensus')
+
+MARKER_PREFIX = 'IBSIBENCHMARK'
+MARKER_PATTERN = re.compile(r'^%s(?P<key>[0-9a-f]{12})$' % MARKER_PREFIX, re.MULTILINE)
+UNSET = u'\u2014'  # Em dash, shown for values that are not set
+
+LONGTABLE_PATTERN = re.compile(r'\\begin\{longtable\}\{[^}]*\}(?P<body>.*?)\\end\{longtable\}', re.DOTALL)
+RULE_PATTERN = re.compile(r'\\(toprule|midrule|bottomrule)\b')
+ROW_END_PATTERN = re.compile(r'\\\\')
+CELL_SEP_PATTERN = re.compile(r'(?<!\\)&')
+EMPTY_COMMAND_PATTERN = re.compile(r'\\(small|footnotesize|scriptsize|centering|endhead|endfirsthead|hline)\b')
+HEADER_PATTERN = re.compile(r'\\(sub)*section((\[.+\])|\*)?\{(?P<Name>.+)\\id\{(?P<Code>\w{4})\}\}')
+INPUT_PATTERN = re.compile(r'\\input\{' + BENCHMARK_DIR + r'/(?P<name>[^}]+?)(\.tex)?\}')
+NUMBER_PATTERN = re.compile(r'^[-+]?(\d+(\.\d*)?|\.\d+)([eE](?P<exp>[-+]?\d+))?$')
+UNSET_PATTERN = re.compile(r'^(\\textemdash|---|\\textendash|--|-)?$')
+FONT_GROUP_PATTERN = re.compile(r'^\\(textbf|textit|textrm|emph)\s*(?=\{)')
+TEX_CHARS = re.compile(r'[\\${}~-]')
+
+
+def get_marker_key(name):
+  return hashlib.sha1(name.encode('utf-8')).hexdigest()[:12]
+
+
+def get_marker(name):
+  """
+  :return: paragraph standing in for the table in the source passed to pandoc
+  """
+  return '\n%s%s\n' % (MARKER_PREFIX, get_marker_key(name))
+
+
+def find_group(tex, start):
+  """
+  :param start: offset of an opening brace
+  :return: offset just past the matching closing brace, or None if it is not closed
+  """
+  depth = 0
+  for pos in range(start, len(tex)):
+    c = tex[pos]
+    if c == '{' and tex[pos - 1:pos] != '\\':
+      depth += 1
+    elif c == '}' and tex[pos - 1:pos] != '\\':
+      depth -= 1
+      if depth == 0:
+        return pos + 1
+  return None
+
+
+def strip_group(text):
+  """
+  Remove braces and font commands enclosing the whole text, e.g. ``{\\textbf{value}}`` becomes ``value``.
+  """
+  text = text.strip()
+  while text[:1] in ('{', '\\'):
+    match = FONT_GROUP_PATTERN.match(text)
+    start = match.end() if match else 0
+    if text[start:start + 1] != '{' or find_group(text, start) != len(text):
+      return text
+    text = text[start + 1:-1].strip()
+  return text
+
+
+def tex_to_rst(text):
+  """
+  Convert the little Tex found in captions and cells to RST.
+  """
+  if TEX_CHARS.search(text) is None:
+    return u' '.join(text.split())
+  parts = re.split(r'(?<!\\)\$(.+?)(?<!\\)\$', text)
+  out = []
+  for idx, part in enumerate(parts):
+    if idx % 2 == 1:
+      out.append(u':math:`%s`' % part.strip())
+      continue
+    for command, markup in (('textbf', '**'), ('textit', '*'), ('emph', '*')):
+      part = re.sub(r'\\%s\{([^{}]*)\}' % command, lambda m: markup + m.group(1) + markup, part)
+    part = part.replace('\\textemdash', UNSET).replace('---', UNSET).replace('\\textendash', u'\u2013')
+    part = part.replace('--', u'\u2013').replace('~', u'\u00a0')
+    part = re.sub(r'\\([%&_#$])', r'\1', part)
+    part = re.sub(r'\\\w+\s*', '', part).replace('{', '').replace('}', '')
+    out.append(part)
+  return re.sub(r'\s+', ' ', u''.join(out)).strip()
+
+
+def parse_number(text):
+  """
+  :return: the number in a cell, None if the cell is unset, or the text of the cell if it is not a number
+  """
+  text = strip_group(text)
+  if UNSET_PATTERN.match(text) is not None:
+    return None
+  if NUMBER_PATTERN.match(text) is not None:
+    return float(text)
+  return tex_to_rst(text)
+
+
+def format_number(text):
+  """
+  :return: RST of a value or tolerance, with numbers in scientific notation written as math, e.g.
+    ``:math:`3.58 \\times 10^{5}```
+  """
+  text = strip_group(text)
+  if UNSET_PATTERN.match(text) is not None:
+    return UNSET
+  match = NUMBER_PATTERN.match(text)
+  if match is not None and match.group('exp') is not None:
+    return u':math:`%s \\times 10^{%i}`' % (text[:match.start('exp') - 1], int(match.group('exp')))
+  return tex_to_rst(text)
+
+
+def parse_benchmark_table(tex):
+  """
+  Parse a benchmark table.
+
+  :param tex: Tex source of the table file
+  :return: dict with the ``caption`` (Tex) and the ``rows`` (lists of the Tex of the cells, in the order of
+    :py:data:`COLUMNS`), or None if the table does not have the layout of a benchmark table
+  """
+  match = LONGTABLE_PATTERN.search(tex)
+  if match is None:
+    return None
+  body = EMPTY_COMMAND_PATTERN.sub('', match.group('body'))
+  parts = RULE_PATTERN.split(body)
+  # Layout: [before, 'toprule', header, 'midrule', rows, 'bottomrule', caption]
+  if len(parts) != 7 or parts[1::2] != ['toprule', 'midrule', 'bottomrule']:
+    return None
+
+  header = ROW_END_PATTERN.split(parts[2])
+  if len(header) != 2 or header[1].strip() != '' or \
+     [strip_group(c).lower() for c in CELL_SEP_PATTERN.split(header[0])] != [c[0] for c in COLUMNS]:
+    return None
+
+  rows = []
+  for row in ROW_END_PATTERN.split(parts[4]):
+    if row.strip() == '':
+      continue
+    cells = [c.strip() for c in CELL_SEP_PATTERN.split(row)]
+    if len(cells) != len(COLUMNS):
+      return None
+    rows.append(cells)
+
+  caption = ''
+  caption_start = parts[6].find('\\caption')
+  if caption_start >= 0:
+    brace = parts[6].find('{', caption_start)
+    caption_end = find_group(parts[6], brace)
+    if caption_end is None:
+      return None
+    caption = parts[6][brace + 1:caption_end - 1].strip()
+  return {'caption': caption, 'rows': rows}
+
+
+def get_benchmark_features(tex_sources):
+  """
+  Find the feature each benchmark table belongs to: that of the last header with an IBSI code preceding its
+  ``\\input``.
+
+  :param tex_sources: Tex sources including the tables (e.g. the main document and ``FeatureDef.tex``)
+  :return: dict of table name: (IBSI code, feature name)
+  """
+  features = {}
+  for tex in tex_sources:
+    headers = [(m.start(), (m.group('Code'), m.group('Name').strip())) for m in HEADER_PATTERN.finditer(tex)]
+    header_idx = -1
+    for match in INPUT_PATTERN.finditer(tex):
+      if '%' in tex[tex.rfind('\n', 0, match.start()) + 1:match.start()]:
+        continue  # Commented out
+      while header_idx + 1 < len(headers) and headers[header_idx + 1][0] < match.start():
+        header_idx += 1
+      if header_idx >= 0:
+        features.setdefault(match.group('name'), headers[header_idx][1])
+  return features
+
+
+def read_benchmark_tables(benchmark_dir, features):
+  """
+  Read and parse all benchmark tables.
+
+  :param features: dict of table name: (IBSI code, feature name) (result of :py:func:`get_benchmark_features`)
+  :return: tuple of the dict of table name: table (see :py:func:`parse_benchmark_table`, with the ``code`` and
+    ``feature`` added) and the list of the file names of the tables that could not be parsed
+  """
+  tables = {}
+  unparsed = []
+  for fname in sorted(os.listdir(benchmark_dir)):
+    with open(os.path.join(benchmark_dir, fname), mode='rb') as b_fs:
+      table = parse_benchmark_table(b_fs.read().decode('utf-8'))
+    name = os.path.splitext(fname)[0]
+    if table is None or not fname.endswith('.tex'):
+      unparsed.append(fname)
+      continue
+    table['code'], table['feature'] = features.get(name, (None, None))
+    tables[name] = table
+  return tables, unparsed
+
+
+def build_rst_table(table):
+  """
+  :return: RST list-table of a benchmark table
+  """
+  lines = [u'', (u'.. list-table:: %s' % tex_to_rst(table['caption'])).rstrip(), u'   :widths: auto', u'   :header-rows: 1',
+           u'']
+  lines.append(u'   * - %s' % u'\n     - '.join(c[0] for c in COLUMNS))
+  for cells in table['rows']:
+    cells = [tex_to_rst(strip_group(c)) if UNSET_PATTERN.match(strip_group(c)) is None else UNSET
+             for c in cells[:2]] + [format_number(c) for c in cells[2:4]] + [tex_to_rst(strip_group(cells[4]))]
+    lines.append(u'   * - %s' % u'\n     - '.join(cells))
+  lines.append(u'')
+  return u'\n'.join(lines)
+
+
+def edit_benchmark_tables(buffer, tables):
+  """
+  Replace the markers of the benchmark tables by RST tables.
+
+  :param buffer: :py:class:`parse_tex.EditBuffer` of the RST output
+  :param tables: dict of table name: table (result of :py:func:`read_benchmark_tables`)
+  :return: number of tables written
+  """
+  by_key = dict((get_marker_key(name), table) for name, table in six.iteritems(tables))
+  n_tables = 0
+  for match in MARKER_PATTERN.finditer(buffer.text):
+    table = by_key.get(match.group('key'))
+    if table is None:
+      continue
+    buffer.replace(match.start(), match.end(), build_rst_table(table))
+    n_tables += 1
+  return n_tables
+
+
+def get_records(tables):
+  """
+  :return: list of the reference value records of all tables (see the module documentation), ordered by table name
+  """
+  records = []
+  for name in sorted(tables):
+    table = tables[name]
+    for cells in table['rows']:
+      record = {'code': table['code'], 'feature': table['feature'] and tex_to_rst(table['feature']), 'table': name}
+      for (_, field), cell in zip(COLUMNS, cells):
+        if field in ('value', 'tolerance'):
+          record[field] = parse_number(cell)
+          if field == 'value':
+            record['value_text'] = None if record['value'] is None else strip_group(cell)
+        else:
+          cell = strip_group(cell)
+          record[field] = None if UNSET_PATTERN.match(cell) is not None else tex_to_rst(cell)
+      records.append(record)
+  return records
+
+
+def format_csv_field(value):
+  if value is None:
+    return u''
+  if isinstance(value, float):
+    return repr(value)
+  if any(c in value for c in u',"\n'):
+    return u'"%s"' % value.replace(u'"', u'""')
+  return value
+
+
+def dump_reference_values(records, base_name=REFERENCE_VALUES):
+  """
+  :return: list of (file name, contents (bytes)) of the reference value records as ``<base_name>.json`` and
+    ``<base_name>.csv``
+  """
+  json_data = u'[\n%s\n]\n' % u',\n'.join(json.dumps(r, sort_keys=True) for r in records)
+  csv_lines = [u','.join(RECORD_FIELDS)] + [u','.join(format_csv_field(r[f]) for f in RECORD_FIELDS) for r in records]
+  return [(base_name + '.json', json_data.encode('utf-8')),
+          (base_name + '.csv', (u'\n'.join(csv_lines) + u'\n').encode('utf-8'))]
@@ -0,0 +1,360 @@
+# -*- coding: utf-8 -*-
+"""
+Check the feature values computed by an implementation against the reference values of the reference data sets.
+
+  python scripts/check_conformance.py computed.csv [other.csv ...] [--reference docs/reference_values.json]
+    [--min-consensus strong] [--output results.csv] [--show-failures] [--jobs 4]
+
+The reference values and their tolerances are read once from ``reference_values.json`` (or ``reference_values.csv``),
+written by ``parse_tex.py`` (see :py:mod:`benchmark_tables`), into NumPy arrays with one row per IBSI code, data set
+and configuration.
+
+The computed values are read from CSV files with the columns ``code``, ``data`` and ``config``, as the reference
+values (e.g. ``RNU0,config. A,`` for the volume of the lung CT configuration A, ``RNU0,dig. phantom,`` for the digital
+phantom), and one or more columns of values. Every other column, and the ``value`` column, holds the values of one run
+(e.g. of a release or a set of parameters), named after the file and the column. The ``feature``, ``table``,
+``tolerance`` and ``consensus`` columns are ignored, so the reference values CSV can be filled in. Data sets and
+configurations are compared without case and extra spaces.
+
+All runs are then checked at once, as a matrix of reference values x runs:
+
+- ``pass``: the computed value is within the tolerance of the reference value. Reference values without a tolerance
+  must be matched to the precision they are given in, i.e. to half a unit of their last digit as written in the
+  benchmark table (``value_text``, e.g. 0.005 for ``1.23`` and 500 for ``3.58e5``), or of their third significant
+  digit if the reference file does not give it.
+- ``fail``: the computed value is not within the tolerance.
+- ``missing``: no value was computed (no row, or an empty cell).
+
+Reference values that are not set (or not a number) are not checked, nor are those without an IBSI code (of tables
+that are not included below a feature). If several reference values have the same code, data set and configuration,
+only the first is checked. Both are reported. The script prints the counts of every run, and exits with status 1 if
+any value failed. NumPy is needed (see ``requirements.txt``).
+"""
+import argparse
+import csv
+import io
+import json
+import operator
+import os
+import sys
+
+import six
+
+try:
+  import numpy as np
+except ImportError:
+  np = None
+
+import benchmark_tables
+
+SCRIPT_DIR = os.path.dirname(os.path.abspath(__file__))
+DOCS_DIR = os.path.join(os.path.dirname(SCRIPT_DIR), 'docs')
+
+CONSENSUS_LEVELS = ('weak', 'moderate', 'strong', 'very strong')
+KEY_FIELDS = ('code', 'data', 'config')
+SIGNIFICANT_DIGITS = 3  # Of the reference values without a tolerance, if they are not given as written
+RELATIVE_SLACK = 1e-9  # Of the comparisons, for values on the edge of their tolerance
+
+# States of the result matrix
+PASS, FAIL, MISSING, NOT_CHECKED = 1, 0, -1, -2
+STATE_NAMES = {PASS: 'pass', FAIL: 'fail', MISSING: 'missing', NOT_CHECKED: ''}
+
+
+def read_csv(path):
+  """
+  :return: list of the rows of a CSV file (UTF-8), as lists of unicode cells. Lines without quotes are split as they
+    are, which is several times faster than the csv module for files of numbers. Quoted cells cannot span lines.
+  """
+  with io.open(path, mode='rb') as csv_fs:
+    data = csv_fs.read().decode('utf-8-sig')
+  rows = []
+  for line in data.splitlines():
+    if u'"' not in line:
+      rows.append(line.split(u',') if line != u'' else [])
+    elif six.PY2:
+      rows.append([c.decode('utf-8') for c in next(csv.reader([line.encode('utf-8')]))])
+    else:
+      rows.append(next(csv.reader([line])))
+  return rows
+
+
+def get_key(code, data, config):
+  """
+  :return: key of a reference value: code in upper case, data set and configuration in lower case, without extra spaces
+  """
+  return ((code or u'').strip().upper(),) + tuple(u' '.join((v or u'').split()).lower() for v in (data, config))
+
+
+def parse_value(text):
+  """
+  :return: the number in a cell, NaN if the cell is empty. Raises a ValueError if it is not a number.
+  """
+  text = text.strip()
+  return float(text) if text != '' else float('nan')
+
+
+def get_precision(text):
+  """
+  :return: half a unit of the last digit of a number as it is written, e.g. 0.005 for ``1.23`` and 500 for ``3.58e5``,
+    NaN if the text is not set or not a number
+  """
+  text = (text or u'').strip()
+  match = benchmark_tables.NUMBER_PATTERN.match(text)
+  if match is None:
+    return float('nan')
+  exponent = int(match.group('exp')) if match.group('exp') is not None else 0
+  mantissa = text[:match.start('exp') - 1] if match.group('exp') is not None else text
+  return 0.5 * 10.0 ** (exponent - len(mantissa.partition(u'.')[2]))
+
+
+def load_reference_values(path):
+  """
+  :param path: ``reference_values.json`` or ``reference_values.csv``
+  :return: list of reference value records (see :py:mod:`benchmark_tables`)
+  """
+  if path.endswith('.json'):
+    with io.open(path, mode='rb') as json_fs:
+      return json.loads(json_fs.read().decode('utf-8'))
+
+  rows = read_csv(path)
+  records = []
+  for cells in rows[1:]:
+    record = dict((f, c if c != '' else None) for f, c in zip(rows[0], cells))
+    for field in ('value', 'tolerance'):
+      if record.get(field) is not None:
+        try:
+          record[field] = parse_value(record[field])
+        except ValueError:
+          pass  # Not a number, as in the tables
+    records.append(record)
+  return records
+
+
+class ReferenceValues(object):
+  """
+  Reference values and tolerances, as arrays.
+
+  :param records: reference value records (result of :py:func:`load_reference_values`)
+  :param min_consensus: lowest consensus (one of :py:data:`CONSENSUS_LEVELS`) of the values to check (default: all).
+    Values with a lower consensus are not checked.
+  :ivar records: records of the rows, in order
+  :ivar index: dict of key (see :py:func:`get_key`): row
+  :ivar values: reference values (NaN if not set, or not checked)
+  :ivar tolerances: tolerances of the values, with the precision of the value if it has no tolerance
+  :ivar no_code: records without an IBSI code, which are not checked
+  :ivar duplicates: list of (record, first record) of the records with the key of an earlier one, which are not checked
+  """
+
+  def __init__(self, records, min_consensus=None):
+    self.records = []
+    self.index = {}
+    self.no_code = []
+    self.duplicates = []
+    for record in records:
+      if (record.get('code') or u'').strip() == u'':
+        self.no_code.append(record)
+        continue
+      key = get_key(record.get('code'), record.get('data'), record.get('config'))
+      if key in self.index:
+        self.duplicates.append((record, self.records[self.index[key]]))
+        continue
+      self.index[key] = len(self.records)
+      self.records.append(record)
+
+    def to_array(field):
+      return np.array([r.get(field) if isinstance(r.get(field), float) else np.nan for r in self.records], dtype=float)
+
+    self.values = to_array('value')
+    if min_consensus is not None:
+      levels = CONSENSUS_LEVELS[CONSENSUS_LEVELS.index(min_consensus):]
+      self.values[[(r.get('consensus') or '').strip().lower() not in levels for r in self.records]] = np.nan
+    tolerances = to_array('tolerance')
+    precision = np.array([get_precision(r.get('value_text')) for r in self.records], dtype=float)
+    with np.errstate(divide='ignore', invalid='ignore'):
+      exponent = np.floor(np.log10(np.abs(self.values)))
+    precision = np.where(np.isnan(precision),
+                         np.where(np.isfinite(exponent), 0.5 * 10.0 ** (exponent - SIGNIFICANT_DIGITS + 1), 0.0),
+                         precision)
+    self.tolerances = np.where(np.isnan(tolerances), precision, tolerances)
+
+  def __len__(self):
+    return len(self.records)
+
+  def check(self, computed):
+    """
+    :param computed: array of the computed values, of shape (number of reference values, number of runs), NaN where
+      no value was computed
+    :return: array of the states (:py:data:`PASS`, etc.) of the same shape
+    """
+    values = self.values[:, np.newaxis]
+    with np.errstate(invalid='ignore'):
+      passed = np.abs(computed - values) <= (self.tolerances + RELATIVE_SLACK * np.abs(self.values))[:, np.newaxis]
+    states = np.where(passed, PASS, FAIL).astype(np.int8)
+    states[np.isnan(computed)] = MISSING
+    states[np.isnan(self.values)] = NOT_CHECKED
+    return states
+
+
+def read_runs(path, reference):
+  """
+  Read the computed values of a CSV file.
+
+  :param reference: :py:class:`ReferenceValues`
+  :return: tuple of the names of the runs, the array of their values (of shape (number of reference values, number of
+    runs), NaN where no value was computed) and the list of the (line, code, data set, configuration) of the rows that
+    are not reference values
+  """
+  rows = read_csv(path)
+  if len(rows) == 0:
+    raise ValueError('%s is empty' % path)
+  header = [h.strip().lower() for h in rows[0]]
+  missing = [f for f in KEY_FIELDS if f not in header]
+  if len(missing) > 0:
+    raise ValueError('%s has no %s column' % (path, ', '.join(missing)))
+  key_columns = [header.index(f) for f in KEY_FIELDS]
+  value_columns = [i for i, h in enumerate(header) if h not in benchmark_tables.RECORD_FIELDS or h == 'value']
+  base_name = os.path.splitext(os.path.basename(path))[0]
+  names = [base_name if header[i] == 'value' else '%s:%s' % (base_name, rows[0][i].strip()) for i in value_columns]
+
+  if len(value_columns) > 1:
+    get_values = operator.itemgetter(*value_columns)
+  else:
+    get_values = lambda row: [row[i] for i in value_columns]
+
+  computed = np.full((len(reference), len(value_columns)), np.nan)
+  row_indices = []
+  cells = []
+  unmatched = []
+  for line, row in enumerate(rows[1:], 2):
+    if len(row) == 0:
+      continue
+    row += [u''] * (len(header) - len(row))
+    key = get_key(*[row[i] for i in key_columns])
+    if key not in reference.index:
+      unmatched.append((line,) + key)
+      continue
+    values = get_values(row)
+    try:
+      cells.append(list(map(float, values)))
+    except ValueError:
+      # Empty cells, or not a number
+      try:
+        cells.append([parse_value(v) for v in values])
+      except ValueError as e:
+        raise ValueError('%s:%i: %s' % (path, line, e))
+    row_indices.append(reference.index[key])
+  if len(row_indices) > 0:
+    computed[row_indices] = np.array(cells, dtype=float)
+  return names, computed, unmatched
+
+
+def read_runs_task(task):
+  return read_runs(*task)
+
+
+def check_conformance(reference, paths, jobs=1):
+  """
+  :param reference: :py:class:`ReferenceValues`
+  :param paths: CSV files of computed values
+  :param jobs: Number of files to read concurrently (by worker processes)
+  :return: tuple of the names of the runs, the matrix of their computed values, the matrix of their states (see
+    :py:meth:`ReferenceValues.check`), and a dict of path: rows that are not reference values (see :py:func:`read_runs`)
+  """
+  tasks = [(path, reference) for path in paths]
+  if jobs > 1 and len(tasks) > 1:
+    import multiprocessing
+    pool = multiprocessing.Pool(min(jobs, len(tasks)))
+    try:
+      results = pool.map(read_runs_task, tasks, chunksize=1)
+      pool.close()
+    except BaseException:
+      pool.terminate()
+      raise
+    finally:
+      pool.join()
+  else:
+    results = [read_runs_task(task) for task in tasks]
+
+  names = [name for file_names, _, _ in results for name in file_names]
+  computed = np.hstack([r[1] for r in results]) if len(results) > 0 else np.empty((len(reference), 0))
+  unmatched = dict((path, r[2]) for path, r in zip(paths, results))
+  return names, computed, reference.check(computed), unmatched
+
+
+def dump_results(reference, names, states):
+  """
+  :return: contents (bytes) of a CSV file of the reference values, with the state of every run
+  """
+  lines = [u','.join(benchmark_tables.RECORD_FIELDS + tuple(names))]
+  for record, row_states in zip(reference.records, states.tolist()):
+    lines.append(u','.join([benchmark_tables.format_csv_field(record.get(f)) for f in benchmark_tables.RECORD_FIELDS] +
+                           [STATE_NAMES[s] for s in row_states]))
+  return (u'\n'.join(lines) + u'\n').encode('utf-8')
+
+
+if __name__ == '__main__':
+  parser = argparse.ArgumentParser(description='Check computed feature values against the reference values of the '
+                                               'reference data sets')
+  parser.add_argument('computed', nargs='+', help='CSV file of computed values (columns code, data, config and one '
+                                                  'column per run)')
+  parser.add_argument('--reference', default=None,
+                      help='reference_values.json or .csv written by parse_tex.py (default: in %s)' % DOCS_DIR)
+  parser.add_argument('--min-consensus', choices=CONSENSUS_LEVELS,
+                      help='Only check the reference values with at least this consensus')
+  parser.add_argument('--output', help='Write the state of every reference value and run to this CSV file')
+  parser.add_argument('--show-failures', action='store_true', help='List the values that failed')
+  parser.add_argument('-j', '--jobs', type=int, default=1,
+                      help='Number of files to read concurrently (0 to use all CPU cores)')
+  args = parser.parse_args()
+
+  if args.jobs < 1:
+    import multiprocessing
+    args.jobs = multiprocessing.cpu_count()
+  if np is None:
+    print('NumPy is not installed, install the requirements of the scripts (pip install -r requirements.txt)')
+    sys.exit(2)
+  reference_file = args.reference
+  if reference_file is None:
+    reference_file = os.path.join(DOCS_DIR, benchmark_tables.REFERENCE_VALUES + '.json')
+    if not os.path.isfile(reference_file):
+      reference_file = os.path.join(DOCS_DIR, benchmark_tables.REFERENCE_VALUES + '.csv')
+  reference = ReferenceValues(load_reference_values(reference_file), args.min_consensus)
+  if len(reference.no_code) > 0:
+    print('%s: %i reference values without an IBSI code are not checked (tables %s)' % (
+      reference_file, len(reference.no_code), ', '.join(sorted(set(r.get('table') or '?' for r in reference.no_code)))))
+  for record, first in reference.duplicates[:10]:
+    print('%s: duplicate reference value of %s (%s, %s) in table %s, only that of table %s is checked' % (
+      reference_file, record['code'], record.get('data') or '', record.get('config') or '', record.get('table') or '?',
+      first.get('table') or '?'))
+  if len(reference.duplicates) > 10:
+    print('%s: ... and %i other duplicate reference values' % (reference_file, len(reference.duplicates) - 10))
+  try:
+    names, computed, states, unmatched = check_conformance(reference, args.computed, args.jobs)
+  except (IOError, ValueError) as e:
+    print(e)
+    sys.exit(2)
+
+  for path in args.computed:
+    for line, code, data, config in unmatched[path][:10]:
+      print('%s:%i: no reference value of %s (%s, %s)' % (path, line, code, data, config))
+    if len(unmatched[path]) > 10:
+      print('%s: ... and %i other rows without a reference value' % (path, len(unmatched[path]) - 10))
+
+  n_checked = int(np.count_nonzero(~np.isnan(reference.values)))
+  print('%i reference values (%i set), %i runs' % (len(reference), n_checked, len(names)))
+  counts = np.stack([np.count_nonzero(states == s, axis=0) for s in (PASS, FAIL, MISSING)], axis=1)
+  for name, (n_pass, n_fail, n_missing) in zip(names, counts.tolist()):
+    print('  %s: %i passed, %i failed, %i missing' % (name, n_pass, n_fail, n_missing))
+
+  if args.show_failures:
+    for row, run in zip(*np.nonzero(states == FAIL)):
+      record = reference.records[row]
+      print('  %s: %s (%s, %s): %g, reference %g +/- %g' %
+            (names[run], record['code'], record.get('data') or '', record.get('config') or '', computed[row, run],
+             reference.values[row], reference.tolerances[row]))
+  if args.output is not None:
+    with open(args.output, mode='wb') as output_fs:
+      output_fs.write(dump_results(reference, names, states))
+
+  if np.any(states == FAIL):
+    sys.exit(1)
@@ -0,0 +1,245 @@
+# -*- coding: utf-8 -*-
+"""
+Check the cross-references of the documentation, without converting or building it.
+
+  python scripts/check_references.py [--docs-dir docs] [--source-dir ibsi-reference-manual]
+
+One index of labels is built from the Tex source tree (the labels of chapters, figures, features and IBSI codes, as the
+converter writes them, see ``parse_tex.py``) and the ``.. _label:`` targets and ``:name:`` options of ``docs/*.rst``.
+Every reference is then checked against it, in a single pass over the files:
+
+- the ``:ref:``, ``:numref:`` and ``:ibsi:`` roles of the RST documents must name a label of the index, and their
+  ``:cite:`` roles a key of the bibliography Sphinx reads (as chosen by ``conf.py``);
+- the ``\\ref`` commands of the Tex sources must name a ``\\label`` of the sources, and their ``\\cite`` commands a key
+  of the bibliography of the document. References to chapters (``chap_...``) must name the label of a chapter, as the
+  converter removes any other (see :py:func:`parse_tex.edit_chapter_refs`).
+
+As in Sphinx, labels and citation keys are compared in lower case. Labels defined twice are reported too.
+
+Broken references are listed as ``file:line: message``, and the script exits with status 1 if there is any. Neither
+pandoc nor Sphinx is run, so the check takes well under a second, e.g. before a full build in CI. If the source tree
+is not found, only the RST documents are checked.
+"""
+import argparse
+import bisect
+import io
+import os
+import re
+import sys
+
+import parse_tex
+
+SCRIPT_DIR = os.path.dirname(os.path.abspath(__file__))
+DOCS_DIR = os.path.join(os.path.dirname(SCRIPT_DIR), 'docs')
+SOURCE_DIR = os.path.join(os.path.dirname(SCRIPT_DIR), 'ibsi-reference-manual')
+
+RST_PATTERN = re.compile(
+  r'^[ \t]*\.\. _(?P<Target>[^:`\n]+|`[^`\n]+`):[ \t]*$'
+  r'|^[ \t]+:name:[ \t]+(?P<Name>\S[^\n]*?)[ \t]*$'
+  r'|:(?P<Role>ref|numref|ibsi|cite(?::\w+)?):`(?P<Text>[^`]+)`',
+  re.MULTILINE)
+TEX_PATTERN = re.compile(
+  r'(?<!\\)%[^\n]*'
+  r'|\\label\{(?P<Label>[^}]+)\}'
+  r'|\\(?P<Command>(?:auto|name|page|eq|c|C)?ref|cite[a-zA-Z]*\*?)(?:\[[^\]]*\])*\{(?P<Keys>[^}]+)\}')
+# Keys of the entries of a bibtex file. Faster than parsing the entries (see parse_tex.split_bib_entries), which is
+# not needed to list them.
+BIB_KEY_PATTERN = re.compile(r'^[ \t]*@(?P<Type>\w+)[ \t]*[{(][ \t]*(?P<Key>[^,\s]+)', re.MULTILINE)
+EXPLICIT_TITLE_PATTERN = re.compile(r'^(?P<Title>.*?)\s*<(?P<Target>.+?)>$', re.DOTALL)
+
+
+def read_text(path):
+  with io.open(path, mode='r', encoding='utf-8') as text_fs:
+    return text_fs.read()
+
+
+def get_bib_keys(bib_files):
+  """
+  :return: set of the keys (in lower case) of the entries of the passed bibtex files
+  """
+  keys = set()
+  for bib_file in bib_files:
+    for match in BIB_KEY_PATTERN.finditer(read_text(bib_file)):
+      if match.group('Type').lower() not in ('string', 'preamble', 'comment'):
+        keys.add(match.group('Key').lower())
+  return keys
+
+
+def get_role_target(text):
+  """
+  :return: target of the text of a role, without escapes and title (``title <target>``)
+  """
+  text = re.sub(r'\\(.)', r'\1', text, flags=re.DOTALL)
+  match = EXPLICIT_TITLE_PATTERN.match(text)
+  return (match.group('Target') if match else text).strip()
+
+
+def iter_lines(text, pattern):
+  """
+  :return: iterator of the (line number, match) tuples of a pattern in a text
+  """
+  line_starts = [m.end() for m in re.finditer(r'\n', text)]
+  for match in pattern.finditer(text):
+    yield bisect.bisect_right(line_starts, match.start()) + 1, match
+
+
+class ReferenceChecker(object):
+  """
+  Collects the labels and references of the documentation, and resolves the references once all files are read.
+  """
+
+  def __init__(self):
+    self.labels = {}  # label in lower case: what it is the label of, for the labels written by the converter
+    self.rst_labels = {}  # label in lower case: where it is defined
+    self.tex_labels = {}
+    self.chapter_labels = set()
+    self.rst_cite_keys = None
+    self.tex_cite_keys = None
+    self.rst_refs = []  # (path, line, role, target) tuples
+    self.tex_refs = []
+    self.problems = []  # (path, line, message) tuples
+    self.n_files = 0
+
+  def add_source_labels(self, tex_data, feature_data, tex_files):
+    """
+    Add the labels the converter writes to the RST documents.
+
+    :param tex_data: contents of the main Tex document
+    :param feature_data: contents of the feature definitions (``Chapters/FeatureDef.tex``)
+    :param tex_files: contents of all Tex files of the document, by path
+    """
+    chapter_labels = parse_tex.get_chapter_labels(tex_data)
+    self.chapter_labels = set(label.lower() for label in chapter_labels.values())
+    for label in self.chapter_labels:
+      self.labels.setdefault(label, 'chapter')
+    for data in tex_files.values():
+      for fig_name, fig_data in parse_tex.parse_tex_figures(data).items():
+        if 'label' in fig_data:
+          self.labels.setdefault(fig_data['label'].lower(), 'figure %s' % fig_name)
+
+    feature_class_codes, feature_codes = parse_tex.parse_feature_ids(feature_data)
+    for code, name, label in feature_class_codes + feature_codes + parse_tex.parse_other_ids(tex_data):
+      self.labels.setdefault(parse_tex.get_code_label(code), 'IBSI code %s' % code)
+      if label is not None:
+        self.labels.setdefault(label.lower(), 'header of %s' % code)
+
+  def scan_tex(self, path, text):
+    self.n_files += 1
+    for line, match in iter_lines(text, TEX_PATTERN):
+      if match.group('Label') is not None:
+        label = match.group('Label').strip().lower()
+        if label in self.tex_labels:
+          self.problems.append((path, line, 'label %s is already defined at %s' % (label, self.tex_labels[label])))
+        else:
+          self.tex_labels[label] = '%s:%i' % (os.path.relpath(path), line)
+      elif match.group('Command') is not None:
+        for key in match.group('Keys').split(','):
+          if key.strip() != '':
+            self.tex_refs.append((path, line, match.group('Command'), key.strip()))
+
+  def scan_rst(self, path, text):
+    self.n_files += 1
+    for line, match in iter_lines(text, RST_PATTERN):
+      role = match.group('Role')
+      if role is None:
+        label = match.group('Target') or match.group('Name')
+        label = re.sub(r'\\(.)', r'\1', label.strip('`')).lower()
+        if label in self.rst_labels:
+          self.problems.append((path, line, 'label %s is already defined at %s' % (label, self.rst_labels[label])))
+        else:
+          self.rst_labels[label] = '%s:%i' % (os.path.relpath(path), line)
+      elif role.startswith('cite'):
+        for key in get_role_target(match.group('Text')).split(','):
+          self.rst_refs.append((path, line, 'cite', key.strip()))
+      else:
+        self.rst_refs.append((path, line, role, get_role_target(match.group('Text'))))
+
+  def has_label(self, label):
+    return label in self.labels or label in self.rst_labels
+
+  def check(self):
+    """
+    :return: number of references checked
+    """
+    for path, line, role, target in self.rst_refs:
+      if role == 'cite':
+        if self.rst_cite_keys is not None and target.lower() not in self.rst_cite_keys:
+          self.problems.append((path, line, 'citation key %s is not found in the bibliography' % target))
+      elif role == 'ibsi':
+        if not self.has_label(parse_tex.get_code_label(target)):
+          self.problems.append((path, line, 'unknown IBSI code: %s' % target))
+      elif not self.has_label(target.lower()):
+        self.problems.append((path, line, 'undefined label: %s (:%s:)' % (target, role)))
+
+    for path, line, command, target in self.tex_refs:
+      key = target.lower()
+      if command.startswith('cite'):
+        if self.tex_cite_keys is not None and key not in self.tex_cite_keys:
+          self.problems.append((path, line, 'citation key %s is not found in the bibliography' % target))
+      elif key not in self.tex_labels:
+        self.problems.append((path, line, 'undefined label: %s (\\%s)' % (target, command)))
+      elif key.startswith('chap') and key not in self.chapter_labels:
+        self.problems.append((path, line, 'reference %s is not the label of a chapter, it would be removed' % target))
+    return len(self.rst_refs) + len(self.tex_refs)
+
+
+def check_references(docs_dir, source_dir=None):
+  """
+  :param docs_dir: documentation root
+  :param source_dir: Tex source tree, holding ``IBSIWorkDocument.tex`` (default: only check the RST documents)
+  :return: :py:class:`ReferenceChecker`, with the broken references in ``problems``
+  """
+  checker = ReferenceChecker()
+  if source_dir is not None:
+    tex_source = os.path.join(source_dir, 'IBSIWorkDocument.tex')
+    tex_data = parse_tex.read_tex_source(tex_source)
+    search_dirs = parse_tex.get_tex_search_dirs(source_dir, [])
+    tex_files = {tex_source: tex_data}
+    for _, path in parse_tex.get_tex_dependencies(tex_data, search_dirs):
+      tex_files[path] = read_text(path)
+    feature_source = os.path.join(source_dir, 'Chapters', 'FeatureDef.tex')
+    feature_data = tex_files.get(feature_source)
+    if feature_data is None:
+      feature_data = parse_tex.read_tex_source(feature_source)
+
+    checker.add_source_labels(tex_data, feature_data, tex_files)
+    for path in sorted(tex_files):
+      checker.scan_tex(path, tex_files[path])
+    # As the converter, which uses the bibliography in docs if the document does not name one
+    bib_files = [f for f in parse_tex.find_bibliography(tex_data, search_dirs,
+                                                        os.path.join(docs_dir, 'Bibliography.bib'))
+                 if os.path.isfile(f)]
+    if len(bib_files) > 0:
+      checker.tex_cite_keys = get_bib_keys(bib_files)
+
+  for name in sorted(os.listdir(docs_dir)):
+    if name.endswith('.rst'):
+      checker.scan_rst(os.path.join(docs_dir, name), read_text(os.path.join(docs_dir, name)))
+  # As conf.py
+  for name in (parse_tex.PRUNED_BIBLIOGRAPHY, 'Bibliography.bib'):
+    if os.path.isfile(os.path.join(docs_dir, name)):
+      checker.rst_cite_keys = get_bib_keys([os.path.join(docs_dir, name)])
+      break
+  return checker
+
+
+if __name__ == '__main__':
+  parser = argparse.ArgumentParser(description='Check the cross-references and citations of the documentation')
+  parser.add_argument('--docs-dir', default=DOCS_DIR, help='Documentation root (default: %(default)s)')
+  parser.add_argument('--source-dir', default=SOURCE_DIR,
+                      help='Tex source tree, not checked if it is not found (default: %(default)s)')
+  args = parser.parse_args()
+
+  source_dir = args.source_dir
+  if not os.path.isfile(os.path.join(source_dir, 'IBSIWorkDocument.tex')):
+    print('%s not found, only checking the RST documents' % source_dir)
+    source_dir = None
+  checker = check_references(args.docs_dir, source_dir)
+  n_refs = checker.check()
+
+  for path, line, message in sorted(checker.problems):
+    print('%s:%i: %s' % (os.path.relpath(path), line, message))
+  print('Checked %i references in %i files against %i labels: %i problems' %
+        (n_refs, checker.n_files, len(set(checker.labels) | set(checker.rst_labels)), len(checker.problems)))
+  if len(checker.problems) > 0:
+    sys.exit(1)
@@ -0,0 +1,358 @@
+# -*- coding: utf-8 -*-
+"""
+Optimisation of the figures of the documentation, run by the ``optimise_figures`` stage of ``parse_tex.py``.
+
+For every figure included by the Tex source:
+
+- PDF figures are rasterised to PNG (by ``pdftoppm`` or Ghostscript), at twice the CSS resolution
+- PNG figures are recompressed losslessly
+- WebP variants are made at the size the figure is shown at, i.e. its size scaled by the ``scale`` of
+  ``\\includegraphics``, and at twice that size for high density screens where the figure is large enough. A variant
+  is only kept if it is smaller than the PNG and than the variant of the next higher density, so no screen is served
+  a larger file than it needs. The ``figure_variants`` Sphinx extension serves them to browsers that support WebP.
+- the size the figure is shown at is returned, to be written as width and height of the figure, so browsers can lay
+  out the page before the figure is loaded
+
+Results are stored in a cache keyed by a hash of the source figure, so unchanged figures are not processed again.
+Figures that are not cached are processed by a pool of worker processes. Recompression and the WebP variants need
+Pillow; without it, figures are only rasterised and measured.
+"""
+import hashlib
+import io
+import json
+import os
+import shutil
+import struct
+import subprocess
+import tempfile
+
+import six
+
+from output_manifest import write_if_changed
+
+# Bump this whenever a change alters the processing of figures, so cached figures are not reused
+FIGURE_CACHE_VERSION = 2
+
+# Resolution of a CSS pixel, and the number of pixels per CSS pixel at which PDF figures are rasterised
+CSS_DPI = 96
+PDF_DENSITY = 2
+
+# Options of the figure directive taken from the figure data (see ``parse_tex_figures`` and ``optimise_figures``)
+FIGURE_OPTIONS = ('align', 'width', 'height', 'loading')
+
+# Suffixes of the WebP variants, and the size of each variant relative to the size the figure is shown at
+WEBP_VARIANTS = (('.webp', 1), ('@2x.webp', 2))
+
+PNG_SIGNATURE = b'\x89PNG\r\n\x1a\n'
+
+
+class FigureError(Exception):
+  pass
+
+
+def get_pillow_version():
+  """
+  :return: version of Pillow, or None if it is not installed
+  """
+  try:
+    import PIL
+  except ImportError:
+    return None
+  return getattr(PIL, '__version__', getattr(PIL, 'PILLOW_VERSION', 'unknown'))
+
+
+def get_rasteriser():
+  """
+  :return: command used to rasterise PDF figures (``pdftoppm`` or ``gs``), or None if neither is installed
+  """
+  for cmd in (['pdftoppm', '-v'], ['gs', '--version']):
+    try:
+      with open(os.devnull, 'wb') as null_fs:
+        subprocess.call(cmd, stdout=null_fs, stderr=null_fs)
+      return cmd[0]
+    except OSError:
+      continue
+  return None
+
+
+def rasterise_pdf(src_path, rasteriser, dpi=CSS_DPI * PDF_DENSITY):
+  """
+  Rasterise the first page of a PDF figure.
+
+  :return: PNG data (bytes)
+  """
+  tmp_dir = tempfile.mkdtemp()
+  try:
+    png_path = os.path.join(tmp_dir, 'figure.png')
+    if rasteriser == 'pdftoppm':
+      cmd = ['pdftoppm', '-png', '-r', str(dpi), '-singlefile', src_path, png_path[:-4]]
+    elif rasteriser == 'gs':
+      cmd = ['gs', '-q', '-dSAFER', '-dBATCH', '-dNOPAUSE', '-sDEVICE=pngalpha', '-r%i' % dpi, '-dFirstPage=1',
+             '-dLastPage=1', '-sOutputFile=%s' % png_path, src_path]
+    else:
+      raise FigureError('No PDF rasteriser available to convert %s' % src_path)
+    with open(os.devnull, 'wb') as null_fs:
+      if subprocess.call(cmd, stdout=null_fs, stderr=null_fs) != 0 or not os.path.isfile(png_path):
+        raise FigureError('%s could not rasterise %s' % (rasteriser, src_path))
+    with open(png_path, mode='rb') as png_fs:
+      return png_fs.read()
+  finally:
+    shutil.rmtree(tmp_dir)
+
+
+def get_png_size(data):
+  """
+  :return: (width, height) in pixels from the header of PNG data
+  """
+  if data[:8] != PNG_SIGNATURE or data[12:16] != b'IHDR':
+    raise FigureError('Not a PNG image')
+  return struct.unpack('>II', data[16:24])
+
+
+def optimise_png(img):
+  """
+  Recompress a PNG image losslessly.
+
+  :param img: PIL image, as opened from PNG data
+  :return: PNG data (bytes)
+  """
+  params = dict((k, img.info[k]) for k in ('transparency', 'dpi', 'gamma') if k in img.info)
+  out = io.BytesIO()
+  img.save(out, format='PNG', optimize=True, **params)
+  return out.getvalue()
+
+
+def make_webp(img, size):
+  """
+  :param img: PIL image
+  :param size: (width, height) of the variant in pixels
+  :return: lossless WebP data (bytes)
+  """
+  from PIL import Image
+
+  has_alpha = img.mode in ('RGBA', 'LA', 'PA') or 'transparency' in img.info
+  img = img.convert('RGBA' if has_alpha else 'RGB')
+  if img.size != tuple(size):
+    img = img.resize(size, Image.LANCZOS)
+  out = io.BytesIO()
+  img.save(out, format='WEBP', lossless=True)
+  return out.getvalue()
+
+
+def has_webp():
+  try:
+    from PIL import features
+  except ImportError:
+    return False
+  return features.check('webp')
+
+
+def process_figure(task):
+  """
+  Process a single figure (worker function).
+
+  :param task: tuple of the path of the source figure, its scale (percentage) and the PDF rasteriser
+  :return: dictionary with the ``width`` and ``height`` the figure is shown at, and the output ``files`` as a dictionary
+    of suffix (``.png`` for the figure itself) and data (bytes)
+  """
+  src_path, scale, rasteriser = task
+  with open(src_path, mode='rb') as src_fs:
+    data = src_fs.read()
+
+  density = 1
+  if src_path.lower().endswith('.pdf'):
+    data = rasterise_pdf(src_path, rasteriser)
+    density = PDF_DENSITY
+
+  px_width, px_height = get_png_size(data)
+  width = max(1, int(round(px_width * scale / 100. / density)))
+  height = max(1, int(round(px_height * scale / 100. / density)))
+  result = {'width': width, 'height': height, 'files': {'.png': data}}
+
+  if get_pillow_version() is None:
+    return result
+
+  from PIL import Image
+  img = Image.open(io.BytesIO(data))
+  img.load()
+
+  optimised = optimise_png(img)
+  if len(optimised) < len(data):
+    result['files']['.png'] = optimised
+
+  if has_webp():
+    # Densest first: a variant that is not smaller than a denser one is dropped, screens of its density are then
+    # served the denser one
+    max_size = len(result['files']['.png'])
+    for suffix, factor in reversed(WEBP_VARIANTS):
+      variant_size = (width * factor, height * factor)
+      if variant_size[0] > px_width:
+        if factor > 1:
+          continue  # Never upscale for high density screens
+        variant_size = (px_width, px_height)
+      variant = make_webp(img, variant_size)
+      if len(variant) < max_size:
+        result['files'][suffix] = variant
+        max_size = len(variant)
+  return result
+
+
+def get_figure_key(src_data, src_path, scale, rasteriser):
+  h = hashlib.sha1()
+  h.update(('%i\0%s\0%s\0%s\0' % (FIGURE_CACHE_VERSION, get_pillow_version(), scale,
+                                  os.path.splitext(src_path)[1].lower())).encode('utf-8'))
+  if src_path.lower().endswith('.pdf'):
+    h.update(('%s\0' % rasteriser).encode('utf-8'))
+  h.update(src_data)
+  return h.hexdigest()
+
+
+class FigureCache(object):
+  """
+  On-disk, content-addressed store of processed figures: a directory per figure, with the output files and a
+  ``meta.json`` file holding the size of the figure.
+
+  Entries are evicted least-recently-used first once the total size of the cache exceeds ``max_size`` bytes. A cache
+  hit refreshes the modification time of ``meta.json``, which is used as the last-used time of the entry.
+  """
+
+  def __init__(self, cache_dir, max_size=256 * 1024 ** 2):
+    self.cache_dir = cache_dir
+    self.max_size = max_size
+    if not os.path.isdir(cache_dir):
+      os.makedirs(cache_dir)
+
+  def get(self, key):
+    meta_file = os.path.join(self.cache_dir, key, 'meta.json')
+    if not os.path.isfile(meta_file):
+      return None
+    os.utime(meta_file, None)
+    with open(meta_file, mode='r') as meta_fs:
+      result = json.load(meta_fs)
+    files = {}
+    for suffix in result['files']:
+      with open(os.path.join(self.cache_dir, key, 'figure' + suffix), mode='rb') as fig_fs:
+        files[suffix] = fig_fs.read()
+    result['files'] = files
+    return result
+
+  def put(self, key, result):
+    # Write to a temporary directory first, so an interrupted run never leaves a partial entry
+    entry_dir = os.path.join(self.cache_dir, key)
+    tmp_dir = tempfile.mkdtemp(dir=self.cache_dir)
+    for suffix, data in six.iteritems(result['files']):
+      with open(os.path.join(tmp_dir, 'figure' + suffix), mode='wb') as fig_fs:
+        fig_fs.write(data)
+    with open(os.path.join(tmp_dir, 'meta.json'), mode='w') as meta_fs:
+      json.dump({'width': result['width'], 'height': result['height'], 'files': sorted(result['files'])}, meta_fs)
+    if os.path.isdir(entry_dir):
+      shutil.rmtree(entry_dir)
+    os.rename(tmp_dir, entry_dir)
+    self.evict()
+
+  def evict(self):
+    entries = []
+    for key in os.listdir(self.cache_dir):
+      meta_file = os.path.join(self.cache_dir, key, 'meta.json')
+      if os.path.isfile(meta_file):
+        size = sum(os.path.getsize(os.path.join(self.cache_dir, key, f))
+                   for f in os.listdir(os.path.join(self.cache_dir, key)))
+        entries.append((os.path.getmtime(meta_file), size, key))
+
+    total_size = sum(e[1] for e in entries)
+    for mtime, size, key in sorted(entries):
+      if total_size <= self.max_size:
+        break
+      shutil.rmtree(os.path.join(self.cache_dir, key))
+      total_size -= size
+
+
+def optimise_figures(figures, search_dirs, dest_dir='.', cache=None, jobs=1):
+  """
+  Process all figures and write the results to the documentation.
+
+  PDF figures are written as PNG, at the same path. If no PDF rasteriser is installed, the PNG version already in
+  ``dest_dir`` (if any) is processed instead.
+
+  :param figures: figure data, as returned by ``parse_tex_figures``. The ``width`` and ``height`` of every processed
+    figure are added to its entry.
+  :param search_dirs: directories in which to look for the source figures, in order
+  :param dest_dir: root directory of the documentation
+  :param cache: :py:class:`FigureCache` to read from and store in, or None to process all figures
+  :param jobs: number of worker processes
+  :return: dictionary of counters (figures processed, taken from the cache, skipped, bytes read and written)
+  """
+  rasteriser = get_rasteriser()
+  counts = {'figures': 0, 'cached': 0, 'skipped': 0, 'bytes_in': 0, 'bytes_out': 0, 'files_written': 0}
+
+  tasks = []
+  for fig_name in sorted(figures):
+    dest_base = os.path.join(dest_dir, os.path.splitext(fig_name)[0])
+    src_path = None
+    for d in search_dirs:
+      if os.path.isfile(os.path.join(d, fig_name)):
+        src_path = os.path.join(d, fig_name)
+        break
+    if (src_path is None or (src_path.lower().endswith('.pdf') and rasteriser is None)) and \
+       os.path.isfile(dest_base + '.png'):
+      src_path = dest_base + '.png'
+    if src_path is None or (src_path.lower().endswith('.pdf') and rasteriser is None):
+      print('WARNING: Figure %s is not found, or cannot be rasterised' % fig_name)
+      counts['skipped'] += 1
+      continue
+
+    scale = float(figures[fig_name].get('scale', 100))
+    with open(src_path, mode='rb') as src_fs:
+      src_data = src_fs.read()
+    counts['bytes_in'] += len(src_data)
+    key = get_figure_key(src_data, src_path, scale, rasteriser)
+    tasks.append((fig_name, dest_base, key, (src_path, scale, rasteriser)))
+
+  results = [None] * len(tasks)
+  to_process = []
+  for task_idx, (fig_name, dest_base, key, task) in enumerate(tasks):
+    if cache is not None:
+      results[task_idx] = cache.get(key)
+    if results[task_idx] is None:
+      to_process.append(task_idx)
+    else:
+      counts['cached'] += 1
+
+  if jobs > 1 and len(to_process) > 1:
+    import multiprocessing
+    pool = multiprocessing.Pool(min(jobs, len(to_process)))
+    try:
+      processed = pool.map(process_figure, [tasks[t][3] for t in to_process], chunksize=1)
+      pool.close()
+    except BaseException:
+      pool.terminate()
+      raise
+    finally:
+      pool.join()
+  else:
+    processed = [process_figure(tasks[t][3]) for t in to_process]
+
+  for task_idx, result in zip(to_process, processed):
+    results[task_idx] = result
+    counts['figures'] += 1
+    if cache is not None:
+      cache.put(tasks[task_idx][2], result)
+      # A figure processed in place is read back in its processed form by the next run
+      fig_name, dest_base, key, (src_path, scale, _) = tasks[task_idx]
+      if src_path == dest_base + '.png':
+        processed_key = get_figure_key(result['files']['.png'], src_path, scale, rasteriser)
+        if processed_key != key:
+          cache.put(processed_key, result)
+
+  for (fig_name, dest_base, key, task), result in zip(tasks, results):
+    figures[fig_name]['width'] = str(result['width'])
+    figures[fig_name]['height'] = str(result['height'])
+    for suffix, data in six.iteritems(result['files']):
+      counts['bytes_out'] += len(data)
+      if write_if_changed(dest_base + suffix, data):
+        counts['files_written'] += 1
+    # Remove variants that are no longer made (e.g. after a change of scale)
+    for suffix, factor in WEBP_VARIANTS:
+      if suffix not in result['files'] and os.path.isfile(dest_base + suffix):
+        os.remove(dest_base + suffix)
+  return counts
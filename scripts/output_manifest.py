@@ -0,0 +1,122 @@
+# -*- coding: utf-8 -*-
+"""
+Manifest of the files written by ``parse_tex.py``, stored as ``conversion_manifest.json`` in the documentation root.
+
+For every output file, the manifest records the SHA-1 hash of its contents, its size and modification time once
+written, and the Tex source files it was derived from (relative to the source tree)::
+
+  {"files": {
+    "01_Introduction.rst": {"mtime": 1700000000.0, "sha1": "...", "size": 1234, "sources": ["IBSIWorkDocument.tex"]},
+    ...
+  }, "version": 1}
+
+An output is not written if it did not change, so Sphinx does not read it again: if its hash matches the manifest and
+the file was not touched since it was written, it is not even read. Files written by a previous run that are no longer
+produced (e.g. the document of a renamed chapter) are removed.
+"""
+import hashlib
+import json
+import os
+
+MANIFEST_FILE = 'conversion_manifest.json'
+MANIFEST_VERSION = 1
+
+
+def write_if_changed(fname, data):
+  """
+  :return: True if the file was written, False if it already held ``data``
+  """
+  if os.path.isfile(fname) and os.path.getsize(fname) == len(data):
+    with open(fname, mode='rb') as fs:
+      if fs.read() == data:
+        return False
+  if not os.path.isdir(os.path.dirname(fname) or '.'):
+    os.makedirs(os.path.dirname(fname))
+  with open(fname, mode='wb') as fs:
+    fs.write(data)
+  return True
+
+
+class Manifest(object):
+  """
+  Writes the output files of a conversion, and records them.
+
+  :param dest_dir: documentation root, holding the output files and the manifest
+  """
+
+  def __init__(self, dest_dir, fname=MANIFEST_FILE):
+    self.dest_dir = dest_dir
+    self.fname = fname
+    self.previous = self.load()
+    self.files = {}
+    self.counts = {'files': 0, 'files_written': 0, 'files_removed': 0, 'bytes_written': 0}
+
+  def load(self):
+    """
+    :return: dict of file name: entry of the manifest of the previous run (empty if there is none, or if it cannot be
+      read)
+    """
+    try:
+      with open(os.path.join(self.dest_dir, self.fname), mode='rb') as manifest_fs:
+        manifest = json.loads(manifest_fs.read().decode('utf-8'))
+    except (IOError, OSError, ValueError):
+      return {}
+    if not isinstance(manifest, dict) or manifest.get('version') != MANIFEST_VERSION:
+      return {}
+    return manifest.get('files', {})
+
+  def write(self, name, data, sources=()):
+    """
+    Write an output file, unless it did not change.
+
+    :param name: file name, relative to the documentation root (with ``/`` as separator)
+    :param data: contents (bytes)
+    :param sources: source files the output is derived from
+    :return: True if the file was written
+    """
+    sha1 = hashlib.sha1(data).hexdigest()
+    path = os.path.join(self.dest_dir, *name.split('/'))
+    entry = self.previous.get(name)
+    try:
+      stat = os.stat(path)
+    except OSError:
+      stat = None
+
+    written = False
+    if entry is None or stat is None or entry.get('sha1') != sha1 or entry.get('size') != stat.st_size or \
+       entry.get('mtime') != stat.st_mtime:
+      written = write_if_changed(path, data)
+      stat = os.stat(path)
+    self.files[name] = {'sha1': sha1, 'size': stat.st_size, 'mtime': stat.st_mtime, 'sources': sorted(set(sources))}
+    self.counts['files'] += 1
+    if written:
+      self.counts['files_written'] += 1
+      self.counts['bytes_written'] += len(data)
+    return written
+
+  def remove_stale(self):
+    """
+    Remove the files of the previous run that were not written by this run.
+
+    :return: sorted list of the names of the removed files
+    """
+    removed = []
+    for name in sorted(self.previous):
+      if name in self.files or os.path.isabs(name) or '..' in name.split('/'):
+        continue
+      path = os.path.join(self.dest_dir, *name.split('/'))
+      if os.path.isfile(path):
+        os.remove(path)
+        removed.append(name)
+    self.counts['files_removed'] += len(removed)
+    return removed
+
+  def save(self):
+    """
+    :return: True if the manifest was written, False if it did not change
+    """
+    lines = [u'  %s: %s' % (json.dumps(name), json.dumps(self.files[name], sort_keys=True))
+             for name in sorted(self.files)]
+    data = u'{"files": {\n%s\n}, "version": %i}\n' % (u',\n'.join(lines), MANIFEST_VERSION)
+    return write_if_changed(os.path.join(self.dest_dir, self.fname), data.encode('utf-8'))
+
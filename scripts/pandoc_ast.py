@@ -0,0 +1,311 @@
+# -*- coding: utf-8 -*-
+"""
+Rewrites on the pandoc JSON AST, used by the ``ast`` engine of ``parse_tex.py``.
+
+Instead of repairing the RST produced by pandoc line by line, the ``ast`` engine requests the document as a JSON tree,
+applies the corrections below to that tree and has pandoc serialise the result to RST once:
+
+- citations become ``:cite:`` roles
+- macros unknown to MathJax are expanded in math elements
+- figures get their label and alignment from the Tex source and point to the PNG version of the figure
+- tables (and the ``&``-separated line blocks pandoc produces for unparsed tabulars) become ``.. list-table::``
+- links to chapters, sections and figures become ``:ref:`` and ``:numref:`` roles
+"""
+import re
+
+import six
+
+from figure_assets import FIGURE_OPTIONS
+
+
+def rewrite_document(doc, figures, chapter_labels, expand_math):
+  """
+  Apply all rewrites to a pandoc document.
+
+  :param doc: pandoc document, as loaded from the JSON output of pandoc
+  :param figures: figure data, as returned by ``parse_tex_figures``
+  :param chapter_labels: chapter labels, as returned by ``get_chapter_labels``
+  :param expand_math: function expanding the macros in a math string, or None to leave math as it is
+  :return: the rewritten document (``doc`` is updated in place)
+  """
+  rewriter = AstRewriter(figures, chapter_labels, expand_math)
+  rewriter.collect_labels(doc['blocks'])
+  doc['blocks'] = rewriter.walk(doc['blocks'])
+  return doc
+
+
+class AstRewriter(object):
+  """
+  Bottom-up rewriter of pandoc elements.
+
+  For every element of type ``T`` with a method ``rewrite_T``, that method is called after the contents of the element
+  have been rewritten. It returns a list of elements to put in its place, or None to keep the element as it is.
+  """
+
+  def __init__(self, figures, chapter_labels, expand_math):
+    self.figures = figures
+    self.expand_math = expand_math
+    self.ref_labels = set(six.itervalues(chapter_labels))
+    self.numref_labels = set(f['label'] for f in six.itervalues(figures) if 'label' in f)
+
+  def collect_labels(self, value):
+    """
+    Register the identifiers of all headers, which pandoc writes as RST targets, so links to them can become roles.
+    """
+    if isinstance(value, list):
+      for v in value:
+        self.collect_labels(v)
+    elif isinstance(value, dict) and 't' in value:
+      if value['t'] == 'Header' and value['c'][1][0] != '':
+        self.ref_labels.add(value['c'][1][0])
+      self.collect_labels(value.get('c'))
+
+  def walk(self, value):
+    if isinstance(value, list):
+      elements = []
+      for v in value:
+        if isinstance(v, dict) and 't' in v:
+          elements.extend(self.rewrite(v))
+        else:
+          elements.append(self.walk(v))
+      return self.fix_role_spacing(elements)
+    return value
+
+  def rewrite(self, element):
+    if 'c' in element:
+      element['c'] = self.walk(element['c'])
+    rewrite_func = getattr(self, 'rewrite_%s' % element['t'], None)
+    if rewrite_func is not None:
+      replacement = rewrite_func(element)
+      if replacement is not None:
+        return replacement
+    return [element]
+
+  @staticmethod
+  def fix_role_spacing(elements):
+    """
+    RST roles must be separated from surrounding words, insert a space where a role directly follows or precedes a
+    word. Also drops a bold "Chapter" preceding a chapter reference, as the reference shows the chapter title.
+    """
+    fixed = []
+    for el_idx, el in enumerate(elements):
+      if is_role(el):
+        if len(fixed) > 1 and fixed[-1].get('t') in ('Space', 'SoftBreak') and fixed[-2] == STRONG_CHAPTER:
+          del fixed[-2:]
+        elif len(fixed) > 0 and fixed[-1].get('t') == 'Str' and fixed[-1]['c'][-1:].isalnum():
+          fixed.append({'t': 'Space'})
+        fixed.append(el)
+        if el_idx + 1 < len(elements) and elements[el_idx + 1].get('t') == 'Str' and \
+           elements[el_idx + 1]['c'][:1].isalnum():
+          fixed.append({'t': 'Space'})
+      else:
+        fixed.append(el)
+    return fixed
+
+  # Inline elements
+
+  def rewrite_Cite(self, element):
+    citations = element['c'][0]
+    return [role('cite', ','.join(c['citationId'] for c in citations))]
+
+  def rewrite_RawInline(self, element):
+    fmt, text = element['c']
+    if fmt != 'latex':
+      return None
+    match = re.match(r'\\cite[pt]?\{(?P<Authors>[^}]+)\}$', text)
+    if match is None:
+      return None
+    return [role('cite', ','.join(a.strip() for a in match.groupdict()['Authors'].split(',')))]
+
+  def rewrite_Math(self, element):
+    if self.expand_math is not None:
+      element['c'][1] = self.expand_math(element['c'][1])
+    return None
+
+  def rewrite_Link(self, element):
+    target = element['c'][2][0]
+    if not target.startswith('#'):
+      return None
+    label = target[1:]
+    if label in self.numref_labels:
+      return [role('numref', label)]
+    if label in self.ref_labels:
+      return [role('ref', label)]
+    return None
+
+  def rewrite_Strong(self, element):
+    # (\textbf{Chapter \ref{chap_x}}), the reference already shows the chapter title
+    content = element['c']
+    if len(content) == 3 and content[0] == STR_CHAPTER and content[1]['t'] in ('Space', 'SoftBreak') and \
+       is_role(content[2]):
+      return [content[2]]
+    return None
+
+  # Block elements
+
+  def rewrite_Figure(self, element):
+    attr, caption, content = element['c']
+    images = [i for b in content if b['t'] in ('Plain', 'Para') for i in b['c'] if i['t'] == 'Image']
+    if len(images) != 1:
+      return None
+    return self.figure_block(images[0]['c'][2][0], caption[1], attr[0])
+
+  def rewrite_Para(self, element):
+    # Pandoc < 3 marks figures as a paragraph holding only an image with title "fig:"
+    content = element['c']
+    if len(content) != 1 or content[0]['t'] != 'Image' or not content[0]['c'][2][1].startswith('fig:'):
+      return None
+    image = content[0]['c']
+    return self.figure_block(image[2][0], [{'t': 'Plain', 'c': image[1]}], image[0][0])
+
+  def figure_block(self, fig_name, caption_blocks, identifier):
+    caption = blocks_to_rst(caption_blocks)
+    if caption is None:
+      return None
+
+    fig_data = self.figures.get(fig_name, {})
+    fig = []
+    label = fig_data.get('label', identifier)
+    if label:
+      fig.append(u'.. _%s:' % label)
+
+    fig.append(u'.. figure:: ' + fig_name.replace('.pdf', '.png'))
+    for k in FIGURE_OPTIONS:
+      if k in fig_data:
+        fig.append(u'   :%s: %s' % (k, fig_data[k].strip()))
+
+    if caption != '':
+      fig.append(u'')
+      fig.append(u'   ' + caption)
+    return raw_block(u'\n'.join(fig))
+
+  def rewrite_Table(self, element):
+    caption = blocks_to_rst(element['c'][1][1])
+    head, bodies, foot = element['c'][3], element['c'][4], element['c'][5]
+
+    head_rows = [table_row_to_rst(r, strip_strong=True) for r in head[1]]
+    body_rows = [table_row_to_rst(r) for b in bodies for r in b[2] + b[3]] + \
+                [table_row_to_rst(r) for r in foot[1]]
+    if caption is None or any(r is None for r in head_rows + body_rows):
+      return None
+
+    rows = [r for r in head_rows + body_rows if any(c != '' for c in r)]
+    header_rows = len([r for r in head_rows if any(c != '' for c in r)])
+    return raw_block(list_table(rows, header_rows, caption))
+
+  def rewrite_LineBlock(self, element):
+    # Tabulars that pandoc could not parse end up as line blocks with '&' separated cells
+    lines = [inlines_to_rst(line) for line in element['c']]
+    if len(lines) == 0 or any(line is None or '&' not in line for line in lines):
+      return None
+
+    rows = [[c.strip() for c in line.split('&')] for line in lines]
+    rows = [r for r in rows if len(r) == len(rows[-1])]
+    header_rows = 0
+    for r in rows:
+      if not all(c.startswith('**') and c.endswith('**') for c in r):
+        break
+      header_rows += 1
+    rows = [[c[2:-2] for c in r] if r_idx < header_rows else r for r_idx, r in enumerate(rows)]
+    return raw_block(list_table(rows, header_rows))
+
+
+STR_CHAPTER = {'t': 'Str', 'c': 'Chapter'}
+STRONG_CHAPTER = {'t': 'Strong', 'c': [STR_CHAPTER]}
+
+
+def role(name, text):
+  return {'t': 'RawInline', 'c': ['rst', ':%s:`%s`' % (name, text)]}
+
+
+def is_role(element):
+  return isinstance(element, dict) and element.get('t') == 'RawInline' and element['c'][0] == 'rst' and element['c'][1].startswith(':')
+
+
+def raw_block(text):
+  # Pandoc writes raw blocks without a trailing empty line, the empty paragraph adds it
+  return [{'t': 'RawBlock', 'c': ['rst', text]}, {'t': 'Para', 'c': []}]
+
+
+def list_table(rows, header_rows, caption=''):
+  table = u'.. list-table:: %s\n   :widths: auto\n' % caption
+  if header_rows > 0:
+    table += u'   :header-rows: %i\n' % header_rows
+  table += u'\n'
+  for r in rows:
+    table += u'   * - %s\n' % u'\n     - '.join(r)
+  return u'\n'.join(line.rstrip() for line in table.rstrip('\n').split('\n'))
+
+
+def table_row_to_rst(row, strip_strong=False):
+  cells = []
+  for cell in row[1]:
+    if cell[2] != 1 or cell[3] != 1:
+      return None  # Row or column spans cannot be represented in a list-table
+    blocks = cell[4]
+    if strip_strong:
+      blocks = [unwrap_strong(b) for b in blocks]
+    cell_str = blocks_to_rst(blocks)
+    if cell_str is None:
+      return None
+    cells.append(cell_str)
+  return cells
+
+
+def unwrap_strong(block):
+  inlines = block.get('c', [])
+  while len(inlines) == 1 and inlines[0]['t'] in ('Span', 'Strong'):
+    inlines = inlines[0]['c'][1] if inlines[0]['t'] == 'Span' else inlines[0]['c']
+  return {'t': block['t'], 'c': inlines}
+
+
+def blocks_to_rst(blocks):
+  """
+  Serialise simple blocks (paragraphs of plain inline text) to a single line of RST.
+
+  :return: RST string, or None if the blocks contain elements that cannot be written on a single line
+  """
+  parts = []
+  for block in blocks:
+    if block['t'] not in ('Plain', 'Para'):
+      return None
+    part = inlines_to_rst(block['c'])
+    if part is None:
+      return None
+    parts.append(part)
+  return u' '.join(parts)
+
+
+def inlines_to_rst(inlines):
+  parts = []
+  for el in inlines:
+    t = el['t']
+    if t == 'Str':
+      parts.append(re.sub(r'([\\*`|]|_$)', r'\\\1', el['c']))
+    elif t in ('Space', 'SoftBreak', 'LineBreak'):
+      parts.append(u' ')
+    elif t in ('Strong', 'Emph'):
+      content = inlines_to_rst(el['c'])
+      if content is None:
+        return None
+      marker = u'**' if t == 'Strong' else u'*'
+      parts.append(marker + content + marker)
+    elif t == 'Span':
+      content = inlines_to_rst(el['c'][1])
+      if content is None:
+        return None
+      parts.append(content)
+    elif t in ('Superscript', 'Subscript'):
+      content = inlines_to_rst(el['c'])
+      if content is None:
+        return None
+      parts.append(u'\\ :%s:`%s`' % ('sup' if t == 'Superscript' else 'sub', content))
+    elif t == 'Math' and el['c'][0]['t'] == 'InlineMath':
+      parts.append(u':math:`%s`' % el['c'][1])
+    elif t == 'Code':
+      parts.append(u'``%s``' % el['c'][1])
+    elif t == 'RawInline' and el['c'][0] == 'rst':
+      parts.append(el['c'][1])
+    else:
+      return None
+  return u''.join(parts).strip()
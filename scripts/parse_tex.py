@@ -1,52 +1,322 @@
 # -*- coding: utf-8 -*-
+import argparse
+import bisect
+import collections
+import hashlib
+import io
+import json
 import os
 import re
 import shutil
+import subprocess
 import tempfile
+import textwrap
 
 import six
 from six.moves import range
 
+import benchmark_tables
+import output_manifest
+import phantom_matrices
+from figure_assets import FIGURE_OPTIONS
 
-def main():
-  tex_source_folder = '../ibsi-reference-manual'
-  tmp = tempfile.mkdtemp()
-  try:
-    shutil.copytree(tex_source_folder, os.path.join(tmp, 'ibsi-reference-manual'))
 
-    tex_source = os.path.join(tmp, 'ibsi-reference-manual', 'IBSIWorkDocument.tex')
-    feature_source = os.path.join(tex_source, '..', 'Chapters', 'FeatureDef.tex')
+# Bump this whenever a change to the converter alters the pandoc invocation, so cached chapters are not reused
+CACHE_VERSION = 1
+PANDOC_ARGS = ['--mathjax']
 
-    tex_data = read_tex_source(tex_source)
-    feature_data = read_tex_source(feature_source)
+# Default directory of the chapter and figure caches
+CACHE_ROOT = os.path.join(os.path.expanduser('~'), '.cache', 'ibsi-doc')
 
-    feature_class_codes, feature_codes = parse_feature_ids(feature_data)
-    other_codes = parse_other_ids(tex_data)
 
-    tex_data, inline_codes = update_inline_ids(tex_data)
-    with open(tex_source, mode='w') as tex_fs:
-      tex_fs.write(tex_data)
-    feature_data, feature_inline_codes = update_inline_ids(feature_data)
-    with open(feature_source, mode='w') as feature_fs:
-      feature_fs.write(feature_data)
+def main(source_dir=None, dest_dir='.', cache_dir=None, cache_size=64 * 1024 ** 2, jobs=1, engine='rst', profiler=None,
+         split_depth=0, split_chapters=None, figure_cache_dir=None, optimise_figures=True, structured_tables=True,
+         streaming=False, math_macros='expand'):
+  """
+  Convert the IBSI reference manual into the RST documents in ``dest_dir``: :py:func:`convert` followed by
+  :py:func:`write_conversion`.
 
-    fix_benchmark_tables(os.path.join(tmp, 'ibsi-reference-manual', 'benchmarks'))
+  When ``streaming``, every document is written as soon as it is converted, so the documents are never all held in
+  memory (see :py:func:`convert`).
 
-    figures = parse_tex_figures(tex_data)
-    chap_labels = get_chapter_labels(tex_data)
+  :param source_dir: Tex source tree (default: ``ibsi-reference-manual`` next to ``dest_dir``)
+  :param dest_dir: Documentation root
+  :param cache_dir: Directory of the cache of converted chapters (default: no cache)
+  :param figure_cache_dir: Directory of the cache of processed figures (default: no cache)
+  :param optimise_figures: If True, figures are processed into ``dest_dir`` (see :py:func:`convert`)
 
-    output = parse_input(tex_source)
-    if output is None or output == '':
-      raise ValueError('Empty output was returned!')
-    output = output.replace('\r', '')
+  See :py:func:`convert` for the other parameters.
+  """
+  if source_dir is None:
+    source_dir = os.path.join(os.path.abspath(dest_dir), os.pardir, 'ibsi-reference-manual')
+  figure_cache = None
+  if optimise_figures and figure_cache_dir is not None:
+    import figure_assets
+    figure_cache = figure_assets.FigureCache(figure_cache_dir)
+
+  manifest = output_manifest.Manifest(dest_dir) if streaming else None
+  conversion = convert(source_dir, cache=None if cache_dir is None else PandocCache(cache_dir, cache_size), jobs=jobs,
+                       engine=engine, profiler=profiler, split_depth=split_depth, split_chapters=split_chapters,
+                       figure_dest_dir=dest_dir if optimise_figures else None, figure_cache=figure_cache,
+                       structured_tables=structured_tables, bibliography=os.path.join(dest_dir, 'Bibliography.bib'),
+                       streaming=streaming, on_document=None if manifest is None else manifest.write,
+                       math_macros=math_macros)
+  write_conversion(conversion, dest_dir, profiler, manifest)
+  for key in conversion.unresolved_citations:
+    print('WARNING: Citation key %s (cited in section %s) is not found in the bibliography' %
+          (key, conversion.cited_keys[key]))
+  return conversion
+
+
+class Conversion(object):
+  """
+  Result of :py:func:`convert`, held in memory.
+
+  :ivar documents: OrderedDict of document name: RST text, in order (empty if the documents were passed to the
+    ``on_document`` callback of :py:func:`convert` instead)
+  :ivar index: RST text of the index document
+  :ivar footnotes: dict of footnote number: footnote text
+  :ivar code_index: :py:class:`CodeIndex` of the IBSI codes
+  :ivar cited_keys: dict of cited bibliography key: title of the first section citing it
+  :ivar bib_files: paths of the source bibliography files
+  :ivar bibliography: text of the pruned bibliography (see :py:func:`prune_bibliography`)
+  :ivar n_bib_entries: number of entries in the pruned bibliography
+  :ivar unresolved_citations: sorted list of the cited keys that are not found in the bibliography
+  :ivar reference_values: reference value records of the benchmark tables, or None if the tables were not parsed
+  :ivar data_files: dict of file name (relative to the documentation root): contents (bytes) of the texture matrices
+    of the digital phantom
+  :ivar figures: figure data (result of :py:func:`parse_tex_figures`)
+  :ivar math_macro_definitions: definitions of the math macros (see :py:func:`get_math_macro_definitions`), or None
+    if the macros were expanded
+  :ivar sources: dict of output file name (see :py:meth:`get_files`): list of the Tex source files it is derived from,
+    relative to the source tree
+  """
+
+  def __init__(self):
+    self.documents = collections.OrderedDict()
+    self.index = None
+    self.footnotes = {}
+    self.code_index = None
+    self.cited_keys = {}
+    self.bib_files = []
+    self.bibliography = None
+    self.n_bib_entries = 0
+    self.unresolved_citations = []
+    self.reference_values = None
+    self.data_files = {}
+    self.figures = {}
+    self.math_macro_definitions = None
+    self.sources = {}
+
+  def get_files(self):
+    """
+    :return: list of (file name relative to the documentation root, contents (bytes), source files) of all outputs
+    """
+    files = [(name + '.rst', text.encode('utf-8')) for name, text in six.iteritems(self.documents)]
+    files.append(('index.rst', self.index.encode('utf-8')))
+    files.append((PRUNED_BIBLIOGRAPHY, self.bibliography.encode('utf-8')))
+    files.append((CODE_INDEX_FILE, self.code_index.dump()))
+    if self.reference_values is not None:
+      files += benchmark_tables.dump_reference_values(self.reference_values)
+    files += sorted(six.iteritems(self.data_files))
+    if self.math_macro_definitions is not None:
+      files.append((MATH_MACROS_FILE, (json.dumps(self.math_macro_definitions, indent=2, sort_keys=True) +
+                                       '\n').encode('utf-8')))
+    return [(name, data, self.sources.get(name, [])) for name, data in files]
+
+
+def convert(source_dir, cache=None, jobs=1, engine='rst', profiler=None, split_depth=0, split_chapters=None,
+            figure_dest_dir=None, figure_cache=None, structured_tables=True, bibliography=None, streaming=False,
+            on_document=None, math_macros='expand'):
+  """
+  Convert the IBSI reference manual in memory.
+
+  The source tree is only read, and the working directory and environment are left as they are, so conversions can
+  run concurrently in one process (e.g. in a thread pool). The only files written are the processed figures (if
+  ``figure_dest_dir`` is set) and the cache entries.
+
+  By default, pandoc converts the whole document before it is edited and split into sections. When ``streaming``,
+  pandoc converts the document chapter by chapter (see :py:func:`iter_chapter_outputs`), and every chapter is edited,
+  split and processed before the next one is read, so only about one chapter is held in memory at a time. Footnotes
+  are defined at the end of the pandoc output of every chapter, so a chapter is the smallest part of the output that
+  can be edited on its own. Chapters defining labels that other chapters reference are converted first, and held in
+  memory until they are processed unless a ``cache`` is passed. As for any conversion by chapter (i.e. with a cache or
+  several ``jobs``), the documents are the same as those of a conversion of the whole document (see
+  :py:class:`ChapterPlan`).
+
+  :param source_dir: Tex source tree, holding ``IBSIWorkDocument.tex``
+  :param cache: :py:class:`PandocCache` of converted chapters (default: no cache). Unless ``jobs`` is larger than 1,
+    the whole document is then converted in a single pandoc run (unless ``streaming``). The output is the same either
+    way.
+  :param jobs: Number of chapters (and figures) to convert concurrently
+  :param engine: ``'rst'`` corrects the RST output of pandoc line by line, ``'ast'`` corrects the pandoc JSON AST
+  :param profiler: :py:class:`profiler.Profiler` recording the timing and counters of every stage (default: none)
+
+  :param split_depth: Deepest header level at which the output is split into separate documents (0: chapters only,
+    1: also sections, etc.). Each document lists the documents of its subsections in a toctree. The first chapter,
+    which ``index.rst`` includes, is never split below chapter level.
+  :param split_chapters: Titles of the chapters to split below chapter level (default: all chapters but the first)
+
+  :param figure_dest_dir: If set, figures are rasterised, recompressed and measured, and WebP variants are made (see
+    :py:mod:`figure_assets`), into this directory (the documentation root). Figures are processed by ``jobs`` worker
+    processes.
+  :param figure_cache: :py:class:`figure_assets.FigureCache` of processed figures (default: no cache)
+
+  :param structured_tables: If True, the benchmark tables are parsed into reference value records, written as RST
+    tables (see :py:mod:`benchmark_tables`). Only tables that cannot be parsed are converted by pandoc.
+  :param bibliography: bibtex file to use if the Tex document does not name one (default: ``Bibliography.bib`` in
+    ``source_dir``)
+
+  :param streaming: If True, the document is converted and processed chapter by chapter (rst engine only)
+  :param on_document: If passed, called with the file name (relative to the documentation root), contents (bytes) and
+    source files of every document as soon as it is complete (e.g. :py:meth:`output_manifest.Manifest.write`),
+    instead of storing the documents in the :py:class:`Conversion`
+
+  :param math_macros: ``'expand'`` replaces the macros of :py:data:`MATH_MACROS` by their definitions in the text,
+    ``'define'`` leaves them as they are, and stores their definitions for MathJax and KaTeX in
+    :py:attr:`Conversion.math_macro_definitions` (written to :py:data:`MATH_MACROS_FILE`, which ``conf.py`` loads)
+  :return: :py:class:`Conversion`
+  """
+  if profiler is None:
+    from profiler import Profiler
+    profiler = Profiler(enabled=False)
 
-    output, footnotes = get_footnotes(output)
+  if math_macros not in ('expand', 'define'):
+    raise ValueError('Unknown math macros mode: %s' % math_macros)
 
-    output = correct_tables(output)
-    output = parse_chapter_refs(output, chap_labels)
+  tex_source_folder = os.path.abspath(source_dir)
+  conversion = Conversion()
+
+  # The source tree is only read. The files rewritten below are written to a sparse overlay directory, in which pandoc
+  # is run. Pandoc looks up any other included file in the overlay first, then in the source tree (TEXINPUTS).
+  overlay = tempfile.mkdtemp()
+  texinputs = [overlay, tex_source_folder]
+  try:
+    tex_source = os.path.join(overlay, 'IBSIWorkDocument.tex')
+    feature_source = os.path.join(overlay, 'Chapters', 'FeatureDef.tex')
+
+    with profiler.stage('read_tex_source') as stage:
+      tex_data = read_tex_source(os.path.join(tex_source_folder, 'IBSIWorkDocument.tex'))
+      feature_data = read_tex_source(os.path.join(tex_source_folder, 'Chapters', 'FeatureDef.tex'))
+      stage.count(files=2, lines=tex_data.count('\n') + feature_data.count('\n'),
+                  bytes_read=len(tex_data) + len(feature_data))
+
+    with profiler.stage('parse_ids') as stage:
+      feature_class_codes, feature_codes = parse_feature_ids(feature_data)
+      other_codes = parse_other_ids(tex_data)
+      stage.count(matches=len(feature_class_codes) + len(feature_codes) + len(other_codes))
+
+    with profiler.stage('update_inline_ids') as stage:
+      tex_data, inline_codes = update_inline_ids(tex_data)
+      feature_data, feature_inline_codes = update_inline_ids(feature_data)
+      stage.count(lines=tex_data.count('\n') + feature_data.count('\n'),
+                  inline_ids=len(inline_codes) + len(feature_inline_codes))
+
+    with profiler.stage('write_overlay') as stage:
+      write_overlay_file(tex_source, tex_data)
+      write_overlay_file(feature_source, feature_data)
+      stage.count(files=2, bytes_written=len(tex_data) + len(feature_data))
+
+    benchmark_dir = os.path.join(tex_source_folder, benchmark_tables.BENCHMARK_DIR)
+    tables = {}
+    unparsed = None
+    if structured_tables:
+      # The parsed tables are replaced by markers in the source passed to pandoc
+      with profiler.stage('read_benchmark_tables') as stage:
+        tables, unparsed = benchmark_tables.read_benchmark_tables(
+          benchmark_dir, benchmark_tables.get_benchmark_features([tex_data, feature_data]))
+        for name in tables:
+          write_overlay_file(os.path.join(overlay, benchmark_tables.BENCHMARK_DIR, name + '.tex'),
+                             benchmark_tables.get_marker(name))
+        stage.count(files=len(tables) + len(unparsed), tables=len(tables),
+                    rows=sum(len(t['rows']) for t in six.itervalues(tables)))
+
+    with profiler.stage('fix_benchmark_tables') as stage:
+      n_read, n_written = fix_benchmark_tables(benchmark_dir, os.path.join(overlay, benchmark_tables.BENCHMARK_DIR),
+                                               unparsed)
+      stage.count(files=n_read, replacements=n_written)
+
+    with profiler.stage('parse_tex_figures') as stage:
+      figures = parse_tex_figures(tex_data)
+      chap_labels = get_chapter_labels(tex_data)
+      stage.count(figures=len(figures), chapter_labels=len(chap_labels))
+    conversion.figures = figures
+
+    with profiler.stage('get_sources') as stage:
+      chapter_sources, all_sources = get_chapter_sources(tex_data, tex_source_folder)
+      stage.count(chapters=len(chapter_sources), files=len(all_sources))
+
+    if figure_dest_dir is not None:
+      with profiler.stage('optimise_figures') as stage:
+        import figure_assets
+        stage.count(**figure_assets.optimise_figures(figures, get_tex_search_dirs(tex_source_folder, []),
+                                                     figure_dest_dir, figure_cache, jobs))
+      for fig_data in six.itervalues(figures):
+        fig_data['loading'] = 'lazy'
+
+    if streaming:
+      if engine != 'rst':
+        raise ValueError('Only the rst engine can convert the document chapter by chapter')
+      outputs = (chapter_output + '\n' for chapter_output in
+                 iter_chapter_outputs(tex_source, tex_data, cache, jobs, texinputs, profiler))
+    else:
+      with profiler.stage('pandoc') as stage:
+        if engine == 'ast':
+          output = convert_ast(tex_source, figures, chap_labels, texinputs, math_macros == 'expand')
+        elif cache is None and jobs == 1:
+          output = parse_input(tex_source, texinputs=texinputs)
+        else:
+          output = convert_chapters(tex_source, tex_data, cache, jobs, texinputs)
+        if output is None or output == '':
+          raise ValueError('Empty output was returned!')
+        output = output.replace('\r', '')
+        stage.count(lines=output.count('\n'), bytes=len(output))
+      outputs = [output]
+      del output
+
+    footnotes = conversion.footnotes
+    footnote_lines = []  # (line index among all lines of the output, footnote number)
+    splitter = SectionSplitter(feature_class_codes, feature_codes, other_codes, ['=', '-'], split_depth,
+                               split_chapters)
+
+    def iter_sections():
+      # The outputs of the chapters end with a newline, so their lines add up to the lines of the whole output
+      for output_idx, output in enumerate(outputs):
+        output_name = 'chapter %i' % output_idx if streaming else None
+        first_line = splitter.n_lines
+
+        # Document level edits are collected first and applied in one go
+        buffer = EditBuffer(output)
+        with profiler.stage('edit_footnotes', output_name) as stage:
+          output_footnotes = edit_footnotes(buffer)
+          stage.count(lines=output.count('\n'), matches=len(output_footnotes) + len(buffer.footnote_refs),
+                      replacements=len(output_footnotes))
+        footnotes.update(output_footnotes)
+        with profiler.stage('edit_benchmark_tables', output_name) as stage:
+          stage.count(replacements=benchmark_tables.edit_benchmark_tables(buffer, tables))
+        if engine == 'rst':
+          with profiler.stage('edit_chapter_refs', output_name) as stage:
+            stage.count(replacements=edit_chapter_refs(buffer, chap_labels))
+          with profiler.stage('edit_tables', output_name) as stage:
+            stage.count(lines=output.count('\n'), replacements=edit_tables(buffer))
+        with profiler.stage('apply_edits', output_name) as stage:
+          output = buffer.apply()
+          footnote_lines.extend((first_line + line_idx, no) for line_idx, no in buffer.get_footnote_lines())
+          stage.count(edits=len(buffer.edits), bytes=len(output))
+        del buffer
+
+        with profiler.stage('split_sections', output_name) as stage:
+          output_lines = output.split('\n')
+          del output
+          sections = list(splitter.feed(output_lines))
+          stage.count(lines=len(output_lines), sections=len(sections), codes=sum(len(s[4]) for s in sections))
+        del output_lines
+        for section in sections:
+          yield section
+        del sections
+      for section in splitter.close():
+        yield section
 
-    output_lines = output.split('\n')
-    hdr_chars = ['=', '-']
     index = [
       '',
       'Contents',
@@ -62,173 +332,1083 @@ def main():
       ''
       ]
 
-    cnt = 0
+    cited_keys = conversion.cited_keys  # key: title of the first section citing it
+    code_index = conversion.code_index = CodeIndex(feature_class_codes, feature_codes)
+    matrix_files = conversion.data_files  # data file: contents
+    documents = SectionDocuments()
+    # Documents of the sections that may still get subsections: (section index, text, footnotes text)
+    unfinished = []
+
+    def store_document(sec_idx, text, footnotes_text):
+      # Sections split off at a deeper level are listed in the document of their parent section
+      toctree = documents.get_toctree(sec_idx)
+      if len(toctree) > 0:
+        text += u'\n' + u'\n'.join(toctree)
+      text += footnotes_text
+      dest_name = documents.names[sec_idx]
+      if on_document is None:
+        conversion.documents[dest_name] = text
+      else:
+        on_document(dest_name + '.rst', text.encode('utf-8'), conversion.sources[dest_name + '.rst'])
+
+    chapter_name = None
+    for start, title_line, section, level, code_dict in iter_sections():
+      section_name = section[title_line - start]
+      end = start + len(section)
+      if level == 0:
+        chapter_name = section_name
+      sec_idx, dest_name = documents.add(section_name, level)
+      while len(unfinished) > 0 and documents.levels[unfinished[-1][0]] >= level:
+        store_document(*unfinished.pop())
+
+      # Every header with an IBSI code gets a label (ibsi_<code>), the target of the :ibsi: role
+      for line in sorted(code_dict.keys(), reverse=True):
+        section.insert(line + 2, '.. raw:: html\n\n  <p style="color:grey;font-style:italic;text-align:right">%s</p>' % code_dict[line][0])
+        section.insert(line, '.. _%s:\n' % get_code_label(code_dict[line][0]))
+      # The first chapter is only built as part of the index, which includes it (see conf.py)
+      code_index.add_section('index' if sec_idx == 0 else dest_name,
+                             [code_dict[line] for line in sorted(code_dict.keys())])
+
+      # The texture matrices of the digital phantom are stored as data files, rendered by the phantom-matrices directive
+      if chapter_name is not None and chapter_name.lower() == phantom_matrices.PHANTOM_CHAPTER:
+        with profiler.stage('phantom_matrices', section_name) as stage:
+          n_files = len(matrix_files)
+          section, _ = phantom_matrices.extract_matrices(section, matrix_files)
+          stage.count(lines=end - start, files=len(matrix_files) - n_files)
+        for fname in matrix_files:
+          conversion.sources.setdefault(fname, chapter_sources.get(chapter_name.lower(), all_sources))
+
+      if engine == 'rst':
+        with profiler.stage('transform_section', section_name) as stage:
+          transformer = SectionTransformer(figures, math_macros == 'expand')
+          section = transformer.transform(section)
+          stage.count(lines=end - start, **transformer.counts)
+
+      print('Storing section %s' % section_name)
+
+      if sec_idx == 0:
+        index.insert(0, '.. include:: %s.rst' % dest_name)
+      elif level == 0:
+        index.append('   %s <%s>' % (section_name, dest_name))
+
+      # Check if this chapter has a label in the source. If so, also add a label in the rst document (unless pandoc
+      # already wrote it above the header)
+      section_title = section_name.lower()
+      if section_title in chap_labels and '.. _%s:' % chap_labels[section_title] not in section[:title_line - start]:
+        section.insert(0, '.. _%s:\n' % chap_labels[section_title])
 
-    footnote_ref_pattern = re.compile('\[(?P<no>\d+)\]_')
+      with profiler.stage('store_section', section_name) as stage:
+        out_str = u'\n'.join(section)
+        del section
+
+        section_end = bisect.bisect_left(footnote_lines, (end,))
+        section_footnotes = sorted(no for line_idx, no in footnote_lines[bisect.bisect_left(footnote_lines, (start,)):
+                                                                         section_end])
+        del footnote_lines[:section_end]
+        footnotes_text = u''.join(format_footnote(sf, footnotes[sf]) for sf in section_footnotes)
+        for key in get_cited_keys(out_str + footnotes_text):
+          cited_keys.setdefault(key, section_name)
+        conversion.sources[dest_name + '.rst'] = chapter_sources.get(chapter_name.lower(), all_sources)
+        if on_document is None:
+          conversion.documents[dest_name] = None  # Keeps the documents in order, if subsections are stored first
+        # Only sections above the split depth can have subsections
+        if level < split_depth:
+          unfinished.append((sec_idx, out_str, footnotes_text))
+        else:
+          store_document(sec_idx, out_str, footnotes_text)
+        stage.count(footnotes=len(section_footnotes), bytes=len(out_str) + len(footnotes_text))
 
-    for section, code_dict in split_sections(output_lines, feature_class_codes, feature_codes, other_codes, hdr_chars):
+    while len(unfinished) > 0:
+      store_document(*unfinished.pop())
 
-      for line in sorted(code_dict.keys(), reverse=True):
-        section.insert(line + 2, '.. raw:: html\n\n  <p style="color:grey;font-style:italic;text-align:right">%s</p>' % code_dict[line][0])
+    index.append('   References')
+    index.append('')
+    conversion.index = u'\n'.join(index)
+    conversion.sources['index.rst'] = all_sources[:1]
+    if math_macros == 'define':
+      conversion.math_macro_definitions = get_math_macro_definitions()
+      conversion.sources[MATH_MACROS_FILE] = all_sources[:1]
+    conversion.sources[CODE_INDEX_FILE] = [all_sources[0], 'Chapters/FeatureDef.tex']
+
+    # Only the cited entries are passed to sphinxcontrib-bibtex, which would otherwise parse the whole bibliography on
+    # every build. Keys missing from the bibliography are reported now rather than by Sphinx.
+    with profiler.stage('prune_bibliography') as stage:
+      conversion.bib_files = find_bibliography(tex_data, get_tex_search_dirs(tex_source_folder, texinputs),
+                                               bibliography or os.path.join(tex_source_folder, 'Bibliography.bib'))
+      conversion.bibliography, conversion.n_bib_entries, conversion.unresolved_citations = \
+        prune_bibliography(conversion.bib_files, cited_keys)
+      stage.count(citations=len(cited_keys), entries=conversion.n_bib_entries,
+                  unresolved=len(conversion.unresolved_citations))
+    conversion.sources[PRUNED_BIBLIOGRAPHY] = all_sources + [
+      os.path.relpath(f, tex_source_folder).replace(os.sep, '/') for f in conversion.bib_files]
+
+    if structured_tables:
+      with profiler.stage('get_reference_values') as stage:
+        conversion.reference_values = benchmark_tables.get_records(tables)
+        stage.count(records=len(conversion.reference_values))
+      for ext in ('.json', '.csv'):
+        conversion.sources[benchmark_tables.REFERENCE_VALUES + ext] = ['%s/%s.tex' % (benchmark_tables.BENCHMARK_DIR, name) for name in tables]
+  finally:
+    shutil.rmtree(overlay)
+  return conversion
 
-      process_citations(section)
-      fix_math_indent(section)
-      fix_math_formula(section)
-      fix_figures(section, figures)
-      fix_numbered_lists(section)
 
-      print('Storing section %s' % section[0])
+def write_conversion(conversion, dest_dir='.', profiler=None, manifest=None):
+  """
+  Write the output of a conversion to the documentation root, and record it in the manifest (see
+  :py:mod:`output_manifest`). Files that did not change are not written, so Sphinx does not read them again, and the
+  files of a previous conversion that are no longer produced are removed.
+
+  :param conversion: :py:class:`Conversion`
+  :param dest_dir: documentation root
+  :param profiler: :py:class:`profiler.Profiler` recording the timing and counters of every stage (default: none)
+  :param manifest: :py:class:`output_manifest.Manifest` the documents were already written to (see the
+    ``on_document`` parameter of :py:func:`convert`), or None
+  :return: sorted list of the names of the removed files
+  """
+  if profiler is None:
+    from profiler import Profiler
+    profiler = Profiler(enabled=False)
+
+  with profiler.stage('write_output') as stage:
+    if manifest is None:
+      manifest = output_manifest.Manifest(dest_dir)
+    for name, data, sources in conversion.get_files():
+      manifest.write(name, data, sources)
+    removed = manifest.remove_stale()
+    manifest.save()
+    stage.count(**manifest.counts)
+
+  print('Stored %i cited entries of %s in %s' % (conversion.n_bib_entries, ', '.join(conversion.bib_files),
+                                                 PRUNED_BIBLIOGRAPHY))
+  print('Wrote %i of %i files' % (manifest.counts['files_written'], manifest.counts['files']))
+  for name in removed:
+    print('Removed %s, which is no longer produced' % name)
+  return removed
+
+
+def run_pandoc(args, input_data=None, cwd=None, texinputs=None):
+  """
+  Run pandoc in its own process, with its working directory and ``TEXINPUTS`` set for this run only (pypandoc cannot
+  set either), so conversions can run concurrently.
+
+  :param args: arguments of pandoc
+  :param input_data: text passed to pandoc on stdin (default: none)
+  :param cwd: directory to run pandoc in (default: the current directory)
+  :param texinputs: directories in which pandoc looks for included Tex files (default: as in the environment)
+  :return: output of pandoc (string)
+  """
+  import pypandoc
 
-      dest_name = section[0].replace(' ', '_')
-      if cnt > 0:
-        dest_name = '%-.2i_' % cnt + dest_name
+  env = None
+  if texinputs is not None:
+    env = dict(os.environ)
+    env['TEXINPUTS'] = os.pathsep.join(texinputs)
+  proc = subprocess.Popen([pypandoc.get_pandoc_path()] + list(args), cwd=cwd, env=env, stdin=subprocess.PIPE,
+                          stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+  out, err = proc.communicate(None if input_data is None else input_data.encode('utf-8'))
+  if proc.returncode != 0:
+    raise RuntimeError('Pandoc exited with code %i: %s' % (proc.returncode, err.decode('utf-8', 'replace').strip()))
+  return out.decode('utf-8')
 
-      cnt += 1
 
-      if cnt == 1:
-        index.insert(0, '.. include:: %s.rst' % str(dest_name))
-      else:
-        index.append('   %s <%s>' % (section[0], dest_name))
+def parse_input(source_file, to='rst', texinputs=None):
+  """
+  Convert a Tex file with pandoc, run in the directory of the file.
 
-      # Check if this chapter has a label in the source. If so, also add a label in the rst document
-      section_title = section[0].lower()
-      if section_title in chap_labels:
-        section.insert(0, '.. _%s:\n' % chap_labels[section_title])
+  :param texinputs: directories in which pandoc looks for included Tex files, after the directory of the file
+  :return: output of pandoc (string)
+  """
+  source_dir = os.path.dirname(os.path.abspath(source_file))
+  if not os.path.isdir(source_dir):
+    raise ValueError('Directory "%s" does not exist, cannot convert' % source_dir)
 
-      out_str = u'\n'.join(section).encode('utf-8')
+  return run_pandoc(['--from', 'latex', '--to', to] + PANDOC_ARGS + [os.path.basename(source_file)], cwd=source_dir,
+                    texinputs=texinputs)
 
-      section_footnotes = sorted([int(m.groupdict()['no']) for m in footnote_ref_pattern.finditer(out_str)])
-      footer = ''
-      for sf in section_footnotes:
-        footer += u'\n.. [%i]\n   %s\n' % (sf, footnotes[sf])
 
-      with open(dest_name + '.rst', mode='wb') as out_fs:
-        out_fs.write(out_str)
-        out_fs.write(footer)
+def convert_ast(tex_source, figures, chap_labels, texinputs=None, expand_macros=True):
+  """
+  Convert the source document through the pandoc JSON AST.
 
-    index.append('   References')
-    index.append('')
+  The document is read by pandoc once, corrected as a tree (see :py:mod:`pandoc_ast`) and serialised to RST once, so
+  none of the line based fixes (citations, math, figures, tables and chapter references) are needed afterwards.
 
-    with open('index.rst', mode='w') as index_fs:
-      out_str = u'\n'.join(index).encode('utf-8')
-      index_fs.write(out_str)
+  :param tex_source: Tex base file of the IBSI document
+  :param figures: figure data (result of py:func:`parse_tex_figures`)
+  :param chap_labels: chapter labels (result of py:func:`get_chapter_labels`)
+  :param texinputs: directories in which pandoc looks for included Tex files (see :py:func:`parse_input`)
+  :param expand_macros: If False, math macros are left as they are (see :py:func:`get_math_macro_definitions`)
+  :return: RST output (string)
+  """
+  import pandoc_ast
 
-    print (hdr_chars)
-  finally:
-    shutil.rmtree(tmp)
+  doc = json.loads(parse_input(tex_source, to='json', texinputs=texinputs))
+  doc = pandoc_ast.rewrite_document(doc, figures, chap_labels, expand_math_macros if expand_macros else None)
+  return run_pandoc(['--from', 'json', '--to', 'rst'] + PANDOC_ARGS, input_data=json.dumps(doc))
 
 
-def parse_input(source_file):
-  import pypandoc
+def split_tex_chapters(tex_data):
+  """
+  Split the source document into the preamble and its top-level chapters.
 
-  print('PyPandoc version: %s' % pypandoc.__version__)
+  The preamble runs up to and including ``\\begin{document}``, so each chapter can be converted on its own with all
+  macro definitions available. Text before the first ``\\chapter`` is returned as the first chapter. If the document
+  has no ``\\begin{document}``, the whole document is returned as a single chapter with an empty preamble.
 
-  current_dir = os.path.abspath(os.path.curdir)
-  source_dir = os.path.dirname(source_file)
+  :param tex_data: Source document contents (result of py:func:`read_tex_source`)
+  :return: tuple of the preamble (string) and the list of chapter sources (list of strings)
+  """
+  begin = re.search(r'^[ \t]*\\begin\{document\}.*\n', tex_data, flags=re.MULTILINE)
+  end = re.search(r'^[ \t]*\\end\{document\}', tex_data, flags=re.MULTILINE)
+  if begin is None:
+    return '', [tex_data]
 
-  if not os.path.isdir(source_dir):
-    raise ValueError('Directory "%s" does not exist, cannot convert')
+  preamble = tex_data[:begin.end()]
+  body = tex_data[begin.end():end.start() if end else len(tex_data)]
+
+  starts = [m.start() for m in re.finditer(r'^[ \t]*\\chapter\*?[\[{]', body, flags=re.MULTILINE)]
+  if len(starts) == 0 or starts[0] > 0:
+    starts.insert(0, 0)
+  starts.append(len(body))
+
+  return preamble, [body[s:e] for s, e in zip(starts[:-1], starts[1:])]
+
+
+def get_tex_search_dirs(source_dir, texinputs=None):
+  """
+  Get the directories in which pandoc looks for files included by ``\\input`` or ``\\include``: the directory it is
+  run in, followed by the directories of ``TEXINPUTS``.
+
+  :param source_dir: Directory pandoc is run in
+  :param texinputs: Directories pandoc is given as ``TEXINPUTS`` (default: as in the environment)
+  :return: list of directories
+  """
+  if texinputs is None:
+    texinputs = os.environ.get('TEXINPUTS', '').split(os.pathsep)
+  search_dirs = [source_dir]
+  for d in texinputs:
+    if d != '' and d not in search_dirs:
+      search_dirs.append(d)
+  return search_dirs
+
+
+def find_tex_file(fname, search_dirs):
+  """
+  :return: path of ``fname`` in the first of ``search_dirs`` that holds it, or None if it is not found
+  """
+  for d in search_dirs:
+    if os.path.isfile(os.path.join(d, fname)):
+      return os.path.join(d, fname)
+  return None
+
+
+def get_tex_dependencies(tex_data, search_dirs, _seen=None):
+  """
+  Find all files included by ``\\input`` or ``\\include`` in the passed Tex, recursively.
+
+  :param tex_data: Tex contents to scan
+  :param search_dirs: Directories against which include paths are resolved, in order (see
+    py:func:`get_tex_search_dirs`)
+  :return: list of tuples of the include path and the path of the existing included file, in order of first inclusion
+  """
+  if _seen is None:
+    _seen = []
+  for match in re.finditer(r'^[^%\n]*?\\(input|include)\{(?P<fname>[^}]+)\}', tex_data, flags=re.MULTILINE):
+    fname = match.groupdict()['fname'].strip()
+    if not fname.endswith('.tex'):
+      fname += '.tex'
+    fname = os.path.normpath(fname)
+    if fname in [s[0] for s in _seen]:
+      continue
+    path = find_tex_file(fname, search_dirs)
+    if path is None:
+      continue
+    _seen.append((fname, path))
+    get_tex_dependencies(read_tex_source(path), search_dirs, _seen)
+  return _seen
+
+
+CHAPTER_TITLE_PATTERN = re.compile(r'\\chapter\*?(\[[^\]]*\])?\{(?P<Title>[^}]*)\}')
+
+
+def get_chapter_sources(tex_data, source_dir, base_name='IBSIWorkDocument.tex'):
+  """
+  Find the source files of every chapter: the base document, and the files included by the preamble and the chapter.
+
+  :param tex_data: Source document contents (result of py:func:`read_tex_source`)
+  :param source_dir: Tex source tree
+  :return: tuple of the dict of chapter title (in lower case): list of source files, and the list of all source files
+    (the base document first). Source files are relative to ``source_dir``, with ``/`` as separator.
+  """
+  def get_sources(tex):
+    return [base_name] + [d.replace(os.sep, '/') for d, _ in get_tex_dependencies(tex, [source_dir])]
+
+  preamble, chapters = split_tex_chapters(tex_data)
+  chapter_sources = {}
+  for chapter_tex in chapters:
+    match = CHAPTER_TITLE_PATTERN.search(chapter_tex)
+    if match is not None:
+      chapter_sources[match.group('Title').strip().lower()] = get_sources(preamble + chapter_tex)
+  return chapter_sources, get_sources(tex_data)
+
+
+def get_chapter_key(preamble, chapter_tex, search_dirs, pandoc_version):
+  """
+  Compute the content address of a chapter conversion.
+
+  The key covers the converter settings, the pandoc version, the preamble (macro definitions), the chapter source and
+  the contents of every file it (transitively) includes.
+
+  :return: hex digest (string)
+  """
+  h = hashlib.sha1()
+  for part in [str(CACHE_VERSION), pandoc_version, ' '.join(PANDOC_ARGS), preamble, chapter_tex]:
+    h.update(part.encode('utf-8'))
+    h.update(b'\0')
+  for dep, path in get_tex_dependencies(chapter_tex, search_dirs):
+    h.update(dep.encode('utf-8'))
+    h.update(b'\0')
+    with open(path, mode='rb') as dep_fs:
+      h.update(dep_fs.read())
+    h.update(b'\0')
+  return h.hexdigest()
+
+
+class PandocCache(object):
+  """
+  On-disk, content-addressed store of pandoc results, one file per chapter.
+
+  Entries are evicted least-recently-used first once the total size of the cache exceeds ``max_size`` bytes. A cache
+  hit refreshes the modification time of the entry, which is used as its last-used time.
+  """
+
+  def __init__(self, cache_dir, max_size=64 * 1024 ** 2):
+    self.cache_dir = cache_dir
+    self.max_size = max_size
+    if not os.path.isdir(cache_dir):
+      os.makedirs(cache_dir)
+
+  def _path(self, key):
+    return os.path.join(self.cache_dir, key + '.rst')
+
+  def contains(self, key):
+    return os.path.isfile(self._path(key))
+
+  def get(self, key):
+    fname = self._path(key)
+    if not os.path.isfile(fname):
+      return None
+    os.utime(fname, None)
+    with open(fname, mode='rb') as cache_fs:
+      return cache_fs.read().decode('utf-8')
+
+  def put(self, key, value):
+    # Write to a temporary file first, so an interrupted run never leaves a truncated entry
+    fname = self._path(key)
+    # (with a name of its own, as concurrent conversions may store the same chapter)
+    tmp_fd, tmp_fname = tempfile.mkstemp(suffix='.tmp', dir=self.cache_dir)
+    with os.fdopen(tmp_fd, 'wb') as cache_fs:
+      cache_fs.write(value.encode('utf-8'))
+    if os.path.isfile(fname):
+      os.remove(fname)
+    os.rename(tmp_fname, fname)
+    self.evict()
+
+  def evict(self):
+    entries = []
+    for fname in os.listdir(self.cache_dir):
+      if fname.endswith('.rst'):
+        stat = os.stat(os.path.join(self.cache_dir, fname))
+        entries.append((stat.st_mtime, stat.st_size, fname))
+
+    total_size = sum(e[1] for e in entries)
+    for mtime, size, fname in sorted(entries):
+      if total_size <= self.max_size:
+        break
+      os.remove(os.path.join(self.cache_dir, fname))
+      total_size -= size
+
+
+def renumber_footnotes(output, offset):
+  """
+  Shift the auto-numbered footnotes in a pandoc result by ``offset``.
+
+  Pandoc numbers footnotes from 1 in every conversion, so separately converted chapters need renumbering before they
+  are joined into one document.
+
+  :return: tuple of the renumbered output and the highest footnote number found (0 if there are no footnotes)
+  """
+  numbers = [0]
+
+  def shift(match):
+    no = int(match.group(2))
+    numbers.append(no)
+    return '%s%i]' % (match.group(1), no + offset)
+
+  output = re.sub(r'(^\.\. \[)(\d+)\]', shift, output, flags=re.MULTILINE)
+  output = re.sub(r'(\[)(\d+)\](?=_)', shift, output)
+  return output, max(numbers)
 
-  if not (source_dir == '' or source_dir == '.'):
-    os.chdir(source_dir)
 
+CHAPTER_PADDING = 'IBSICHAPTERPADDING'
+LABEL_MAP_MARKER = 'IBSILABELMAP'
+NUMBERED_CHAPTER_PATTERN = re.compile(
+  r'^\s*\\chapter(\[[^\]]*\])?\{(?:[^{}]|\{[^{}]*\})*\}(\s*\\label\{(?P<Label>[^}]+)\})?')
+TEX_LABEL_PATTERN = re.compile(r'\\label\{(?P<Label>[^}]+)\}')
+TEX_REF_PATTERN = re.compile(r'\\ref\{(?P<Label>[^}]+)\}')
+TEX_INPUT_PATTERN = re.compile(r'^(?P<Before>[^%\n]*?)\\(input|include)\{(?P<fname>[^}]+)\}', re.MULTILINE)
+PADDING_PATTERN = re.compile(r'\A\s*(\.\. _[^\n]*:\n\n)?%s\n=+\n+' % CHAPTER_PADDING)
+LABEL_MAP_PATTERN = re.compile(r'\n*^%s\b(?P<Refs>(.|\n(?!\n))*)' % LABEL_MAP_MARKER, re.MULTILINE)
+REF_LINK_PATTERN = re.compile(r'`(?P<Text>[^`<]*?)\s+<#(?P<Label>[^>`]+)>`__')
+
+
+def expand_tex_inputs(tex_data, search_dirs):
+  """
+  Replace the ``\\input`` and ``\\include`` commands of the passed Tex by the contents of the included files,
+  recursively, as pandoc reads them. Files that are not found are left included.
+  """
+  def expand(match):
+    fname = match.group('fname').strip()
+    path = find_tex_file(os.path.normpath(fname if fname.endswith('.tex') else fname + '.tex'), search_dirs)
+    if path is None:
+      return match.group(0)
+    return match.group('Before') + expand_tex_inputs(read_tex_source(path), search_dirs)
+
+  return TEX_INPUT_PATTERN.sub(expand, tex_data)
+
+
+class ChapterPlan(object):
+  """
+  Sources of the chapters of a document converted chapter by chapter, so the numbers of the figures, sections, etc. and
+  the references between chapters are those of a conversion of the whole document.
+
+  Pandoc numbers the chapters of every conversion from 1, and cannot resolve references to labels of other chapters.
+  Every chapter is therefore converted after as many empty numbered chapters as there are numbered chapters before it
+  (which are removed from the output, see :py:meth:`finish`), and its references to the labels of other chapters are
+  replaced by links holding their numbers (``\\hyperref[label]{number}``), so pandoc writes and wraps them as it does
+  in a conversion of the whole document. The numbers of chapters are known from the source. Those of other labels are
+  written by pandoc when it converts the chapter that defines them, in a paragraph of references added to its source
+  (and removed from the output). Such a chapter is converted before the chapters referencing it (see
+  :py:meth:`is_resolved`).
+
+  :param preamble: preamble of the document (see :py:func:`split_tex_chapters`)
+  :param chapters: sources of the chapters
+  :param search_dirs: directories in which pandoc looks for included files (see :py:func:`get_tex_search_dirs`)
+  :ivar chapters: sources of the chapters converted separately: unnumbered chapters are converted with the chapter
+    before them
+  :ivar offsets: number of numbered chapters before every chapter
+  :ivar chapter_numbers: dict of label: number of the numbered chapters
+  :ivar exported: labels of every chapter that other chapters reference, and whose number pandoc has to write
+  """
+
+  def __init__(self, preamble, chapters, search_dirs):
+    # Pandoc only restarts the numbers of sections, figures, etc. at numbered chapters, so unnumbered chapters are
+    # converted with the chapter before them
+    self.chapters = []
+    for chapter_tex in chapters:
+      if len(self.chapters) > 0 and NUMBERED_CHAPTER_PATTERN.match(chapter_tex) is None:
+        self.chapters[-1] += chapter_tex
+      else:
+        self.chapters.append(chapter_tex)
+    self.preamble = preamble
+    self.search_dirs = search_dirs
+    self.offsets = []
+    self.chapter_numbers = {}
+    defined = []
+    referenced = []
+    n_numbered = 0
+    for chapter_tex in self.chapters:
+      self.offsets.append(n_numbered)
+      match = NUMBERED_CHAPTER_PATTERN.match(chapter_tex)
+      if match is not None:
+        n_numbered += 1
+        if match.group('Label') is not None:
+          self.chapter_numbers[match.group('Label')] = str(n_numbered)
+      text = '\n'.join([chapter_tex] + [read_tex_source(path) for _, path in
+                                        get_tex_dependencies(chapter_tex, search_dirs)])
+      defined.append(set(m.group('Label') for m in TEX_LABEL_PATTERN.finditer(text)))
+      referenced.append(set(m.group('Label') for m in TEX_REF_PATTERN.finditer(text)))
+
+    owners = {}
+    for chap_idx, labels in enumerate(defined):
+      for label in labels:
+        owners.setdefault(label, chap_idx)
+    # Labels of other chapters referenced by every chapter
+    self.imported = [set(l for l in labels if owners.get(l, chap_idx) != chap_idx)
+                     for chap_idx, labels in enumerate(referenced)]
+    self.exported = [set() for _ in self.chapters]
+    for labels in self.imported:
+      for label in labels:
+        if label not in self.chapter_numbers:
+          self.exported[owners[label]].add(label)
+
+  def is_resolved(self, chap_idx, numbers):
+    """
+    :param numbers: dict of label: number of the labels known so far
+    :return: True if the numbers of all labels of other chapters the chapter references are known
+    """
+    return all(label in numbers for label in self.imported[chap_idx])
+
+  def get_source(self, chap_idx, numbers):
+    """
+    :param numbers: dict of label: number of the labels known so far
+    :return: Tex source of the chapter, as it is converted (without the preamble)
+    """
+    chapter_tex = self.chapters[chap_idx]
+    refs = dict((label, numbers[label]) for label in self.imported[chap_idx]
+                if label in numbers and not numbers[label].startswith('['))
+    if len(refs) > 0:
+      # The references in included files are replaced too
+      chapter_tex = TEX_REF_PATTERN.sub(
+        lambda m: '\\hyperref[%s]{%s}' % (m.group('Label'), refs[m.group('Label')]) if m.group('Label') in refs else
+        m.group(0), expand_tex_inputs(chapter_tex, self.search_dirs))
+    parts = ['\\chapter{%s}\n' % CHAPTER_PADDING] * self.offsets[chap_idx] + [chapter_tex]
+    if len(self.exported[chap_idx]) > 0:
+      parts.append('\n\n%s %s\n' % (LABEL_MAP_MARKER, ' '.join('\\ref{%s}' % label
+                                                                for label in sorted(self.exported[chap_idx]))))
+    return ''.join(parts) + '\n\\end{document}\n'
+
+  def finish(self, chap_idx, output):
+    """
+    Remove the empty chapters and the paragraph of references from the output of a chapter.
+
+    :return: tuple of the output and a dict of label: number of the labels of the chapter other chapters reference
+    """
+    output = output.replace('\r', '')
+    for _ in range(self.offsets[chap_idx]):
+      output = PADDING_PATTERN.sub('', output, count=1)
+    numbers = {}
+    if len(self.exported[chap_idx]) > 0:
+      match = LABEL_MAP_PATTERN.search(output)
+      if match is None:
+        raise ValueError('The references to the labels of chapter %i were not found in its output' % chap_idx)
+      numbers = dict((m.group('Label'), m.group('Text')) for m in REF_LINK_PATTERN.finditer(match.group('Refs')))
+      output = output[:match.start()] + output[match.end():]
+    return output, numbers
+
+
+def convert_chapters(tex_source, tex_data, cache=None, jobs=1, texinputs=None):
+  """
+  Convert the source document chapter by chapter, reusing cached results of unchanged chapters.
+
+  The outputs of the chapters (see :py:func:`iter_chapter_outputs`) are joined in order. Numbers and references are
+  those of a conversion of the whole document (see :py:class:`ChapterPlan`).
+
+  :return: RST output (string)
+  """
+  return '\n\n'.join(iter_chapter_outputs(tex_source, tex_data, cache, jobs, texinputs)) + '\n'
+
+
+def iter_chapter_outputs(tex_source, tex_data, cache=None, jobs=1, texinputs=None, profiler=None):
+  """
+  Convert the source document chapter by chapter, reusing cached results of unchanged chapters.
+
+  Every chapter is converted as a standalone document that shares the preamble of the source document (see
+  :py:class:`ChapterPlan`). The chapters defining labels that other chapters reference are converted first. The other
+  chapters that are not cached are converted by up to ``jobs`` concurrent pandoc processes, which run ahead of the
+  chapter being returned by at most ``jobs`` chapters. Cached chapters are only read when they are returned.
+
+  :param tex_source: Tex base file of the IBSI document (its directory also holds the included chapters)
+  :param tex_data: Source document contents, as they should be converted
+  :param cache: :py:class:`PandocCache` to read from and store in, or None to convert all chapters
+  :param jobs: Number of pandoc processes to run concurrently
+  :param texinputs: directories in which pandoc looks for included Tex files (see :py:func:`parse_input`)
+  :param profiler: :py:class:`profiler.Profiler` recording the conversion of every chapter (default: none)
+  :return: generator of the RST output of each chapter with any output, in order, with footnotes renumbered and
+    without leading or trailing newlines
+  """
+  import pypandoc
+
+  if profiler is None:
+    from profiler import Profiler
+    profiler = Profiler(enabled=False)
+
+  source_dir = os.path.dirname(os.path.abspath(tex_source))
+  search_dirs = get_tex_search_dirs(source_dir, texinputs)
+  pandoc_version = pypandoc.get_pandoc_version()
+  preamble, chapters = split_tex_chapters(tex_data)
+  plan = ChapterPlan(preamble, chapters, search_dirs)
+  chapters = plan.chapters
+
+  def get_key(chapter_source):
+    return None if cache is None else get_chapter_key(preamble, chapter_source, search_dirs, pandoc_version)
+
+  def convert_chapter(chap_idx, chapter_source, key):
+    # Looked up again, as the entry may have been evicted (e.g. by a concurrent conversion) since it was found
+    chapter_output = None if key is None else cache.get(key)
+    if chapter_output is None:
+      source_file = os.path.join(source_dir, '_chapter_%02i.tex' % chap_idx)
+      with io.open(source_file, mode='w', encoding='utf-8') as chapter_fs:
+        chapter_fs.write(preamble + chapter_source)
+      chapter_output = parse_input(source_file, texinputs=texinputs).replace('\r', '')
+      if key is not None:
+        cache.put(key, chapter_output)
+    return chapter_output
+
+  pool = None
+  started = collections.deque()  # (chapter index, result) of the conversions started, in order
   try:
-    return pypandoc.convert_file(source_file, to='rst', extra_args=['--mathjax'])
+    # The chapters defining labels referenced by other chapters are converted first, as soon as the numbers of the
+    # labels they reference are known. If no chapter is, their references are broken by converting one of them twice.
+    numbers = dict(plan.chapter_numbers)
+    converted = {}  # chapter index: output of the chapters converted ahead
+    pending = [chap_idx for chap_idx in range(len(chapters)) if len(plan.exported[chap_idx]) > 0]
+    to_count = set()  # chapters that are not cached
+    while len(pending) > 0:
+      batch = [chap_idx for chap_idx in pending if plan.is_resolved(chap_idx, numbers)]
+      is_final = len(batch) > 0
+      if not is_final:
+        batch = pending[:1]
+      tasks = []
+      for chap_idx in batch:
+        chapter_source = plan.get_source(chap_idx, numbers)
+        tasks.append((chap_idx, chapter_source, get_key(chapter_source)))
+        if tasks[-1][2] is None or not cache.contains(tasks[-1][2]):
+          to_count.add(chap_idx)
+      if jobs > 1 and len(tasks) > 1:
+        from multiprocessing.pool import ThreadPool
+        pool = pool or ThreadPool(jobs)
+        outputs = pool.map(lambda task: convert_chapter(*task), tasks)
+      else:
+        outputs = [convert_chapter(*task) for task in tasks]
+      for chap_idx, chapter_output in zip(batch, outputs):
+        chapter_output, chapter_numbers = plan.finish(chap_idx, chapter_output)
+        numbers.update(chapter_numbers)
+        if is_final:
+          converted[chap_idx] = chapter_output
+      pending = [chap_idx for chap_idx in pending if chap_idx not in batch]
+
+    to_convert = collections.deque()
+    sources = [None] * len(chapters)
+    for chap_idx in range(len(chapters)):
+      if chap_idx in converted:
+        continue
+      chapter_source = plan.get_source(chap_idx, numbers)
+      key = get_key(chapter_source)
+      sources[chap_idx] = (chap_idx, chapter_source, key)
+      if key is None or not cache.contains(key):
+        to_convert.append(sources[chap_idx])
+        to_count.add(chap_idx)
+      else:
+        print('Using cached chapter %i (%s)' % (chap_idx, key))
+
+    print('Converting %i of %i chapters using %i process(es)' % (len(to_count), len(chapters), jobs))
+    if jobs > 1 and len(to_convert) > 1:
+      # Every chapter is converted by a pandoc process of its own, so threads suffice to run them concurrently
+      from multiprocessing.pool import ThreadPool
+      pool = pool or ThreadPool(jobs)
+
+    def start_conversions():
+      while pool is not None and len(to_convert) > 0 and len(started) < jobs:
+        task = to_convert.popleft()
+        started.append((task[0], pool.apply_async(convert_chapter, task)))
+
+    start_conversions()
+    footnote_offset = 0
+    for chap_idx in range(len(chapters)):
+      with profiler.stage('pandoc', 'chapter %i' % chap_idx) as stage:
+        if chap_idx in converted:
+          chapter_output = converted.pop(chap_idx)
+        else:
+          if len(started) > 0 and started[0][0] == chap_idx:
+            chapter_output = started.popleft()[1].get()
+            start_conversions()
+          else:
+            if len(to_convert) > 0 and to_convert[0][0] == chap_idx:
+              to_convert.popleft()
+            chapter_output = convert_chapter(*sources[chap_idx])
+          chapter_output = plan.finish(chap_idx, chapter_output)[0]
+
+        chapter_output, footnote_count = renumber_footnotes(chapter_output, footnote_offset)
+        footnote_offset += footnote_count
+        chapter_output = chapter_output.strip('\n')
+        stage.count(lines=chapter_output.count('\n') + 1, bytes=len(chapter_output))
+      if chapter_output != '':
+        yield chapter_output
+    if pool is not None:
+      pool.close()
+  except BaseException:
+    if pool is not None:
+      pool.terminate()
+    raise
   finally:
-    os.chdir(current_dir)
+    if pool is not None:
+      pool.join()
 
 
 def split_sections(output_lines, feature_class_codes, feature_codes, other_codes, header_chars=None):
-  if header_chars is None:
-    header_chars = []
-  current_level = -1
-  start_line = -1
-  corrected_header_chars = {}
+  for start, end, code_dict in split_section_ranges(output_lines, feature_class_codes, feature_codes, other_codes,
+                                                    header_chars):
+    yield output_lines[start:end], code_dict
 
-  class_idx = 0
-  feature_idx = 0
-  code_idx = 0
 
-  code_dict = {}
+def split_section_ranges(output_lines, feature_class_codes, feature_codes, other_codes, header_chars=None):
+  """
+  Same as :py:func:`split_sections`, but yields the start and end line of each section instead of a copy of its lines.
+  """
+  for start, title_line, end, level, code_dict in split_section_levels(output_lines, feature_class_codes, feature_codes,
+                                                                      other_codes, header_chars):
+    yield start, end, code_dict
+
+
+def get_section_documents(output_lines, section_ranges):
+  """
+  Get the document names of the sections, and the subsections each document should list in its toctree (see
+  :py:class:`SectionDocuments`).
+
+  :param output_lines: lines of the RST output, split by :py:func:`split_section_levels`
+  :param section_ranges: list of the sections returned by :py:func:`split_section_levels`
+  :return: tuple of the list of document names and the list of the indices of the child sections of each section
+  """
+  documents = SectionDocuments()
+  for start, title_line, end, level, code_dict in section_ranges:
+    documents.add(output_lines[title_line], level)
+  return documents.names, documents.children
+
+
+class SectionDocuments(object):
+  """
+  Names the documents of the sections in order, and collects the subsections each document should list in its
+  toctree.
+
+  Chapters are numbered in order, deeper sections are numbered within their parent and prefixed with the number of the
+  parent (e.g. ``03_01_Morphological_features``). The first chapter, which is included in the index, is not numbered.
+  """
+
+  def __init__(self):
+    self.names = []
+    self.titles = []
+    self.levels = []
+    self.prefixes = []
+    self.children = []
+    self.parents = []  # Indices of the sections enclosing the current section
+    self.n_chapters = 0
+
+  def add(self, title, level):
+    """
+    :param title: title of the next section
+    :param level: header level of the section
+    :return: tuple of the index and the document name of the section
+    """
+    sec_idx = len(self.names)
+    while len(self.parents) > 0 and self.levels[self.parents[-1]] >= level:
+      self.parents.pop()
+
+    if len(self.parents) == 0:
+      prefix = '%02i' % self.n_chapters
+    else:
+      self.children[self.parents[-1]].append(sec_idx)
+      prefix = '%s_%02i' % (self.prefixes[self.parents[-1]], len(self.children[self.parents[-1]]))
+
+    name = re.sub(r'[^\w\-]+', '_', title).strip('_')
+    self.names.append(name if sec_idx == 0 else '%s_%s' % (prefix, name))
+    self.titles.append(title)
+    self.levels.append(level)
+    self.prefixes.append(prefix)
+    self.children.append([])
+    self.parents.append(sec_idx)
+    if level == 0:
+      self.n_chapters += 1
+    return sec_idx, self.names[-1]
+
+  def get_toctree(self, sec_idx):
+    """
+    :return: RST lines of the toctree of the subsections of a section (empty if it has none)
+    """
+    if len(self.children[sec_idx]) == 0:
+      return []
+    return ['', '.. toctree::', '   :maxdepth: 1', ''] + \
+      ['   %s <%s>' % (self.titles[c], self.names[c]) for c in self.children[sec_idx]] + ['']
+
+
+LABEL_PATTERN = re.compile(r'\.\. _[^:]+:$')
+
+
+def split_section_levels(output_lines, feature_class_codes, feature_codes, other_codes, header_chars=None,
+                         split_depth=0, split_chapters=None):
+  """
+  Split the RST output into sections at headers of level ``split_depth`` or lower (0 being chapters).
+
+  Header characters are corrected in ``output_lines`` to ``header_chars``, which is extended with the characters of
+  new levels. Label targets directly preceding a header are part of the section of that header.
+
+  :param split_depth: Deepest header level at which to split. The first chapter is only split from the next one, as
+    it is included in the index (see :py:class:`SectionDocuments`): its toctree would be shown on the home page.
+  :param split_chapters: If passed, headers below chapter level are only split in the chapters with these titles
+    (lower case)
+  :return: generator of (start line, title line, end line, header level, code_dict) tuples, where ``code_dict`` maps
+    the line index (relative to the start line) of each header with an IBSI code to the code
+  """
+  splitter = SectionSplitter(feature_class_codes, feature_codes, other_codes, header_chars, split_depth, split_chapters)
+  for sections in (splitter.feed(output_lines), splitter.close()):
+    for start, title_line, section, level, code_dict in sections:
+      output_lines[start:start + len(section)] = section
+      yield start, title_line, start + len(section), level, code_dict
+
+
+class SectionSplitter(object):
+  """
+  Splits RST lines into sections as they are fed, as :py:func:`split_section_levels` does for the whole output.
+
+  Only the lines of the current section are held: a section is returned as soon as the header of the next section is
+  fed (or :py:meth:`close` is called), so the output can be split while it is being converted.
+  """
+
+  def __init__(self, feature_class_codes, feature_codes, other_codes, header_chars=None, split_depth=0,
+               split_chapters=None):
+    self.feature_class_codes = feature_class_codes
+    self.feature_codes = feature_codes
+    self.other_codes = other_codes
+    self.header_chars = [] if header_chars is None else header_chars
+    self.split_depth = split_depth
+    self.split_chapters = split_chapters
+
+    self.current_level = -1
+    self.corrected_header_chars = {}
+    self.chapter_title = None
+    self.n_chapters = 0
+    self.class_idx = 0
+    self.feature_idx = 0
+    self.code_idx = 0
+
+    self.lines = []  # Lines of the current section (before the first section: the lines fed so far)
+    self.start_line = 0  # Index of the first line of ``lines`` among all lines fed
+    self.title_line = -1  # Index of the title line in ``lines``, -1 before the first section
+    self.level = 0
+    self.code_dict = {}  # keys are line indices in ``lines``
+
+  @property
+  def n_lines(self):
+    """
+    Number of lines fed so far.
+    """
+    return self.start_line + len(self.lines)
+
+  def feed(self, lines):
+    """
+    :param lines: iterable of the next lines of the RST output
+    :return: generator of the sections that end within ``lines``, as (start line, title line, section lines, header
+      level, code_dict) tuples. Start and title line are indices among all lines fed, ``code_dict`` maps the line
+      index (relative to the start line) of each header with an IBSI code to the code.
+    """
+    header_chars = self.header_chars
+    buf = self.lines
+    append = buf.append
+    for line in lines:
+      append(line)
+      if len(line) < 2 or line != line[0] * len(line):
+        continue
+      line_idx = len(buf) - 1
+      if line_idx == 0 or len(line) != len(buf[line_idx - 1]):
+        continue
 
-  for line_idx in range(len(output_lines)):
-    line = output_lines[line_idx]
-    if len(line) < 2:
-      continue
-    if line == line[0] * len(line) and len(line) == len(output_lines[line_idx - 1]):
       # Section header!
-      title = output_lines[line_idx - 1].replace(u'’', "'")
-
-      if class_idx < len(feature_class_codes) and title == feature_class_codes[class_idx][1]:
-        code_dict[line_idx - 1 - start_line] = feature_class_codes[class_idx]
-        class_idx += 1
-      elif feature_idx < len(feature_codes) and title == feature_codes[feature_idx][1]:
-        code_dict[line_idx - 1 - start_line] = feature_codes[feature_idx]
-        feature_idx += 1
-      elif code_idx < len(other_codes) and title == other_codes[code_idx][1]:
-        code_dict[line_idx - 1 - start_line] = other_codes[code_idx]
-        code_idx += 1
+      title = buf[line_idx - 1].replace(u'’', "'")
+
+      if self.class_idx < len(self.feature_class_codes) and title == self.feature_class_codes[self.class_idx][1]:
+        self.code_dict[line_idx - 1] = self.feature_class_codes[self.class_idx]
+        self.class_idx += 1
+      elif self.feature_idx < len(self.feature_codes) and title == self.feature_codes[self.feature_idx][1]:
+        self.code_dict[line_idx - 1] = self.feature_codes[self.feature_idx]
+        self.feature_idx += 1
+      elif self.code_idx < len(self.other_codes) and title == self.other_codes[self.code_idx][1]:
+        self.code_dict[line_idx - 1] = self.other_codes[self.code_idx]
+        self.code_idx += 1
 
       header_char = line[0]
 
       # Check if the header character is correct
-      if header_char in corrected_header_chars:
-        current_level = corrected_header_chars[header_char]
-        output_lines[line_idx] = len(line) * header_chars[current_level]
+      if header_char in self.corrected_header_chars:
+        self.current_level = self.corrected_header_chars[header_char]
+        buf[line_idx] = len(line) * header_chars[self.current_level]
       elif header_char not in header_chars:
         # header character not yet known, i.e. proceed to next level
-        current_level += 1
-        if (current_level + 1) > len(header_chars):
+        self.current_level += 1
+        if (self.current_level + 1) > len(header_chars):
           # Level not yet reached,
           # store current header character as the character for the new level
           header_chars.append(header_char)
         else:
           # Next level was already known, but under a different character.
           # Update this header to the known character for this level
-          output_lines[line_idx] = len(line) * header_chars[current_level]
-          corrected_header_chars[header_char] = current_level
-      elif header_chars.index(header_char) < current_level:
+          buf[line_idx] = len(line) * header_chars[self.current_level]
+          self.corrected_header_chars[header_char] = self.current_level
+      elif header_chars.index(header_char) < self.current_level:
         # Character known, indicating a lower level. Go to that level
-        current_level = header_chars.index(header_char)
-        corrected_header_chars = {k: v for k, v in six.iteritems(corrected_header_chars) if v <= current_level}
-      elif header_chars.index(header_char) > current_level:
+        self.current_level = header_chars.index(header_char)
+        self.corrected_header_chars = {k: v for k, v in six.iteritems(self.corrected_header_chars)
+                                       if v <= self.current_level}
+      elif header_chars.index(header_char) > self.current_level:
         # Character known, indicating a higher level. Go to next level
-        current_level += 1
+        self.current_level += 1
         # Check if the character is correct
-        if header_chars[current_level] != header_char:
+        if header_chars[self.current_level] != header_char:
           # Character not correct, update to the correct character
-          output_lines[line_idx] = len(line) * header_chars[current_level]
-          corrected_header_chars[header_char] = current_level
+          buf[line_idx] = len(line) * header_chars[self.current_level]
+          self.corrected_header_chars[header_char] = self.current_level
 
-      # Check if the current level indicates a split section (main sections)
-      if current_level == 0:
-        # Yes it does! return the previous section and continue
-        if start_line > -1:
-          yield output_lines[start_line: line_idx - 1], code_dict  # Line above header line is Title, don't include that in the previous section
-        start_line = line_idx - 1
-        code_dict = {}
+      if self.current_level == 0:
+        self.chapter_title = title.lower()
+        self.n_chapters += 1
 
-  yield output_lines[start_line:], code_dict  # return the remainder of the document
+      # Check if the current level indicates a split section (main sections, or deeper if requested, except in the
+      # first chapter)
+      if self.current_level == 0 or (self.current_level <= self.split_depth and self.n_chapters > 1 and
+                                     (self.split_chapters is None or self.chapter_title in self.split_chapters)):
+        # Yes it does! return the previous section and continue
+        new_start = line_idx - 1  # Line above header line is Title, don't include that in the previous section
+        label_start = new_start
+        # The first line of the previous section stays in it, unless there is no previous section
+        min_start = 0 if self.title_line < 0 else 1
+        while label_start > min_start and (buf[label_start - 1] == '' or LABEL_PATTERN.match(buf[label_start - 1])):
+          label_start -= 1
+          if buf[label_start] != '':
+            new_start = label_start
+
+        if self.title_line >= 0:
+          yield self.start_line, self.start_line + self.title_line, buf[:new_start], self.level, \
+                dict((k, v) for k, v in six.iteritems(self.code_dict) if k < new_start)
+        self.code_dict = dict((k - new_start, v) for k, v in six.iteritems(self.code_dict) if k >= new_start)
+        buf = self.lines = buf[new_start:]
+        append = buf.append
+        self.start_line += new_start
+        self.title_line = line_idx - 1 - new_start
+        self.level = self.current_level
+
+  def close(self):
+    """
+    :return: generator of the last section (see :py:meth:`feed`). If no header was fed, the last line is returned as
+      the only section.
+    """
+    if self.title_line < 0:
+      if len(self.lines) == 0:
+        return
+      self.start_line, self.lines, self.title_line = self.n_lines - 1, self.lines[-1:], 0
+    yield self.start_line, self.start_line + self.title_line, self.lines, self.level, self.code_dict
+    self.start_line, self.lines, self.title_line, self.code_dict = self.n_lines, [], -1, {}
+
+
+CITE_PATTERN = re.compile(
+  r':raw-latex:`\\cite[pt]?\{(?P<Authors>[a-z,A-Z]+(-[a-z,A-Z]+)*\d{4}[a-z,A-Z]*(,\s?([a-z,A-Z]+(-[a-z,A-Z]+)*\d{4}[a-z,A-Z]*))*)\}`'
+)
 
 
 def process_citations(section_lines):
-  cite_pattern = r':raw-latex:`\\cite[pt]?\{(?P<Authors>[a-z,A-Z]+(-[a-z,A-Z]+)*\d{4}[a-z,A-Z]*(,\s?([a-z,A-Z]+(-[a-z,A-Z]+)*\d{4}[a-z,A-Z]*))*)\}`'
-
   for line_idx in range(len(section_lines)):
-    line = section_lines[line_idx]
-    replacements = {}
-    for match in re.finditer(cite_pattern, line):
-      match_str = match.group()
-      authors = match.groupdict()['Authors'].split(',')
+    section_lines[line_idx] = replace_citations(section_lines[line_idx])
+
+
+def replace_citations(line):
+  replacements = {}
+  for match in CITE_PATTERN.finditer(line):
+    match_str = match.group()
+    authors = match.groupdict()['Authors'].split(',')
+
+    replacements[match_str] = [a.strip() for a in authors]
+
+  for r in replacements:
+    r_str = ':cite:`' + ','.join(replacements[r]) + '`'
+    if not (line.index(r) == 0 or line[line.index(r) - 1] == ' '):
+      r_str = ' ' + r_str
+    line = line.replace(r, r_str)
+  return line
+
+
+CITE_ROLE_PATTERN = re.compile(r':cite:`(?P<Keys>[^`]+)`')
+BIB_ENTRY_PATTERN = re.compile(r'^[ \t]*@(?P<Type>\w+)[ \t]*[{(]', re.MULTILINE)
+BIB_CROSSREF_PATTERN = re.compile(r'\bcrossref\s*=\s*[{"](?P<Key>[^}"]+)[}"]', re.IGNORECASE)
+PRUNED_BIBLIOGRAPHY = 'CitedBibliography.bib'
 
-      replacements[match_str] = [a.strip() for a in authors]
 
-    for r in replacements:
-      r_str = ':cite:`' + ','.join(replacements[r]) + '`'
-      if not (line.index(r) == 0 or line[line.index(r) - 1] == ' '):
-        r_str = ' ' + r_str
-      line = line.replace(r, r_str)
-    section_lines[line_idx] = line
+def get_cited_keys(text):
+  """
+  :param text: RST text
+  :return: list of the keys cited by the ``:cite:`` roles in the text, in order of citation
+  """
+  return [k.strip() for match in CITE_ROLE_PATTERN.finditer(text) for k in match.group('Keys').split(',')]
+
+
+def find_bibliography(tex_data, search_dirs, default='Bibliography.bib'):
+  """
+  Find the bibliography files of the Tex document (``\\bibliography{...}``).
+
+  :return: list of paths of the existing bibliography files, ``[default]`` if the document does not name any
+  """
+  bib_files = []
+  for match in re.finditer(r'\\bibliography\{(?P<Names>[^}]+)\}', tex_data):
+    for name in match.group('Names').split(','):
+      name = name.strip()
+      bib_file = find_tex_file(name if name.endswith('.bib') else name + '.bib', search_dirs)
+      if bib_file is not None and bib_file not in bib_files:
+        bib_files.append(bib_file)
+  return bib_files or [default]
+
+
+def split_bib_entries(bib_data):
+  """
+  Split the contents of a bibtex file into its entries. Text outside entries (comments) is dropped.
+
+  :return: list of (entry type in lower case, key, text of the entry) tuples. The key of ``@string``, ``@preamble``
+    and ``@comment`` entries is None.
+  """
+  entries = []
+  pos = 0
+  for match in BIB_ENTRY_PATTERN.finditer(bib_data):
+    if match.start() < pos:
+      continue  # '@' inside the previous entry
+    entry_type = match.group('Type').lower()
+    close_char = '}' if bib_data[match.end() - 1] == '{' else ')'
+
+    # Find the end of the entry, skipping over braced values
+    depth = 1
+    end = match.end()
+    while depth > 0 and end < len(bib_data):
+      c = bib_data[end]
+      if c == '{':
+        depth += 1
+      elif c == '}' or (c == close_char and depth == 1):
+        depth -= 1
+      end += 1
+
+    key = None
+    if entry_type not in ('string', 'preamble', 'comment'):
+      key = bib_data[match.end():end].split(',', 1)[0].strip()
+    entries.append((entry_type, key, bib_data[match.start():end].strip()))
+    pos = end
+  return entries
+
+
+def prune_bibliography(bib_files, cited_keys):
+  """
+  Collect the bibliography entries that are cited (and the entries they cross-reference) into a new bibtex file, so
+  the Sphinx build does not parse the entries that are never cited. ``@string`` and ``@preamble`` entries are kept.
+
+  :param bib_files: source bibtex files (files that do not exist are skipped)
+  :param cited_keys: keys cited by the documentation
+  :return: tuple of the text of the pruned bibtex file, the number of entries it holds, and the sorted list of cited
+    keys not found in any source file
+  """
+  entries = []
+  for bib_file in bib_files:
+    if not os.path.isfile(bib_file):
+      continue
+    with open(bib_file, mode='rb') as bib_fs:
+      entries += split_bib_entries(bib_fs.read().decode('utf-8-sig'))
+  by_key = dict((key, text) for _, key, text in entries if key is not None)
+
+  keep = set()
+  pending = [k for k in cited_keys if k in by_key]
+  while len(pending) > 0:
+    key = pending.pop()
+    if key in keep:
+      continue
+    keep.add(key)
+    pending += [m.group('Key').strip() for m in BIB_CROSSREF_PATTERN.finditer(by_key[key])
+                if m.group('Key').strip() in by_key]
+
+  out = [text for entry_type, key, text in entries if key in keep or entry_type in ('string', 'preamble')]
+  return u'\n\n'.join(out) + u'\n', len(keep), sorted(k for k in cited_keys if k not in by_key)
 
 
 def fix_math_indent(section_lines):
@@ -258,41 +1438,148 @@ def fix_math_indent(section_lines):
       section_lines[line_idx] = line.strip()
 
 
-def fix_math_formula(section_lines):
-  keys = {r'\floor*{': (r'\left\lfloor ', r'\right\rfloor '),
-          r'\ceil*{': (r'\left\lceil ', r'\right\rceil '),
-          r'\abs{': ('|', '|'),
-          r'\norm{': (r'\|', r'\|'),
-          r'\iverson{': (r'\big[', r'\big]')}
-  regex = r'\\(floor\*|ceil\*|abs|norm|iverson)\{'
+# Macros defined in the Tex preamble (e.g. by \DeclarePairedDelimiter) that are not known to MathJax, with the
+# replacements of the macro and its opening brace, and of its closing brace
+MATH_MACROS = collections.OrderedDict([
+  (r'\floor*', (r'\left\lfloor ', r'\right\rfloor ')),
+  (r'\ceil*', (r'\left\lceil ', r'\right\rceil ')),
+  (r'\abs', ('|', '|')),
+  (r'\norm', (r'\|', r'\|')),
+  (r'\iverson', (r'\big[', r'\big]'))
+])
+# Definitions of the macros, written instead of expanding them (see get_math_macro_definitions)
+MATH_MACROS_FILE = 'math_macros.json'
 
+
+def fix_math_formula(section_lines):
+  expander = MathMacroExpander()
   for line_idx in range(len(section_lines)):
-    line = section_lines[line_idx]
+    section_lines[line_idx] = expander.expand_line(section_lines[line_idx])
 
-    replacements = []
-    for match in re.finditer(regex, line):
-      idx = match.start(), match.end()
-      key = line[idx[0]:idx[1]]
-
-      end_idx = None
-      level = 1
-      for char_idx, char in enumerate(line[idx[1]:], start=idx[1]):
-        if char == '{':
-          level += 1
-        elif char == '}':
-          level -= 1
-
-        if level == 0:
-          end_idx = char_idx
-          break
 
-      replacements.append((idx[0], idx[1], keys[key][0]))
-      replacements.append((end_idx, end_idx + 1, keys[key][1]))
+def expand_math_macros(line, macros=None):
+  """
+  Replace the macros in :py:data:`MATH_MACROS` by their definitions.
+
+  :param line: Math source (a line of RST, or the contents of a math element)
+  :param macros: macro table (default: :py:data:`MATH_MACROS`)
+  :return: the line with all macros expanded, or the line as it is if a macro is not closed
+  """
+  expander = MathMacroExpander(macros)
+  expanded = expander.expand(line)
+  return line if len(expander.open) > 0 else expanded
+
+
+_math_macro_patterns = {}
+
+
+def _get_math_macro_patterns(macros):
+  """
+  :param macros: tuple of the macros of a macro table
+  :return: tuple of the compiled patterns of :py:class:`MathMacroExpander`
+  """
+  if macros not in _math_macro_patterns:
+    names = '|'.join(re.escape(m.lstrip('\\')) for m in sorted(macros, key=len, reverse=True))
+    _math_macro_patterns[macros] = (
+      # Macros with their opening brace. Escaped backslashes are matched as well, so the text following a line break
+      # (\\) is not taken as a macro.
+      re.compile(r'\\\\|\\(?:%s)\{' % names),
+      # Macros with their opening brace and braces, looked for while a macro is open. Escaped braces are matched as
+      # well, so they are not counted.
+      re.compile(r'\\[\\{}]|\\(?:%s)\{|[{}]' % names))
+  return _math_macro_patterns[macros]
+
+
+class MathMacroExpander(object):
+  """
+  Expands the macros of a macro table in a single pass over the math source.
+
+  The source is scanned once for the macros of the table, and while a macro is open, for braces. A macro is replaced
+  together with its opening brace, and its closing brace is the first one that balances it, so nested macros are
+  expanded in the same pass. Escaped braces (``\\{``, ``\\}``) are not counted. Macros that are still open at the end
+  of a text stay open for the next text passed to :py:meth:`expand` (e.g. the next line of a math block), until
+  :py:meth:`reset`.
+
+  :param macros: dict of macro (e.g. ``\\abs``): (replacement of the macro and its opening brace, replacement of its
+    closing brace), see :py:data:`MATH_MACROS`
+  """
+
+  def __init__(self, macros=None):
+    self.macros = MATH_MACROS if macros is None else macros
+    self.macro_pattern, self.token_pattern = _get_math_macro_patterns(tuple(self.macros))
+    self.depth = 0  # Brace depth, counted while a macro is open
+    self.open = []  # (brace depth of each open macro, replacement of its closing brace)
+
+  def reset(self):
+    self.depth = 0
+    self.open = []
+
+  def expand(self, text):
+    """
+    :return: ``text`` with the macros expanded
+    """
+    if len(self.macros) == 0:
+      return text
+    parts = []
+    pos = 0  # Start of the text not yet copied to parts
+    search_pos = 0
+    while True:
+      match = (self.token_pattern if len(self.open) > 0 else self.macro_pattern).search(text, search_pos)
+      if match is None:
+        break
+      token = match.group()
+      search_pos = match.end()
+      if token == '{':
+        self.depth += 1
+      elif token == '}':
+        if self.open[-1][0] == self.depth:
+          parts.append(text[pos:match.start()])
+          parts.append(self.open.pop()[1])
+          pos = search_pos
+        self.depth -= 1
+      elif token[:-1] in self.macros:
+        parts.append(text[pos:match.start()])
+        parts.append(self.macros[token[:-1]][0])
+        pos = search_pos
+        self.depth += 1
+        self.open.append((self.depth, self.macros[token[:-1]][1]))
+
+    if pos == 0:
+      return text
+    parts.append(text[pos:])
+    return ''.join(parts)
+
+  def expand_line(self, line):
+    """
+    Expand the macros in a line of RST. Macros that are not closed within the line are closed in the following lines,
+    up to the next empty line.
+    """
+    if line == '':
+      self.reset()
+      return line
+    if '\\' not in line and len(self.open) == 0:
+      return line
+    return self.expand(line)
+
+
+def get_math_macro_definitions(macros=None):
+  """
+  Get the definitions of the macros, so MathJax and KaTeX can render them as they are (instead of expanding them in
+  the text). The star of a starred macro (e.g. ``\\floor*``) is taken as its first argument.
 
-    if len(replacements) > 0:
-      for r in sorted(replacements, key=lambda x: x[0], reverse=True):
-        line = line[:r[0]] + r[2] + line[r[1]:]
-      section_lines[line_idx] = line
+  :param macros: macro table (default: :py:data:`MATH_MACROS`)
+  :return: dict with the definitions of the macros for MathJax (``mathjax``: ``{name: [definition, number of
+    arguments]}``, see the ``tex.macros`` option of MathJax) and for KaTeX (``katex``: ``{macro: definition}``)
+  """
+  if macros is None:
+    macros = MATH_MACROS
+  definitions = {'mathjax': {}, 'katex': {}}
+  for macro, (open_replacement, close_replacement) in six.iteritems(macros):
+    n_args = 2 if macro.endswith('*') else 1
+    definition = '%s#%i%s' % (open_replacement, n_args, close_replacement)
+    definitions['mathjax'][macro.lstrip('\\').rstrip('*')] = [definition, n_args]
+    definitions['katex'][macro.rstrip('*')] = definition
+  return definitions
 
 
 def read_tex_source(tex_source):
@@ -305,7 +1592,7 @@ def read_tex_source(tex_source):
   if not os.path.isfile(tex_source):
     raise ValueError('Tex source file (%s) is not found!' % tex_source)
 
-  with open(tex_source, mode='r') as tex_fs:
+  with io.open(tex_source, mode='r', encoding='utf-8') as tex_fs:
     return tex_fs.read()
 
 
@@ -386,6 +1673,64 @@ def parse_other_ids(source_tex):
   return other_codes
 
 
+CODE_INDEX_FILE = 'ibsi_codes.json'
+
+
+def get_code_label(code):
+  """
+  :return: RST label of the header of the passed IBSI code (``ibsi_<code>``). Its HTML anchor is ``ibsi-<code>``.
+  """
+  return 'ibsi_%s' % code.lower()
+
+
+class CodeIndex(object):
+  """
+  Index of the IBSI codes in the output, mapping every code to the document and anchor of its header, its name and,
+  for features, the name and code of its feature family. Stored as JSON for the ``ibsi_codes`` Sphinx extension and
+  other tools.
+
+  :param feature_class_codes: codes of the feature families, as returned by :py:func:`parse_feature_ids`
+  :param feature_codes: codes of the features, as returned by :py:func:`parse_feature_ids`
+  """
+
+  def __init__(self, feature_class_codes, feature_codes):
+    self.class_codes = set(c[0] for c in feature_class_codes)
+    self.feature_codes = set(c[0] for c in feature_codes)
+    self.codes = {}
+    self.family = None
+
+  def add_section(self, document, codes):
+    """
+    :param document: name of the document the section is written to
+    :param codes: (code, name, label) tuples of the headers of the section, in order
+    """
+    for code, name, label in codes:
+      name = name.replace('\\ :sup:`th`', 'th')
+      entry = {
+        'document': document,
+        'anchor': get_code_label(code).replace('_', '-'),
+        'label': get_code_label(code),
+        'name': name,
+        'type': 'other'
+      }
+      if code in self.class_codes:
+        entry['type'] = 'family'
+        self.family = (code, name)
+      elif code in self.feature_codes:
+        entry['type'] = 'feature'
+        if self.family is not None:
+          entry['family_code'], entry['family'] = self.family
+      if label is not None:
+        entry['tex_label'] = label
+      self.codes[code] = entry
+
+  def dump(self):
+    """
+    :return: contents (bytes) of the JSON file of the index
+    """
+    return json.dumps(self.codes, indent=1, sort_keys=True).encode('utf-8')
+
+
 def update_inline_ids(source_tex):
   id_pattern = re.compile(r'\\textid{(?P<InlineCode>\w{4})}')
 
@@ -398,7 +1743,18 @@ def update_inline_ids(source_tex):
   return source_tex, inline_codes
 
 
-def fix_benchmark_tables(benchmark_dir):
+def fix_benchmark_tables(benchmark_dir, dest_dir=None, fnames=None):
+  """
+  Rewrite the benchmark tables into a form pandoc can parse.
+
+  :param benchmark_dir: Directory holding the benchmark tables
+  :param dest_dir: Directory to write the fixed tables to (default: overwrite the tables in ``benchmark_dir``). Only
+    tables that need fixing are written.
+  :param fnames: File names of the tables to fix (default: all files in ``benchmark_dir``)
+  :return: tuple of the number of tables read and the number of tables written
+  """
+  if dest_dir is None:
+    dest_dir = benchmark_dir
   small_pattern = re.compile(r'\\small{(?P<table>(.*\n)+)}\n')
   table_pattern = re.compile(r'\\begin{longtable}{ccccc}\n\s+\\toprule\n(?P<hdr>({\\textbf{.+}} & )+{\\textbf{.+}}\s)\\\\\s*\n\s+\\midrule\n(?P<table_data>(.+\\\\\s*\n)+\s+\\bottomrule)(?P<caption>\n\\caption{)')
   em_dash_pattern = re.compile(r'\\textemdash')
@@ -414,14 +1770,30 @@ def fix_benchmark_tables(benchmark_dir):
     repl += grps['caption']
     return repl
 
-  for fname in os.listdir(benchmark_dir):
-    with open(os.path.join(benchmark_dir, fname)) as b_fs:
-      b_table = b_fs.read()
-    b_table = small_pattern.sub(r'\\small\g<table>', b_table)
+  if fnames is None:
+    fnames = os.listdir(benchmark_dir)
+  n_written = 0
+  for fname in fnames:
+    with io.open(os.path.join(benchmark_dir, fname), mode='r', encoding='utf-8') as b_fs:
+      b_source = b_fs.read()
+    b_table = small_pattern.sub(r'\\small\g<table>', b_source)
     b_table = table_pattern.sub(header_fix, b_table)
     b_table = em_dash_pattern.sub('---', b_table)
-    with open(os.path.join(benchmark_dir, fname), mode='w') as b_fs:
-      b_fs.write(b_table)
+    if b_table == b_source:
+      continue
+    write_overlay_file(os.path.join(dest_dir, fname), b_table)
+    n_written += 1
+  return len(fnames), n_written
+
+
+def write_overlay_file(fname, data):
+  """
+  Write a (transformed) source file, creating its directory if needed.
+  """
+  if not os.path.isdir(os.path.dirname(fname)):
+    os.makedirs(os.path.dirname(fname))
+  with io.open(fname, mode='w', encoding='utf-8') as out_fs:
+    out_fs.write(six.text_type(data))
 
 
 def fix_figures(section_lines, figures):
@@ -457,7 +1829,7 @@ def fix_figures(section_lines, figures):
 
     fig.append(u'.. figure:: ' + r[2].replace('.pdf', '.png'))
 
-    for k in ('align',):  # ('scale', 'align'):
+    for k in FIGURE_OPTIONS:
       if k in fig_data:
         fig.append(u'   :%s: %s' % (k, fig_data[k].strip()))
 
@@ -480,44 +1852,260 @@ def fix_numbered_lists(section_lines):
           section_lines[line_idx] = '   ' + line[len(indent):]
 
 
-def correct_tables(total_output):
-  pattern = r'(^\n|(\| \n)|(\|? ?to 0\.\d+\n)|(@\S+@\n))*(?P<table_data>(^\| [^\&\n]*( ?\&[^\&\n]*)+\n(  (\S+\s)+)*\n*)+)'
+MATH_BLOCK_PATTERN = re.compile(r'\s*.. math::$')
+MATH_LINE_PATTERN = re.compile(r'\s*.. math::')
+INDENT_PATTERN = re.compile(r'\s*')
+NON_SPACE_PATTERN = re.compile(r'\S')
+LIST_ITEM_PATTERN = re.compile(r'(?P<indent>\s*)\S')
 
-  replacements = {}
 
-  for match in re.finditer(pattern, total_output, flags=re.MULTILINE):
-    table = match.groupdict()['table_data']
-    rows = table.split('|')[1:]
-    rows = [r.replace('\n', '').split('&') for r in rows]
+class SectionTransformer(object):
+  """
+  Single pass equivalent of :py:func:`process_citations`, :py:func:`fix_math_indent`, :py:func:`fix_math_formula`,
+  :py:func:`fix_figures` and :py:func:`fix_numbered_lists`, applied in that order.
 
-    rows = [r for r in rows if len(r) == len(rows[-1])]
+  Lines are fed one at a time and go through each of the fixes in turn, every fix keeping its own state. Output lines
+  are appended to a new list, the only lines held back are those of a figure that is still being read. The output is
+  identical to running the separate passes over the section.
 
-    new_table = '\n.. list-table::\n   :widths: auto\n'
+  The number of lines changed by each fix is counted in ``counts``.
 
-    headers = True
-    hdrlines = 0
-    for r in rows:
-      if headers:
-        if all([c.strip().startswith('**') and c.strip().endswith('**') for c in r]):
-          hdrlines += 1
-        else:
-          headers = False
+  :param expand_math_macros: If False, math macros are left as they are (see :py:func:`get_math_macro_definitions`)
+  """
+
+  def __init__(self, figures, expand_math_macros=True):
+    self.figures = figures
+    self.output = []
+    self.counts = {'citations': 0, 'math_indents': 0, 'math_macros': 0, 'figures': 0, 'list_indents': 0}
+
+    # fix_math_indent
+    self.math_block = False
+    self.math_line = False
+    self.math_indent = None
+
+    # fix_math_formula
+    self.math_macros = MathMacroExpander() if expand_math_macros else None
+
+    # fix_figures
+    self.fig_name = None
+    self.fig_lines = None
+    self.fig_indent = None
+
+    # fix_numbered_lists
+    self.is_list = False
+
+  def transform(self, section_lines):
+    for line in section_lines:
+      self.feed(line)
+    return self.close()
+
+  def feed(self, line):
+    if ':raw-latex:`\\cite' in line:
+      cited = replace_citations(line)
+      if cited != line:
+        self.counts['citations'] += 1
+        line = cited
+    line = self._fix_math_indent(line)
+    if self.math_macros is not None:
+      expanded = self.math_macros.expand_line(line)
+      if expanded != line:
+        self.counts['math_macros'] += 1
+        line = expanded
+    self._fix_figure(line)
+
+  def close(self):
+    # A figure that is not closed before the end of the section is left as it is
+    if self.fig_lines is not None:
+      for fig_line in self.fig_lines:
+        self._fix_numbered_list(fig_line)
+      self.fig_lines = None
+    return self.output
+
+  def _fix_math_indent(self, line):
+    if line == '':
+      return line
+
+    if MATH_BLOCK_PATTERN.match(line):
+      self.math_block = True
+    elif MATH_LINE_PATTERN.match(line):
+      self.math_line = True
+    elif self.math_block:
+      if self.math_indent is None:
+        self.math_indent = INDENT_PATTERN.match(line).group()
+      elif not _has_indent(line, self.math_indent):
+        self.math_indent = None
+        self.math_block = False
+        self.counts['math_indents'] += 1
+        return line.strip()
+    elif self.math_line and line.startswith(' '):
+      self.math_line = False
+      self.counts['math_indents'] += 1
+      return line.strip()
+    return line
+
+  def _fix_figure(self, line):
+    if line.startswith('.. figure:: '):
+      if self.fig_lines is not None:
+        # Previous figure was not closed, keep it as it is
+        for fig_line in self.fig_lines:
+          self._fix_numbered_list(fig_line)
+      self.fig_name = line.replace('.. figure:: ', '')
+      self.fig_lines = [line]
+      return
+
+    if self.fig_lines is not None:
+      if self.fig_indent is None:
+        self.fig_indent = INDENT_PATTERN.match(line).group()
+      elif line == '' or not _has_indent(line, self.fig_indent):
+        self.fig_indent = None
+        self.counts['figures'] += 1
+        for fig_line in self._figure_lines():
+          self._fix_numbered_list(fig_line)
+        self.fig_lines = None
+        self._fix_numbered_list(line)
+        return
+      self.fig_lines.append(line)
+      return
+
+    self._fix_numbered_list(line)
+
+  def _figure_lines(self):
+    fig = []
+    fig_data = self.figures.get(self.fig_name, {})
+    if 'label' in fig_data:
+      fig.append(u'.. _%s:' % fig_data['label'])
+
+    fig.append(u'.. figure:: ' + self.fig_name.replace('.pdf', '.png'))
+
+    for k in FIGURE_OPTIONS:
+      if k in fig_data:
+        fig.append(u'   :%s: %s' % (k, fig_data[k].strip()))
+    return fig
+
+  def _fix_numbered_list(self, line):
+    if line.startswith('#. '):
+      self.is_list = True
+    elif self.is_list:
+      if line == '':
+        self.is_list = False
+      else:
+        m = LIST_ITEM_PATTERN.match(line)
+        if m is not None:
+          indent = m.groupdict()['indent']
+          if indent != '   ':
+            line = '   ' + line[len(indent):]
+            self.counts['list_indents'] += 1
+    self.output.append(line)
+
+
+def _has_indent(line, indent):
+  # Equivalent to re.match(indent + '\S', line) for an indent consisting of whitespace only
+  return line.startswith(indent) and NON_SPACE_PATTERN.match(line, len(indent)) is not None
+
+
+TABLE_JUNK_PATTERN = re.compile(r'(\| |\|? ?to 0\.\d+|@\S+@)$')
+
+
+def correct_tables(total_output):
+  buffer = EditBuffer(total_output)
+  edit_tables(buffer)
+  return buffer.apply()
+
+
+def edit_tables(buffer):
+  """
+  Convert the tables pandoc could not parse into list-tables.
 
-    if hdrlines > 0:
-      new_table += '   :header-rows: %i\n' % hdrlines
-    for r_idx, r in enumerate(rows):
-      if r_idx < hdrlines:
-        r = [c.strip()[2:-2] for c in r]
-      new_table += '\n   * - %s' % '\n     - '.join(r)
+  Pandoc writes these as line blocks, one ``|`` line per row with ``&`` separated cells, possibly wrapped onto
+  indented continuation lines. Lines preceding the table that are left over from the Tex table layout (empty lines,
+  empty line block lines, column widths ``to 0.x`` and ``@..@`` column separators) are removed along with the table.
 
-    new_table += '\n\n'
+  The output is scanned line by line in a single forward pass. Edits made by other passes within a table are applied
+  to the cells of the list-table.
 
-    replacements[(match.start(), match.end())] = new_table
+  :param buffer: :py:class:`EditBuffer` of the RST output
+  :return: number of tables converted
+  """
+  total_output = buffer.text
+  lines = total_output.split('\n')
+  n_lines = len(lines) - 1  # The last element has no line ending, so it cannot be part of a table
+
+  def is_row(line_idx):
+    line = lines[line_idx]
+    return line_idx < n_lines and line.startswith('| ') and '&' in line
+
+  def is_continuation(line_idx):
+    line = lines[line_idx]
+    return line_idx < n_lines and line.startswith('  ') and len(line) > 2 and not line[2].isspace()
+
+  line_starts = [0]
+  for line in lines:
+    line_starts.append(line_starts[-1] + len(line) + 1)
+
+  last_end_line = 0
+  line_idx = 0
+  n_tables = 0
+  while line_idx < n_lines:
+    if not is_row(line_idx):
+      line_idx += 1
+      continue
 
-  for r in sorted(replacements, key=lambda x: x[0], reverse=True):
-    total_output = total_output[:r[0]] + replacements[r] + total_output[r[1]:]
+    # Find the start of the layout lines that precede the table
+    start = line_starts[line_idx]
+    start_line = line_idx
+    while start_line > last_end_line:
+      junk = TABLE_JUNK_PATTERN.search(lines[start_line - 1])
+      if lines[start_line - 1] == '' or (junk is not None and junk.start() == 0):
+        start_line -= 1
+        start = line_starts[start_line]
+        continue
+      if junk is not None:
+        start = line_starts[start_line - 1] + junk.start()
+      break
+
+    # Consume the rows of the table, each optionally followed by continuation lines and empty lines
+    table_start = line_idx
+    while line_idx < n_lines and is_row(line_idx):
+      line_idx += 1
+      while line_idx < n_lines and is_continuation(line_idx):
+        line_idx += 1
+      while line_idx < n_lines and lines[line_idx] == '':
+        line_idx += 1
+
+    # The table cannot extend into text removed by another pass (e.g. a footnote following the table)
+    start, end = buffer.clip(start, line_starts[line_idx])
+    buffer.replace(start, end, build_list_table(buffer.edited(max(start, line_starts[table_start]), end)), absorb=True)
+    last_end_line = line_idx
+    n_tables += 1
+  return n_tables
+
+
+def build_list_table(table):
+  rows = table.split('|')[1:]
+  rows = [r.replace('\n', '').split('&') for r in rows]
+
+  rows = [r for r in rows if len(r) == len(rows[-1])]
+
+  new_table = '\n.. list-table::\n   :widths: auto\n'
+
+  headers = True
+  hdrlines = 0
+  for r in rows:
+    if headers:
+      if all([c.strip().startswith('**') and c.strip().endswith('**') for c in r]):
+        hdrlines += 1
+      else:
+        headers = False
 
-  return total_output
+  if hdrlines > 0:
+    new_table += '   :header-rows: %i\n' % hdrlines
+  for r_idx, r in enumerate(rows):
+    if r_idx < hdrlines:
+      r = [c.strip()[2:-2] for c in r]
+    new_table += '\n   * - %s' % '\n     - '.join(r)
+
+  new_table += '\n\n'
+  return new_table
 
 
 def get_chapter_labels(tex_data):
@@ -534,39 +2122,234 @@ def get_chapter_labels(tex_data):
 
 
 def parse_chapter_refs(output, chapter_labels):
-  refs = chapter_labels.viewvalues()
+  buffer = EditBuffer(output)
+  edit_chapter_refs(buffer, chapter_labels)
+  return buffer.apply()
 
-  replacements = {}
-  for match in re.finditer(r'\(\*\*Chapter[ \n]\[(?P<chapter>chap(\\_\w+)+( \w+)?)\]\*\*\)', output):
+
+def edit_chapter_refs(buffer, chapter_labels):
+  """
+  Replace the chapter references pandoc could not resolve by ``:ref:`` roles, or remove them if the chapter is not
+  known.
+
+  :param buffer: :py:class:`EditBuffer` of the RST output
+  :param chapter_labels: chapter labels (result of py:func:`get_chapter_labels`)
+  :return: number of references replaced or removed
+  """
+  refs = set(six.itervalues(chapter_labels))
+  n_refs = 0
+
+  for match in re.finditer(r'\(\*\*Chapter[ \n]\[(?P<chapter>chap(\\_\w+)+( \w+)?)\]\*\*\)', buffer.text):
     chapter_ref = match.groupdict()['chapter'].replace(r'\_', '_').replace(' ', '_')
     if chapter_ref not in refs:
       print("Skipping ref %s (could not find corresponding chapter)" % chapter_ref)
-      chapter_ref = None
-    match_str = match.group()
-    replacements[match_str] = chapter_ref
-
-  for r in replacements:
-    if replacements[r] is None:
       r_str = ''
     else:
-      r_str = '(:ref:`%s`)' % replacements[r]
-    if '\n' in r:
+      r_str = '(:ref:`%s`)' % chapter_ref
+    if '\n' in match.group():
       r_str = '\n' + r_str
-    output = output.replace(r, r_str)
-  return output
+    buffer.replace(match.start(), match.end(), r_str)
+    n_refs += 1
+  return n_refs
+
+
+# Footnote definitions, with all lines of their (indented) text, and footnote references
+FOOTNOTE_PATTERN = re.compile(r'(?P<def>\n\.\. \[(?P<no>\d+)\][ \t]*\n(?P<value>([ \t]+\S[^\n]*\n|\n(?=[ \t]+\S))+))'
+                              r'|\[(?P<ref>\d+)\]_')
 
 
 def get_footnotes(output):
+  buffer = EditBuffer(output)
+  footnotes = edit_footnotes(buffer)
+  return buffer.apply(), footnotes
+
+
+def edit_footnotes(buffer):
+  """
+  Remove the footnote definitions from the RST output, so they can be added to the documents that reference them.
+
+  The footnote references found in the same scan are stored in ``buffer.footnote_refs``.
+
+  :param buffer: :py:class:`EditBuffer` of the RST output
+  :return: dictionary of footnote number to footnote text (without indentation, it may span several lines)
+  """
   footnotes = {}
-  footnote_pattern = re.compile(r'\n.. \[(?P<no>\d+)\]\s*\n\s+(?P<value>.+)\n')
-  for m in footnote_pattern.finditer(output):
+  for m in FOOTNOTE_PATTERN.finditer(buffer.text):
     grp = m.groupdict()
-    footnotes[int(grp['no'])] = grp['value']
+    if grp['def'] is None:
+      buffer.footnote_refs.append((m.start(), int(grp['ref'])))
+    else:
+      footnotes[int(grp['no'])] = textwrap.dedent(grp['value']).strip('\n')
+      buffer.replace(m.start(), m.end(), '')
+  return footnotes
 
-  output = footnote_pattern.sub('', output)
-  return output, footnotes
+
+def format_footnote(no, text):
+  """
+  :return: RST of the definition of a footnote (see :py:func:`edit_footnotes`)
+  """
+  return u'\n.. [%i]\n%s\n' % (no, u'\n'.join(u'   ' + line if line != u'' else line for line in text.split(u'\n')))
+
+
+class EditBuffer(object):
+  """
+  Collects replacements of non-overlapping spans of a text, and applies them all at once.
+
+  This allows several passes to edit the whole RST output without copying it for every replacement. All passes work on
+  the unchanged ``text``, offsets passed to :py:meth:`replace` refer to that text.
+  """
+
+  def __init__(self, text):
+    self.text = text
+    self.edits = []  # sorted list of (start, end, replacement)
+    self.footnote_refs = []  # (offset, footnote number)
+
+  def replace(self, start, end, replacement, absorb=False):
+    """
+    Replace ``text[start:end]`` by ``replacement``.
+
+    If ``absorb`` is True, edits lying within the span are dropped, as they are assumed to be part of the replacement
+    (see :py:meth:`edited`). Any other overlap with an existing edit raises a ValueError.
+    """
+    idx = bisect.bisect_left(self.edits, (start,))
+    if idx > 0 and self.edits[idx - 1][1] > start:
+      raise ValueError('Edit of %i:%i overlaps with edit of %i:%i' % ((start, end) + self.edits[idx - 1][:2]))
+
+    last = idx
+    while last < len(self.edits) and (self.edits[last][0] < end or self.edits[last][0] == start):
+      if not absorb or self.edits[last][1] > end:
+        raise ValueError('Edit of %i:%i overlaps with edit of %i:%i' % ((start, end) + self.edits[last][:2]))
+      last += 1
+    self.edits[idx:last] = [(start, end, replacement)]
+
+  def clip(self, start, end):
+    """
+    Shrink the span ``start:end`` so that it does not partially overlap any existing edit.
+    """
+    idx = bisect.bisect_left(self.edits, (start,))
+    if idx > 0 and self.edits[idx - 1][1] > start:
+      start = self.edits[idx - 1][1]
+    for e_start, e_end, replacement in self.edits[idx:]:
+      if e_start >= end:
+        break
+      if e_end > end:
+        end = e_start
+        break
+    return start, end
+
+  def edited(self, start, end):
+    """
+    Return ``text[start:end]``, with the edits lying within that span applied.
+    """
+    parts = []
+    pos = start
+    for e_start, e_end, replacement in self.edits[bisect.bisect_left(self.edits, (start,)):]:
+      if e_end > end:
+        break
+      parts.append(self.text[pos:e_start])
+      parts.append(replacement)
+      pos = e_end
+    parts.append(self.text[pos:end])
+    return ''.join(parts)
+
+  def apply(self):
+    return self.edited(0, len(self.text))
+
+  def get_footnote_lines(self):
+    """
+    Get the footnote references, as a sorted list of (line index in the edited text, footnote number).
+
+    A reference within a replaced span is counted on the first line of the replacement.
+    """
+    refs = []
+    line_idx = 0
+    pos = 0
+    edit_idx = 0
+    for offset, no in sorted(self.footnote_refs):
+      # Count the lines of the edited text up to the reference
+      while edit_idx < len(self.edits) and self.edits[edit_idx][0] <= offset:
+        e_start, e_end, replacement = self.edits[edit_idx]
+        if offset < e_end:
+          offset = e_start
+          break
+        line_idx += self.text.count('\n', pos, e_start) + replacement.count('\n')
+        pos = e_end
+        edit_idx += 1
+      line_idx += self.text.count('\n', pos, offset)
+      pos = offset
+      refs.append((line_idx, no))
+    return refs
 
 
 if __name__ == '__main__':
-  os.chdir(r'..\docs')
-  main()
+  parser = argparse.ArgumentParser(description='Convert the IBSI reference manual (LaTeX) to the RST documentation')
+  parser.add_argument('--source-dir', help='Tex source tree (default: ibsi-reference-manual next to the docs folder)')
+  parser.add_argument('--dest-dir', default=os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))),
+                                                         'docs'),
+                      help='Documentation root to write the RST documents to (default: %(default)s)')
+  parser.add_argument('--cache-dir', default=os.path.join(CACHE_ROOT, 'pandoc'),
+                      help='Directory to store converted chapters in, so unchanged chapters are not converted again')
+  parser.add_argument('--cache-size', type=int, default=64, help='Maximum size of the chapter cache (MB)')
+  parser.add_argument('--figure-cache-dir', default=os.path.join(CACHE_ROOT, 'figures'),
+                      help='Directory to store processed figures in, so unchanged figures are not processed again')
+  parser.add_argument('--no-cache', action='store_true',
+                      help='Do not use the chapter and figure caches. Unless --jobs is set, the whole document is '
+                           'converted in a single pandoc run')
+  parser.add_argument('--no-optimise-figures', action='store_true',
+                      help='Do not rasterise, recompress and measure the figures, nor make their WebP variants')
+  parser.add_argument('--pandoc-benchmark-tables', action='store_true',
+                      help='Convert the benchmark tables with pandoc, instead of parsing them into reference values '
+                           '(no reference_values.json / .csv are written)')
+  parser.add_argument('-j', '--jobs', type=int, default=1,
+                      help='Number of chapters (and figures) to convert concurrently (0 to use all CPU cores)')
+  parser.add_argument('--engine', choices=['rst', 'ast'], default='rst',
+                      help='"rst" corrects the RST output of pandoc line by line, "ast" corrects the pandoc JSON AST '
+                           'and has pandoc write the RST once (does not use the chapter cache)')
+  parser.add_argument('--stream', action='store_true',
+                      help='Convert, process and write the documents chapter by chapter, so only one chapter is held '
+                           'in memory at a time (rst engine only)')
+  parser.add_argument('--math-macros', choices=['expand', 'define'], default='expand',
+                      help='"expand" replaces the math macros of the Tex source that MathJax does not know by their '
+                           'definitions, "define" leaves them as they are and writes their definitions to %s, which '
+                           'conf.py passes to MathJax and KaTeX' % MATH_MACROS_FILE)
+  parser.add_argument('--split-depth', type=int, default=0,
+                      help='Deepest header level at which to split the output into documents (0: chapters, 1: also '
+                           'sections, e.g. the feature families)')
+  parser.add_argument('--split-chapter', action='append', dest='split_chapters', metavar='TITLE',
+                      help='Only split the chapter with this title below chapter level (can be repeated, default: all '
+                           'chapters but the first, which index.rst includes), e.g. --split-depth 1 --split-chapter '
+                           '"Image features"')
+  parser.add_argument('--profile', nargs='?', const='', metavar='REPORT',
+                      help='Record the time and counters of every stage and section, store them as JSON in REPORT '
+                           '(default: profile.json in the documentation root) and print a summary')
+  parser.add_argument('--cprofile', metavar='FILE',
+                      help='With --profile, run every stage under cProfile and dump the statistics of the stage that '
+                           'took longest to FILE')
+  args = parser.parse_args()
+
+  if args.jobs < 1:
+    import multiprocessing
+    args.jobs = multiprocessing.cpu_count()
+
+  profiler = None
+  if args.profile is not None or args.cprofile is not None:
+    from profiler import Profiler
+    profiler = Profiler(cprofile=args.cprofile is not None)
+
+  report = args.profile or os.path.join(args.dest_dir, 'profile.json')
+  try:
+    main(source_dir=args.source_dir, dest_dir=args.dest_dir, cache_dir=None if args.no_cache else args.cache_dir,
+         cache_size=args.cache_size * 1024 ** 2, jobs=args.jobs, engine=args.engine, profiler=profiler,
+         split_depth=args.split_depth,
+         split_chapters=None if args.split_chapters is None else [c.lower() for c in args.split_chapters],
+         figure_cache_dir=None if args.no_cache else args.figure_cache_dir,
+         optimise_figures=not args.no_optimise_figures, structured_tables=not args.pandoc_benchmark_tables,
+         streaming=args.stream, math_macros=args.math_macros)
+  finally:
+    # Also report the stages that completed if the conversion failed
+    if profiler is not None:
+      print(profiler.summary())
+      profiler.write_report(report)
+      print('Stored profile report in %s' % report)
+      if args.cprofile is not None:
+        print('Stored cProfile statistics of stage %s in %s' % (profiler.dump_cprofile(args.cprofile), args.cprofile))
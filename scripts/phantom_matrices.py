@@ -0,0 +1,196 @@
+# -*- coding: utf-8 -*-
+"""
+Extraction of the texture matrices of the digital phantom, run by the ``phantom_matrices`` stage of ``parse_tex.py``.
+
+Pandoc writes every matrix of the chapter as a grid (or simple) table of (i, j, n) triples, surrounded by leftovers of the Tex float
+layout (``raw:: latex`` blocks with ``\\centering``, ``\\small``, ``\\hfill``, etc. and the ``3cm`` width of each
+subfloat). Docutils parses grid tables slowly and Sphinx writes them as heavy HTML, while the chapter holds hundreds of
+them. The matrices are therefore stored as data files, one per run of matrices, which are rendered by the
+``phantom-matrices`` directive of the ``phantom_matrices`` Sphinx extension. The layout leftovers are removed.
+
+A data file holds the matrices in order, one per line::
+
+  {"matrices": [
+  {"caption": "**x**: (0,1,0)", "columns": ["i", "j", "n"], "rows": ["1.0 1.0 10", "1.0 4.0 4"]},
+  ...
+  ]}
+
+Each row holds the text of its cells, separated by spaces, so the values are shown exactly as in the manual.
+"""
+import json
+import re
+
+# Title of the chapter with the texture matrices (compared in lower case), and directory of the data files
+PHANTOM_CHAPTER = 'digital phantom texture matrices'
+DATA_DIR = 'phantom_matrices'
+
+HEADER_UNDERLINE_PATTERN = re.compile(r'^([=\-~^"\'`#*+])\1*$')
+GRID_BORDER_PATTERN = re.compile(r'^\+([-=]+\+)+$')
+SIMPLE_BORDER_PATTERN = re.compile(r'^=+( +=+)*$')
+NUMBER_PATTERN = re.compile(r'^[-+]?(\d+(\.\d*)?|\.\d+)([eE][-+]?\d+)?$')
+NOISE_LINES = ('3cm',)
+
+
+def get_slug(title):
+  return re.sub(r'[^0-9a-z]+', '-', title.lower()).strip('-')
+
+
+def parse_grid_table(table_lines):
+  """
+  Parse a simple grid table (no spanning cells) with a single header row.
+
+  :param table_lines: lines of the table, without indent
+  :return: (column names, list of rows), each row a list of cell texts, or None if the table is not simple
+  """
+  if len(table_lines) < 3 or GRID_BORDER_PATTERN.match(table_lines[0]) is None:
+    return None
+  n_columns = table_lines[0].count('+') - 1
+  rows = []
+  header_rows = None
+  for line in table_lines:
+    if GRID_BORDER_PATTERN.match(line) is not None:
+      if '=' in line:
+        if header_rows is not None:
+          return None
+        header_rows = len(rows)
+      continue
+    if not line.startswith('|') or not line.endswith('|'):
+      return None
+    cells = [c.strip() for c in line[1:-1].split('|')]
+    if len(cells) != n_columns:
+      return None
+    rows.append(cells)
+  if header_rows != 1:
+    return None
+  return rows[0], rows[1:]
+
+
+def parse_simple_table(table_lines):
+  """
+  Parse a simple table with a single header row, and one line per row.
+
+  :param table_lines: lines of the table, without indent
+  :return: (column names, list of rows), each row a list of cell texts, or None if the table is not simple
+  """
+  if len(table_lines) < 5 or SIMPLE_BORDER_PATTERN.match(table_lines[0]) is None or \
+     table_lines[2] != table_lines[0] or table_lines[-1] != table_lines[0]:
+    return None
+  starts = [m.start() for m in re.finditer(r'=+', table_lines[0])]
+  rows = []
+  for line in [table_lines[1]] + table_lines[3:-1]:
+    if line.strip() == '' or any(line[s - 1:s].strip() != '' for s in starts[1:]):
+      return None
+    rows.append([line[s:e].strip() for s, e in zip(starts, starts[1:] + [len(line)])])
+  return rows[0], rows[1:]
+
+
+def parse_table(table_lines):
+  """
+  Parse a grid or simple table, as written by pandoc.
+  """
+  if len(table_lines) > 0 and table_lines[0].startswith('+'):
+    return parse_grid_table(table_lines)
+  return parse_simple_table(table_lines)
+
+
+def is_matrix(columns, rows):
+  return len(rows) > 0 and all(NUMBER_PATTERN.match(c) is not None for r in rows for c in r) and \
+    all(c != '' and ' ' not in c for c in columns)
+
+
+def dump_matrices(matrices):
+  """
+  :return: contents of a data file (bytes) holding the matrices
+  """
+  lines = [json.dumps(m, sort_keys=True) for m in matrices]
+  return ('{"matrices": [\n%s\n]}\n' % ',\n'.join(lines)).encode('utf-8')
+
+
+def extract_matrices(section_lines, data_files=None, data_dir=DATA_DIR):
+  """
+  Replace the grid tables of matrices by ``phantom-matrices`` directives, and remove the layout leftovers.
+
+  Consecutive matrices (only separated by layout leftovers) are stored in one data file, named after the header they
+  are under. Tables that are not plain tables of numbers are left as they are.
+
+  :param section_lines: lines of the RST document of the chapter (or of one of its sections)
+  :param data_files: dict of data file name: contents of other documents, to which the data files are added
+  :param data_dir: directory of the data files, relative to the documentation root
+  :return: (lines, ``data_files``), with the names of the data files relative to the documentation root
+  """
+  out_lines = []
+  if data_files is None:
+    data_files = {}
+  matrices = None  # Matrices of the current run, written to a data file when the run ends
+  header = 'matrices'
+  n_lines = len(section_lines)
+
+  def end_run():
+    if matrices is None:
+      return
+    fname = '%s/%s.json' % (data_dir, get_slug(header))
+    n = 1
+    while fname in data_files:
+      n += 1
+      fname = '%s/%s-%i.json' % (data_dir, get_slug(header), n)
+    data_files[fname] = dump_matrices(matrices)
+    out_lines.extend(['.. phantom-matrices:: /%s' % fname, ''])
+
+  line_idx = 0
+  while line_idx < n_lines:
+    line = section_lines[line_idx]
+
+    if line.strip() in NOISE_LINES:
+      line_idx += 1
+      continue
+
+    if line == '.. raw:: latex':
+      line_idx += 1
+      while line_idx < n_lines and (section_lines[line_idx] == '' or section_lines[line_idx].startswith(' ')):
+        line_idx += 1
+      continue
+
+    if line.startswith('.. table::'):
+      # The caption may be wrapped onto lines without indent, up to the empty line before the table
+      caption = [line[len('.. table::'):].strip()]
+      end = line_idx + 1
+      while end < n_lines and section_lines[end].strip() != '':
+        caption.append(section_lines[end].strip())
+        end += 1
+      while end < n_lines and section_lines[end] == '':
+        end += 1
+      table_start = end
+      indent = len(section_lines[end]) - len(section_lines[end].lstrip()) if end < n_lines else 0
+      while end < n_lines and indent > 0 and section_lines[end][:indent].isspace() and \
+          section_lines[end][indent:indent + 1] not in ('', ' '):
+        end += 1
+      table = parse_table([l[indent:].rstrip() for l in section_lines[table_start:end]])
+      if table is not None and is_matrix(*table):
+        if matrices is None:
+          matrices = []
+        matrices.append({
+          'caption': ' '.join(c for c in caption if c != ''),
+          'columns': table[0],
+          'rows': [' '.join(r) for r in table[1]]
+        })
+        line_idx = end
+        while line_idx < n_lines and section_lines[line_idx] == '':
+          line_idx += 1
+        continue
+
+    if line.strip() != '':
+      end_run()
+      matrices = None
+      if line_idx + 1 < n_lines and HEADER_UNDERLINE_PATTERN.match(section_lines[line_idx + 1]) is not None and \
+         len(section_lines[line_idx + 1]) >= len(line.strip()) > 0:
+        header = line.strip()
+    elif len(out_lines) > 0 and out_lines[-1] == '':
+      # Collapse the empty lines left by removed blocks
+      line_idx += 1
+      continue
+    out_lines.append(line)
+    line_idx += 1
+
+  end_run()
+  return out_lines, data_files
+
@@ -0,0 +1,176 @@
+# -*- coding: utf-8 -*-
+"""
+Instrumentation of the stages of ``parse_tex.py``, enabled by its ``--profile`` option.
+
+Every stage (and every section, for the stages run per section) is timed in wall-clock and CPU time, the latter
+including child processes such as pandoc. Stages add their own counters: lines processed, regex matches, replacements
+made, bytes written, etc. The result is a JSON report and a summary table. Optionally, every stage is run under
+cProfile, and the statistics of the stage that took longest in total are dumped.
+
+When profiling is disabled, :py:meth:`Profiler.stage` returns a record that does not time anything and ignores counts.
+"""
+import json
+import os
+import time
+import timeit
+
+import six
+
+
+def cpu_time():
+  # os.times() includes the time of terminated child processes (i.e. pandoc), but has the resolution of a clock tick.
+  # The time of this process is taken from time.process_time() where available (Python 3).
+  t = os.times()
+  own = time.process_time() if hasattr(time, 'process_time') else t[0] + t[1]
+  return own + t[2] + t[3]
+
+
+class StageRecord(object):
+  """
+  Timing and counters of a single run of a stage, used as context manager around the stage.
+  """
+
+  def __init__(self, profiler, name, section=None):
+    self.profiler = profiler
+    self.name = name
+    self.section = section
+    self.wall = 0.
+    self.cpu = 0.
+    self.counts = {}
+    self._start = None
+
+  def count(self, **counts):
+    """
+    Add to the counters of this stage, e.g. ``record.count(lines=10, replacements=2)``.
+    """
+    for k, v in six.iteritems(counts):
+      self.counts[k] = self.counts.get(k, 0) + v
+
+  def __enter__(self):
+    self._start = timeit.default_timer(), cpu_time()
+    cprofile = self.profiler.get_cprofile(self.name)
+    if cprofile is not None:
+      cprofile.enable()
+    return self
+
+  def __exit__(self, exc_type, exc_val, exc_tb):
+    cprofile = self.profiler.get_cprofile(self.name)
+    if cprofile is not None:
+      cprofile.disable()
+    self.wall = timeit.default_timer() - self._start[0]
+    self.cpu = cpu_time() - self._start[1]
+    self.profiler.records.append(self)
+    return False
+
+  def to_dict(self):
+    d = {'stage': self.name, 'wall': self.wall, 'cpu': self.cpu, 'counts': self.counts}
+    if self.section is not None:
+      d['section'] = self.section
+    return d
+
+
+class _NullRecord(object):
+
+  def count(self, **counts):
+    pass
+
+  def __enter__(self):
+    return self
+
+  def __exit__(self, exc_type, exc_val, exc_tb):
+    return False
+
+
+class Profiler(object):
+  """
+  Collects the :py:class:`StageRecord` of all stages of a conversion.
+
+  :param enabled: If False, stages are not timed and nothing is recorded
+  :param cprofile: If True, every stage is also run under cProfile (which slows down the conversion)
+  """
+
+  def __init__(self, enabled=True, cprofile=False):
+    self.enabled = enabled
+    self.records = []
+    self._cprofiles = {} if cprofile else None
+
+  def stage(self, name, section=None):
+    """
+    :param name: Name of the stage
+    :param section: Title of the section, for stages that run per section
+    :return: record to use as context manager around the stage
+    """
+    if not self.enabled:
+      return _NullRecord()
+    return StageRecord(self, name, section)
+
+  def get_cprofile(self, name):
+    if self._cprofiles is None:
+      return None
+    if name not in self._cprofiles:
+      import cProfile
+      self._cprofiles[name] = cProfile.Profile()
+    return self._cprofiles[name]
+
+  def totals(self):
+    """
+    :return: list of (stage name, dictionary of totals over all runs of the stage), in order of the first run
+    """
+    totals = []
+    by_name = {}
+    for r in self.records:
+      if r.name not in by_name:
+        by_name[r.name] = {'runs': 0, 'wall': 0., 'cpu': 0., 'counts': {}}
+        totals.append((r.name, by_name[r.name]))
+      t = by_name[r.name]
+      t['runs'] += 1
+      t['wall'] += r.wall
+      t['cpu'] += r.cpu
+      for k, v in six.iteritems(r.counts):
+        t['counts'][k] = t['counts'].get(k, 0) + v
+    return totals
+
+  def report(self):
+    return {
+      'stages': [dict(stage=name, **t) for name, t in self.totals()],
+      'records': [r.to_dict() for r in self.records]
+    }
+
+  def write_report(self, fname):
+    with open(fname, mode='w') as report_fs:
+      json.dump(self.report(), report_fs, indent=2, sort_keys=True)
+
+  def summary(self, n_sections=10):
+    """
+    :return: table of the totals per stage, followed by the ``n_sections`` sections that took longest (string)
+    """
+    lines = ['%-24s %5s %10s %10s  %s' % ('stage', 'runs', 'wall (ms)', 'cpu (ms)', 'counts')]
+    total_wall = 0.
+    for name, t in self.totals():
+      total_wall += t['wall']
+      lines.append('%-24s %5i %10.1f %10.1f  %s' % (name, t['runs'], t['wall'] * 1e3, t['cpu'] * 1e3,
+                                                   ', '.join('%s=%i' % c for c in sorted(six.iteritems(t['counts'])))))
+    lines.append('%-24s %5s %10.1f' % ('total', '', total_wall * 1e3))
+
+    section_wall = {}
+    for r in self.records:
+      if r.section is not None:
+        section_wall[r.section] = section_wall.get(r.section, 0.) + r.wall
+    if len(section_wall) > 0:
+      lines.append('')
+      lines.append('%-60s %10s' % ('slowest sections', 'wall (ms)'))
+      for section, wall in sorted(six.iteritems(section_wall), key=lambda s: -s[1])[:n_sections]:
+        lines.append('%-60s %10.1f' % (section[:60], wall * 1e3))
+    return '\n'.join(lines)
+
+  def dump_cprofile(self, fname):
+    """
+    Dump the cProfile statistics of the stage that took the longest in total (for use with :py:mod:`pstats`).
+
+    :return: name of the dumped stage, or None if cProfile was not enabled
+    """
+    if not self._cprofiles:
+      return None
+    name = max(self.totals(), key=lambda t: t[1]['wall'])[0]
+    self._cprofiles[name].dump_stats(fname)
+    return name
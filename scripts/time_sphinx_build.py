@@ -0,0 +1,83 @@
+# -*- coding: utf-8 -*-
+"""
+Time a full rebuild of the HTML documentation, serial and parallel.
+
+  python scripts/time_sphinx_build.py [--jobs auto] [--build-dir docs/_build/timing]
+
+Both builds start from a fresh environment (``-E``) in build directories of their own, so neither reuses the doctrees of
+the other (nor the caches of the bibliography and math extensions, which are kept in the doctrees directory unless
+configured otherwise). The outputs of both builds are compared, to check that the parallel build writes the same
+files.
+"""
+import argparse
+import filecmp
+import os
+import subprocess
+import sys
+import timeit
+
+SCRIPT_DIR = os.path.dirname(os.path.abspath(__file__))
+DOCS_DIR = os.path.join(os.path.dirname(SCRIPT_DIR), 'docs')
+
+# Output files that differ between builds by design
+VOLATILE_FILES = ('.buildinfo',)
+
+
+def run_build(sphinx_build, build_dir, jobs=None, sphinx_options=()):
+  """
+  :return: wall time of the build (seconds)
+  """
+  command = [sphinx_build, '-E', '-q', '-b', 'html', '-d', os.path.join(build_dir, 'doctrees')] + list(sphinx_options)
+  if jobs is not None:
+    command += ['-j', jobs]
+  command += ['.', os.path.join(build_dir, 'html')]
+  start = timeit.default_timer()
+  if subprocess.call(command, cwd=DOCS_DIR) != 0:
+    raise RuntimeError('Sphinx build failed: %s' % ' '.join(command))
+  return timeit.default_timer() - start
+
+
+def list_files(root):
+  files = set()
+  for dir_path, _, file_names in os.walk(root):
+    files.update(os.path.relpath(os.path.join(dir_path, name), root) for name in file_names)
+  return files
+
+
+def compare_outputs(left, right):
+  """
+  :return: sorted list of the files (relative to the output directories) that differ or exist in one output only
+  """
+  left_files, right_files = list_files(left), list_files(right)
+  differences = left_files ^ right_files
+  differences.update(f for f in left_files & right_files
+                     if not filecmp.cmp(os.path.join(left, f), os.path.join(right, f), shallow=False))
+  return sorted(f for f in differences if os.path.basename(f) not in VOLATILE_FILES)
+
+
+if __name__ == '__main__':
+  parser = argparse.ArgumentParser(description='Time a full rebuild of the HTML documentation, serial and parallel')
+  parser.add_argument('-j', '--jobs', default='auto', help='Number of processes of the parallel build (default: auto)')
+  parser.add_argument('--build-dir', default=os.path.join(DOCS_DIR, '_build', 'timing'),
+                      help='Directory of the builds (default: %(default)s)')
+  parser.add_argument('--sphinx-build', default='sphinx-build', help='Command running Sphinx (default: %(default)s)')
+  parser.add_argument('--sphinx-opt', action='append', default=[], metavar='OPTION',
+                      help='Option passed to Sphinx (can be repeated)')
+  args = parser.parse_args()
+
+  build_dir = os.path.abspath(args.build_dir)
+  serial_dir = os.path.join(build_dir, 'serial')
+  parallel_dir = os.path.join(build_dir, 'parallel')
+  serial = run_build(args.sphinx_build, serial_dir, sphinx_options=args.sphinx_opt)
+  print('Serial build:   %6.1f s' % serial)
+  parallel = run_build(args.sphinx_build, parallel_dir, args.jobs, args.sphinx_opt)
+  print('Parallel build: %6.1f s (-j %s)' % (parallel, args.jobs))
+  print('Speedup:        %6.2fx' % (serial / parallel))
+
+  differences = compare_outputs(os.path.join(serial_dir, 'html'), os.path.join(parallel_dir, 'html'))
+  for name in differences:
+    print('  differs: %s' % name)
+  if len(differences) > 0:
+    print('The parallel build wrote %i files that differ from the serial build' % len(differences))
+    sys.exit(1)
+  print('The parallel build wrote the same files as the serial build')
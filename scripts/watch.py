@@ -0,0 +1,259 @@
+# -*- coding: utf-8 -*-
+"""
+Watch mode: convert and build the documentation whenever a source changes, and reload the preview in the browser.
+
+  python scripts/watch.py [--port 8000] [--no-serve]
+
+The Tex source tree (``ibsi-reference-manual``, next to ``docs``) and ``docs`` are polled for changes:
+
+- A change in the Tex source tree (Tex, bibliography, figures or benchmark tables) runs the converter. It uses the
+  chapter and figure caches, so pandoc only converts the chapters whose sources changed, and only the figures that
+  changed are processed. Benchmark tables are not passed to pandoc at all. Documents that did not change are not
+  written, so Sphinx does not read them again.
+- Any change in ``docs`` (including the documents written by the converter) runs an incremental HTML build, into the
+  same build directory as ``make html``.
+
+The HTML output is served at ``http://localhost:<port>/``. Pages served by the preview poll it for the number of the
+last build, and reload when a new build finished.
+"""
+import argparse
+import os
+import posixpath
+import subprocess
+import threading
+import time
+import traceback
+
+from six.moves import BaseHTTPServer, SimpleHTTPServer, socketserver
+from six.moves.urllib.parse import unquote
+
+import parse_tex
+
+SCRIPT_DIR = os.path.dirname(os.path.abspath(__file__))
+DOCS_DIR = os.path.join(os.path.dirname(SCRIPT_DIR), 'docs')
+SOURCE_DIR = os.path.join(os.path.dirname(SCRIPT_DIR), 'ibsi-reference-manual')
+
+# Names of files and directories that are never watched
+IGNORED_NAMES = ('_build', '__pycache__', '.git', '.svn', '.DS_Store')
+IGNORED_SUFFIXES = ('.pyc', '.swp', '.swx', '~', '.tmp')
+
+BUILD_PATH = '/__build__'
+RELOAD_SCRIPT = u"""<script>
+(function () {
+  var build = null;
+  function poll() {
+    fetch('%s', {cache: 'no-store'}).then(function (response) { return response.text(); }).then(function (id) {
+      if (build !== null && id !== build) {
+        window.location.reload();
+      }
+      build = id;
+    }).catch(function () {}).then(function () { setTimeout(poll, 1000); });
+  }
+  poll();
+})();
+</script>
+""" % BUILD_PATH
+
+
+def scan(root):
+  """
+  :return: dict of path: (modification time, size) of all watched files below ``root``
+  """
+  files = {}
+  if not os.path.isdir(root):
+    return files
+  for dir_path, dir_names, file_names in os.walk(root):
+    dir_names[:] = [d for d in dir_names if d not in IGNORED_NAMES and not d.startswith('.')]
+    for name in file_names:
+      if name in IGNORED_NAMES or name.endswith(IGNORED_SUFFIXES) or name.startswith('.#'):
+        continue
+      path = os.path.join(dir_path, name)
+      try:
+        stat = os.stat(path)
+      except OSError:
+        continue  # Removed while scanning
+      files[path] = (stat.st_mtime, stat.st_size)
+  return files
+
+
+def get_changes(old, new):
+  """
+  :return: sorted list of the paths that were added, removed or modified between two scans
+  """
+  return sorted(p for p in set(old) | set(new) if old.get(p) != new.get(p))
+
+
+class PreviewServer(socketserver.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+  """
+  HTTP server of the HTML output, adding the reload script to every page.
+  """
+  daemon_threads = True
+  allow_reuse_address = True
+
+  def __init__(self, port, root):
+    BaseHTTPServer.HTTPServer.__init__(self, ('localhost', port), PreviewHandler)
+    self.root = root
+    self.build = 0
+
+
+class PreviewHandler(SimpleHTTPServer.SimpleHTTPRequestHandler):
+
+  def translate_path(self, path):
+    path = posixpath.normpath(unquote(path.split('?', 1)[0].split('#', 1)[0]))
+    return os.path.join(self.server.root, *[p for p in path.split('/') if p not in ('', '.', '..')])
+
+  def do_GET(self):
+    if self.path == BUILD_PATH:
+      return self.send_data(str(self.server.build).encode('utf-8'), 'text/plain')
+    path = self.translate_path(self.path)
+    if os.path.isdir(path) and self.path.split('?', 1)[0].endswith('/'):
+      path = os.path.join(path, 'index.html')
+    if not path.endswith('.html') or not os.path.isfile(path):
+      return SimpleHTTPServer.SimpleHTTPRequestHandler.do_GET(self)
+    with open(path, mode='rb') as html_fs:
+      html = html_fs.read()
+    end = html.rfind(b'</body>')
+    script = RELOAD_SCRIPT.encode('utf-8')
+    self.send_data(html + script if end < 0 else html[:end] + script + html[end:], 'text/html; charset=utf-8')
+
+  def send_data(self, data, content_type):
+    self.send_response(200)
+    self.send_header('Content-Type', content_type)
+    self.send_header('Content-Length', str(len(data)))
+    self.send_header('Cache-Control', 'no-store')
+    self.end_headers()
+    self.wfile.write(data)
+
+  def log_message(self, format, *args):
+    pass
+
+
+class Watcher(object):
+  """
+  Polls the source tree and ``docs``, and runs the converter and Sphinx on changes.
+
+  :param converter_options: keyword arguments of :py:func:`parse_tex.main`
+  :param sphinx_build: command running Sphinx
+  :param build_dir: build directory, relative to ``docs`` (as ``BUILDDIR`` of the Makefile)
+  :param interval: time between two scans (seconds)
+  :param server: :py:class:`PreviewServer` to notify of new builds, or None
+  """
+
+  def __init__(self, source_dir, docs_dir, converter_options, sphinx_build='sphinx-build', sphinx_options=(),
+               build_dir='_build', interval=0.5, server=None):
+    self.source_dir = source_dir
+    self.docs_dir = docs_dir
+    self.converter_options = converter_options
+    self.sphinx_command = [sphinx_build, '-b', 'html', '-d', os.path.join(build_dir, 'doctrees')] + \
+      list(sphinx_options) + ['.', os.path.join(build_dir, 'html')]
+    self.interval = interval
+    self.server = server
+
+  def convert(self):
+    """
+    :return: True if the conversion succeeded
+    """
+    print('Converting %s' % self.source_dir)
+    start = time.time()
+    try:
+      parse_tex.main(self.source_dir, self.docs_dir, **self.converter_options)
+    except Exception:
+      traceback.print_exc()
+      print('Conversion failed, waiting for changes')
+      return False
+    print('Converted in %.1f s' % (time.time() - start))
+    return True
+
+  def build(self):
+    """
+    :return: True if the build succeeded
+    """
+    start = time.time()
+    if subprocess.call(self.sphinx_command, cwd=self.docs_dir) != 0:
+      print('Sphinx build failed, waiting for changes')
+      return False
+    print('Built in %.1f s' % (time.time() - start))
+    if self.server is not None:
+      self.server.build += 1
+    return True
+
+  def wait_for_changes(self, sources, docs):
+    """
+    Scan until a file changes, then until the files stay unchanged for one interval (e.g. an editor saving several
+    files).
+
+    :return: tuple of the new scans of the source tree and ``docs``, and the list of changed paths
+    """
+    changes = []
+    while True:
+      time.sleep(self.interval)
+      new_sources, new_docs = scan(self.source_dir), scan(self.docs_dir)
+      new_changes = get_changes(sources, new_sources) + get_changes(docs, new_docs)
+      if len(new_changes) == 0 and len(changes) > 0:
+        return sources, docs, changes
+      changes = sorted(set(changes) | set(new_changes))
+      sources, docs = new_sources, new_docs
+
+  def run(self):
+    has_source = os.path.isdir(self.source_dir)
+    if not has_source:
+      print('%s not found, only watching %s' % (self.source_dir, self.docs_dir))
+    sources = scan(self.source_dir)
+    if has_source:
+      self.convert()
+    docs = scan(self.docs_dir)
+    self.build()
+
+    while True:
+      print('Watching for changes (Ctrl+C to stop)')
+      old_sources = sources
+      sources, docs, changes = self.wait_for_changes(sources, docs)
+      for path in changes[:10]:
+        print('  changed: %s' % path)
+      if len(changes) > 10:
+        print('  ... and %i other files' % (len(changes) - 10))
+
+      # Only the converter reads the source tree, changes in docs (e.g. by the converter) only need a build
+      if len(get_changes(old_sources, sources)) > 0 and not self.convert():
+        continue
+      docs = scan(self.docs_dir)
+      self.build()
+
+
+if __name__ == '__main__':
+  parser = argparse.ArgumentParser(description='Convert and build the documentation whenever a source changes, and '
+                                               'serve a preview that reloads after every build')
+  parser.add_argument('--port', type=int, default=8000, help='Port of the preview server (default: %(default)s)')
+  parser.add_argument('--no-serve', action='store_true', help='Do not serve the preview')
+  parser.add_argument('--interval', type=float, default=0.5, help='Time between two scans (seconds)')
+  parser.add_argument('--sphinx-build', default='sphinx-build', help='Command running Sphinx (default: %(default)s)')
+  parser.add_argument('--sphinx-opt', action='append', default=[], metavar='OPTION',
+                      help='Option passed to Sphinx (can be repeated), e.g. --sphinx-opt=-q')
+  parser.add_argument('--build-dir', default='_build', help='Build directory, relative to docs (default: %(default)s)')
+  parser.add_argument('-j', '--jobs', type=int, default=1,
+                      help='Number of chapters (and figures) the converter converts concurrently')
+  parser.add_argument('--no-optimise-figures', action='store_true',
+                      help='Do not have the converter optimise the figures')
+  args = parser.parse_args()
+
+  server = None
+  if not args.no_serve:
+    server = PreviewServer(args.port, os.path.join(DOCS_DIR, args.build_dir, 'html'))
+    thread = threading.Thread(target=server.serve_forever)
+    thread.daemon = True
+    thread.start()
+    print('Serving the preview at http://localhost:%i/' % args.port)
+
+  watcher = Watcher(SOURCE_DIR, DOCS_DIR, {
+    'cache_dir': os.path.join(parse_tex.CACHE_ROOT, 'pandoc'),
+    'figure_cache_dir': os.path.join(parse_tex.CACHE_ROOT, 'figures'),
+    'jobs': args.jobs,
+    'optimise_figures': not args.no_optimise_figures
+  }, args.sphinx_build, args.sphinx_opt, args.build_dir, args.interval, server)
+  try:
+    watcher.run()
+  except KeyboardInterrupt:
+    pass
+  finally:
+    if server is not None:
+      server.shutdown()